@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark suite for requests-ecp.
+
+These benchmarks use `pytest-benchmark`, run them with
+
+.. code-block:: bash
+
+    python -m pytest benchmarks/ --benchmark-autosave
+
+and compare against a previous run with ``--benchmark-compare``.
+
+All HTTP traffic goes to an in-process stand-in Service Provider and
+Identity Provider built on `requests_mock`, using the PAOS and SOAP
+messages from the unit test suite.
+"""
+
+import pytest
+
+import requests
+import requests_mock
+
+from requests_ecp.tests.test_ecp import (
+    IDP_ECP_SOAP_RESPONSE,
+    SP_ECP_PAOS_RESPONSE,
+)
+
+pytest.importorskip("pytest_benchmark")
+
+IDP = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+ACS = "https://example.com/Shibboleth.sso/SAML2/ECP"
+DATA = "https://example.com/data"
+LOGIN = "https://example.com/Shibboleth.sso/Login?SAMLRequest=abc"
+SESSION_COOKIE = "_shibsession_abc"
+
+
+def _has_session(request):
+    return SESSION_COOKIE in request.headers.get("Cookie", "")
+
+
+def _wants_paos(request):
+    return "PAOS" in request.headers
+
+
+def mock_service(adapter):
+    """Configure a `requests_mock.Adapter` as a Shibboleth SP and IdP.
+
+    The SP returns data to requests with a session cookie, PAOS
+    ``<AuthnRequest>`` messages to ECP requests, and redirects
+    everything else to the IdP.
+    """
+    adapter.register_uri(
+        "GET",
+        DATA,
+        text="data",
+        additional_matcher=_has_session,
+    )
+    adapter.register_uri(
+        "GET",
+        DATA,
+        content=SP_ECP_PAOS_RESPONSE,
+        additional_matcher=lambda r: (
+            _wants_paos(r) and not _has_session(r)
+        ),
+    )
+    adapter.register_uri(
+        "GET",
+        DATA,
+        status_code=302,
+        headers={"Location": LOGIN},
+        additional_matcher=lambda r: not (
+            _wants_paos(r) or _has_session(r)
+        ),
+    )
+    adapter.register_uri("POST", IDP, content=IDP_ECP_SOAP_RESPONSE)
+    adapter.register_uri(
+        "POST",
+        ACS,
+        status_code=302,
+        headers={"Location": DATA},
+        cookies={SESSION_COOKIE: "123"},
+    )
+    return adapter
+
+
+@pytest.fixture
+def service():
+    """A `requests_mock.Adapter` emulating an SP and its IdP.
+    """
+    return mock_service(requests_mock.Adapter())
+
+
+def mount(session, adapter):
+    """Mount an adapter for all HTTPS traffic on a session.
+    """
+    session.mount("https://", adapter)
+    return session
+
+
+def authenticated(session):
+    """Add a valid SP session cookie to a session.
+    """
+    session.cookies.set(SESSION_COOKIE, "123", domain="example.com")
+    return session
+
+
+@pytest.fixture
+def response_200():
+    """A plain ``200 OK`` response.
+    """
+    response = requests.Response()
+    response.status_code = 200
+    response.url = DATA
+    return response
+
+
+@pytest.fixture
+def response_ecp_redirect():
+    """A ``302 Found`` response redirecting to the IdP.
+    """
+    response = requests.Response()
+    response.status_code = 302
+    response.url = DATA
+    response.headers["Location"] = LOGIN
+    return response
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for requests_ecp.auth and requests_ecp.session.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import requests
+
+import requests_ecp
+from requests_ecp import auth as requests_ecp_auth
+
+from conftest import (
+    DATA,
+    IDP,
+    authenticated,
+    mount,
+)
+
+NTHREADS = 8
+NREQUESTS = 200
+
+
+# -- redirect detection -----
+
+@pytest.mark.parametrize("fixture", [
+    "response_200",
+    "response_ecp_redirect",
+])
+def test_is_ecp_auth_redirect(benchmark, request, fixture):
+    response = request.getfixturevalue(fixture)
+    benchmark(requests_ecp_auth.is_ecp_auth_redirect, response)
+
+
+@pytest.mark.parametrize("fixture", [
+    "response_200",
+    "response_ecp_redirect",
+])
+def test_is_gitlab_auth_redirect(benchmark, request, fixture):
+    response = request.getfixturevalue(fixture)
+    benchmark(requests_ecp_auth.is_gitlab_auth_redirect, response)
+
+
+def test_handle_response_ok(benchmark, response_200):
+    """Benchmark the response hook for a response that needs no auth.
+    """
+    auth = requests_ecp.HTTPECPAuth(IDP, username="user", password="pass")
+    response_200.request = auth(requests.Request("GET", DATA).prepare())
+    hook, = response_200.request.hooks["response"]
+    benchmark(hook, response_200)
+
+
+# -- sessions ---------------
+
+def test_get_plain(benchmark, service):
+    """Benchmark an authenticated GET on a plain `requests.Session`.
+
+    This is the baseline for `test_get_authenticated`.
+    """
+    with authenticated(mount(requests.Session(), service)) as sess:
+        assert benchmark(sess.get, DATA).text == "data"
+
+
+def test_get_authenticated(benchmark, service):
+    """Benchmark a GET on a `requests_ecp.Session` with a valid SP session.
+    """
+    with authenticated(mount(requests_ecp.Session(
+        idp=IDP,
+        username="user",
+        password="pass",
+    ), service)) as sess:
+        assert benchmark(sess.get, DATA).text == "data"
+
+
+def test_get_login(benchmark, service):
+    """Benchmark a GET on a `requests_ecp.Session` that requires ECP login.
+    """
+    def _get():
+        with mount(requests_ecp.Session(
+            idp=IDP,
+            username="user",
+            password="pass",
+        ), service) as sess:
+            return sess.get(DATA, allow_redirects=False)
+
+    assert benchmark(_get).status_code == 302
+
+
+@pytest.mark.parametrize("nthreads", (1, NTHREADS, 64))
+def test_get_authenticated_threads(benchmark, service, nthreads):
+    """Benchmark authenticated GET throughput on a session shared by threads.
+    """
+    def _get_many(sess):
+        with ThreadPoolExecutor(nthreads) as pool:
+            return list(pool.map(lambda _: sess.get(DATA), range(NREQUESTS)))
+
+    with authenticated(mount(requests_ecp.Session(
+        idp=IDP,
+        username="user",
+        password="pass",
+    ), service)) as sess:
+        responses = benchmark(_get_many, sess)
+    assert all(r.text == "data" for r in responses)
+
+
+def test_auth_overhead(benchmark, response_200):
+    """Benchmark the total per-request overhead of `HTTPECPAuth`.
+
+    This is the cost of attaching the auth to a prepared request and
+    then dispatching the response hook for a ``200 OK`` response, which
+    is all that happens for a request with a valid SP session.
+    """
+    auth = requests_ecp.HTTPECPAuth(IDP, username="user", password="pass")
+    request = requests.Request("GET", DATA).prepare()
+
+    def _request():
+        request.hooks = {"response": []}
+        hooks = auth(request).hooks
+        requests.hooks.dispatch_hook("response", hooks, response_200)
+
+    benchmark(_request)
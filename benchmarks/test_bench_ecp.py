@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for requests_ecp.ecp.
+"""
+
+from contextlib import nullcontext
+from unittest import mock
+
+import pytest
+from lxml import etree
+
+from requests.auth import HTTPBasicAuth
+
+from requests_ecp import ecp
+from requests_ecp.tests.test_ecp import (
+    IDP_ECP_SOAP_RESPONSE,
+    SP_ECP_PAOS_RESPONSE,
+)
+
+from conftest import (
+    DATA,
+    IDP,
+)
+
+#: An IdP response with a large assertion (~1 MB).
+LARGE_IDP_ECP_SOAP_RESPONSE = IDP_ECP_SOAP_RESPONSE.replace(
+    b"cipher_value",
+    b"".join(b'<value n="%d">cipher_value</value>' % i for i in range(25000)),
+    1,
+)
+
+
+def test_authenticate(benchmark, service):
+    """Benchmark a full ECP round-trip.
+    """
+    auth = HTTPBasicAuth("user", "passwd")
+    responses = benchmark(ecp.authenticate, service, auth, IDP, DATA)
+    assert responses[-1].status_code == 302
+
+
+def test_parse_sp_request(benchmark):
+    """Benchmark parsing (and re-serialising) the SP PAOS request.
+    """
+    idpbody = benchmark(ecp._parse_sp_request, SP_ECP_PAOS_RESPONSE)[0]
+    assert idpbody.startswith(b"<S:Envelope")
+
+
+def test_parse_idp_response(benchmark):
+    """Benchmark parsing (and re-serialising) the IdP SOAP response.
+    """
+    relaystate = ecp._get_xml_attribute(
+        etree.XML(SP_ECP_PAOS_RESPONSE),
+        "//ecp:RelayState",
+    )
+    spbody = benchmark(
+        ecp._parse_idp_response,
+        IDP_ECP_SOAP_RESPONSE,
+        IDP,
+        relaystate,
+    )[0]
+    assert b"RelayState" in spbody
+
+
+@pytest.mark.parametrize("rewrite", [
+    pytest.param(True, id="header"),
+    pytest.param(False, id="tree"),
+])
+def test_parse_idp_response_large(benchmark, rewrite):
+    """Benchmark rewriting an IdP response with a large assertion.
+
+    ``header`` rewrites only the SOAP header, ``tree`` parses and
+    re-serialises the whole envelope.
+    """
+    relaystate = ecp._get_xml_attribute(
+        etree.XML(SP_ECP_PAOS_RESPONSE),
+        "//ecp:RelayState",
+    )
+    if rewrite:
+        context = nullcontext()
+    else:  # make the header rewrite fall back to the whole tree
+        context = mock.patch.object(
+            ecp,
+            "_parse_header",
+            return_value=(None,) * 4,
+        )
+    with context:
+        spbody = benchmark(
+            ecp._parse_idp_response,
+            LARGE_IDP_ECP_SOAP_RESPONSE,
+            IDP,
+            relaystate,
+        )[0]
+    assert b"RelayState" in spbody
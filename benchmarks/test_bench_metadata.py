@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for requests_ecp.metadata.
+"""
+
+from io import BytesIO
+
+import pytest
+
+from requests_ecp.metadata import MetadataIndex
+
+NUM_ENTITIES = 10000
+
+
+@pytest.fixture(scope="module")
+def metadata():
+    """A synthetic federation metadata aggregate.
+    """
+    entities = b"".join(
+        b'<md:EntityDescriptor entityID="https://idp%d.example.org/idp">'
+        b'<md:IDPSSODescriptor><md:SingleSignOnService '
+        b'Binding="urn:oasis:names:tc:SAML:2.0:bindings:SOAP" '
+        b'Location="https://idp%d.example.org/ECP"/>'
+        b'</md:IDPSSODescriptor></md:EntityDescriptor>' % (i, i)
+        for i in range(NUM_ENTITIES)
+    )
+    return (
+        b'<md:EntitiesDescriptor '
+        b'xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">'
+        + entities
+        + b'</md:EntitiesDescriptor>'
+    )
+
+
+def test_build(benchmark, metadata, tmp_path):
+    """Benchmark indexing a metadata aggregate.
+    """
+    index = MetadataIndex(tmp_path / "metadata.idx")
+    assert benchmark(
+        lambda: index.build(BytesIO(metadata)),
+    ) == 2 * NUM_ENTITIES
+
+
+def test_resolve(benchmark, metadata, tmp_path):
+    """Benchmark resolving an IdP endpoint from an index.
+    """
+    with MetadataIndex(tmp_path / "metadata.idx") as index:
+        index.build(BytesIO(metadata))
+        assert benchmark(index.resolve, "idp1234.example.org") == (
+            "https://idp1234.example.org/ECP"
+        )
@@ -32,6 +32,7 @@ __author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
 __version__ = "0.3.2"
 
 from .auth import HTTPECPAuth
+from .cache import CookieCache
 from .session import (
     ECPAuthSessionMixin,
     Session,
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp.
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Asynchronous ECP authentication using HTTPX.
+
+This module requires `HTTPX <https://www.python-httpx.org/>`__:
+
+.. code-block:: python
+
+    >>> from requests_ecp.aio import AsyncSession
+    >>> async with AsyncSession(idp="https://idp.example.com/SAML/SOAP/ECP") as sess:
+    ...     await sess.get("https://private.example.com/data")
+
+"""  # noqa: E501
+
+__author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
+
+import asyncio
+import threading
+from urllib.parse import urlparse
+
+try:
+    import httpx
+except ModuleNotFoundError as exc:  # pragma: no cover
+    raise ModuleNotFoundError(
+        f"{exc.msg}; you must install httpx to use requests_ecp.aio",
+    ) from exc
+
+from .auth import _is_ecp_auth_location
+from .credentials import get_credentials
+from .ecp import (
+    IDP_HEADERS,
+    PAOS_HEADERS,
+    SP_HEADERS,
+    _parse_idp_response,
+    _parse_sp_request,
+    _soap_fault,
+)
+
+
+# -- utilities --------------
+
+def is_ecp_auth_redirect(response):
+    """Return `True` if a response indicates a request for ECP authentication.
+
+    Parameters
+    ----------
+    response : `httpx.Response`
+        The response object to inspect.
+
+    Returns
+    -------
+    state : bool
+        `True` if ``response`` looks like a redirect initiated by Shibboleth,
+        otherwise `False`.
+    """
+    if not response.has_redirect_location:
+        return False
+    return _is_ecp_auth_location(response.headers['location'])
+
+
+def _is_ecp_redirected(response):
+    """Return `True` if a response was redirected for ECP authentication.
+
+    This includes redirects already followed by the client
+    (with ``follow_redirects=True``), which are in ``response.history``.
+    """
+    return any(map(is_ecp_auth_redirect, (*response.history, response)))
+
+
+def _raise_for_status(response):
+    """Raise an `httpx.HTTPStatusError` for error responses only.
+    """
+    if response.is_error:
+        response.raise_for_status()
+    return response
+
+
+def _delegate(flow):
+    """Run an `httpx.Auth` flow as part of another flow.
+
+    Returns the final response from the delegated flow.
+    """
+    request = next(flow)
+    while True:
+        response = yield request
+        try:
+            request = flow.send(response)
+        except StopIteration:
+            return response
+
+
+def _request_cookies(request):
+    """Return the ``(name, value)`` pairs of the cookies sent by a request.
+    """
+    return {
+        tuple(part.strip().split("=", 1))
+        for part in request.headers.get("Cookie", "").split(";")
+        if "=" in part
+    }
+
+
+def _has_cookies(request, cookies):
+    """Return `True` if a request already sent all of some cookies.
+    """
+    sent = _request_cookies(request)
+    return all((cookie.name, cookie.value) in sent for cookie in cookies.jar)
+
+
+def _set_cookies(request, cookies):
+    """Add some `httpx.Cookies` to a request.
+
+    Cookies already on the request with the same name are replaced.
+    """
+    probe = httpx.Request(request.method, request.url)
+    cookies.set_cookie_header(probe)
+    if "Cookie" not in probe.headers:
+        return
+    names = {cookie.name for cookie in cookies.jar}
+    existing = [
+        part.strip() for part in request.headers.get("Cookie", "").split(";")
+        if part.strip() and part.split("=", 1)[0].strip() not in names
+    ]
+    request.headers["Cookie"] = "; ".join(
+        existing + [probe.headers["Cookie"]],
+    )
+
+
+def _import_kerberos_auth():
+    try:
+        from httpx_gssapi import HTTPSPNEGOAuth
+    except ModuleNotFoundError as exc:  # pragma: no cover
+        # no kerberos interface, display a useful error message
+        raise ModuleNotFoundError(
+            f"{exc.msg}; you must install httpx-gssapi "
+            "to use Kerberos auth with requests_ecp.aio"
+        ) from exc
+    return HTTPSPNEGOAuth
+
+
+# -- Auth -------------------
+
+class AsyncHTTPECPAuth(httpx.Auth):
+    """SAML2/ECP authorisation plugin for :mod:`httpx`.
+
+    This is the `httpx` counterpart of `requests_ecp.HTTPECPAuth`;
+    it intercepts redirect responses that target a `SAMLRequest`
+    authorisation or a `Shibboleth.sso` discovery service, executes a
+    SAML2/ECP workflow against the configured Identity Provider (``idp``),
+    and then replays the original request with the new session cookies.
+
+    The flow does no I/O of its own, so it can be used with both
+    `httpx.AsyncClient` and `httpx.Client`.
+    If many requests to the same Service Provider are redirected at once,
+    only one of them executes the ECP round-trip, the others wait for it
+    (using an `asyncio.Lock` per host, or a `threading.Lock` with
+    `httpx.Client`) and are then replayed with the new session cookies.
+
+    If the client follows redirects itself (``follow_redirects=True``),
+    the redirect to the Identity Provider is found in the history of
+    the final response, but following it costs an extra request, so
+    it is better not to.
+
+    Kerberos authentication is supported via the
+    `httpx-gssapi <https://github.com/pythongssapi/httpx-gssapi>`__
+    module.
+
+    >>> import httpx
+    >>> from requests_ecp.aio import AsyncHTTPECPAuth
+    >>> auth = AsyncHTTPECPAuth(idp="https://idp.example.com/SAML2/SOAP/ECP")
+    >>> async with httpx.AsyncClient(auth=auth) as client:
+    ...     await client.get("https://private.example.com/data")
+
+    """
+    requires_request_body = True
+    requires_response_body = True
+
+    def __init__(
+            self,
+            idp,
+            kerberos=False,
+            username=None,
+            password=None,
+            credentials=None,
+    ):
+        #: Address of Identity Provider ECP endpoint.
+        self.idp = idp
+        if kerberos:  # raise an ImportError early
+            _import_kerberos_auth()
+        self.kerberos = kerberos
+        self.username = username
+        self.password = password
+        self.credentials = credentials
+        self._idpauth = None
+        # SP session cookies from the most recent round-trip, by host
+        self._cookies = {}
+        # per-host locks to allow only one ECP round-trip at a time
+        self._lock = threading.Lock()
+        self._login_locks = {}
+        self._async_login_locks = {}
+
+    @staticmethod
+    def _init_auth(
+            idp,
+            kerberos=False,
+            username=None,
+            password=None,
+            credentials=None,
+    ):
+        if kerberos:
+            HTTPSPNEGOAuth = _import_kerberos_auth()
+            return HTTPSPNEGOAuth(opportunistic_auth=True)
+        elif username and password:
+            return httpx.BasicAuth(username, password)
+        return httpx.BasicAuth(*get_credentials(
+            urlparse(idp).hostname,
+            username,
+            providers=credentials,
+        ))
+
+    # -- auth method --------
+
+    def _ecp_flow(self, url, endpoint=None):
+        """Execute an ECP authentication round-trip as an auth flow.
+
+        This is the `httpx` counterpart of
+        :func:`requests_ecp.ecp.authenticate`.
+
+        Returns
+        -------
+        response : `httpx.Response`
+            The final response from the Service Provider that should be
+            a ``302 Found`` redirect back to the original resource URL.
+        """
+        endpoint = endpoint or self.idp
+        if self._idpauth is None:  # init auth now
+            self._idpauth = self._init_auth(
+                self.idp,
+                kerberos=self.kerberos,
+                username=self.username,
+                password=self.password,
+                credentials=self.credentials,
+            )
+
+        # -- step 1: initiate ECP request
+
+        resp1 = yield httpx.Request("GET", url, headers=PAOS_HEADERS)
+        _raise_for_status(resp1)
+        idpbody, relaystate, rcurl = _parse_sp_request(resp1.content)
+
+        # -- step 2: authenticate with endpoint
+
+        resp2 = yield from _delegate(self._idpauth.auth_flow(httpx.Request(
+            "POST",
+            endpoint,
+            content=idpbody,
+            headers=IDP_HEADERS,
+        )))
+        _raise_for_status(resp2)
+        spbody, acsurl = _parse_idp_response(
+            resp2.content,
+            endpoint,
+            relaystate,
+        )
+
+        # validate URLs between SP and IdP
+        if acsurl != rcurl:
+            # don't care about the response, just doing a service
+            yield httpx.Request(
+                "POST",
+                rcurl,
+                content=_soap_fault(),
+                headers=SP_HEADERS,
+            )
+
+        # -- step 3: post back to the SP
+
+        resp3 = yield httpx.Request(
+            "POST",
+            acsurl,
+            content=spbody,
+            headers=SP_HEADERS,
+        )
+        return _raise_for_status(resp3)
+
+    def _login_flow(self, request):
+        """Get a Service Provider session for a request that was
+        redirected for ECP authentication, as an auth flow.
+
+        The cookies from the most recent round-trip for the host are
+        reused, if the request didn't already send them (in which case
+        they were rejected), otherwise a new round-trip is executed.
+
+        Returns
+        -------
+        cookies : `httpx.Cookies`
+            The Service Provider session cookies.
+        """
+        host = request.url.host
+        cookies = self._cookies.get(host)
+        if cookies is not None and not _has_cookies(request, cookies):
+            return cookies
+        final = yield from self._ecp_flow(str(request.url))
+        cookies = httpx.Cookies()
+        # the cookies may be on a redirect that the client followed
+        for response in (*final.history, final):
+            cookies.extract_cookies(response)
+        self._cookies[host] = cookies
+        return cookies
+
+    def _login_lock(self, host):
+        with self._lock:
+            return self._login_locks.setdefault(host, threading.Lock())
+
+    def _async_login_lock(self, host):
+        # created on first use, so that it belongs to the running loop
+        try:
+            return self._async_login_locks[host]
+        except KeyError:
+            lock = self._async_login_locks[host] = asyncio.Lock()
+            return lock
+
+    def auth_flow(self, request):
+        response = yield request
+
+        # if the request was redirected in a way that looks like the SP
+        # is asking for ECP authentication, then handle that here
+        # (only once per request)
+        if not _is_ecp_redirected(response):
+            return
+
+        cookies = yield from self._login_flow(request)
+
+        # replay the original request with the new session cookies
+        _set_cookies(request, cookies)
+        yield request
+
+    def sync_auth_flow(self, request):
+        """Execute the auth flow with `httpx.Client`.
+
+        This is `AsyncHTTPECPAuth.auth_flow`, but allowing only one ECP
+        round-trip per host at a time.
+        """
+        request.read()
+        response = yield request
+        if not _is_ecp_redirected(response):
+            return
+        with self._login_lock(request.url.host):
+            flow = self._login_flow(request)
+            try:
+                next_request = next(flow)
+                while True:
+                    response = yield next_request
+                    response.read()
+                    next_request = flow.send(response)
+            except StopIteration as exc:
+                cookies = exc.value
+        _set_cookies(request, cookies)
+        yield request
+
+    async def async_auth_flow(self, request):
+        """Execute the auth flow with `httpx.AsyncClient`.
+
+        This is `AsyncHTTPECPAuth.auth_flow`, but allowing only one ECP
+        round-trip per host at a time.
+        """
+        await request.aread()
+        response = yield request
+        if not _is_ecp_redirected(response):
+            return
+        async with self._async_login_lock(request.url.host):
+            flow = self._login_flow(request)
+            try:
+                next_request = next(flow)
+                while True:
+                    response = yield next_request
+                    await response.aread()
+                    next_request = flow.send(response)
+            except StopIteration as exc:
+                cookies = exc.value
+        _set_cookies(request, cookies)
+        yield request
+
+
+# -- Session ----------------
+
+class AsyncSession(httpx.AsyncClient):
+    """An `httpx.AsyncClient` with default SAML/ECP authentication.
+
+    This is the asynchronous counterpart of `requests_ecp.Session`:
+
+    >>> from requests_ecp.aio import AsyncSession
+    >>> async with AsyncSession(idp="https://idp.example.com/SAML/SOAP/ECP") as sess:
+    ...     await sess.get("https://private.example.com/data")
+
+    Any keyword arguments other than those documented below are passed
+    to `httpx.AsyncClient`.
+    """  # noqa: E501
+    def __init__(
+            self,
+            idp=None,
+            kerberos=False,
+            username=None,
+            password=None,
+            credentials=None,
+            **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.auth = AsyncHTTPECPAuth(
+            idp,
+            kerberos=kerberos,
+            username=username,
+            password=password,
+            credentials=credentials,
+        )
+
+    async def ecp_authenticate(self, url, endpoint=None):
+        """Manually authenticate against the endpoint.
+
+        This generates a shibboleth session cookie for the domain
+        of the given URL.
+
+        Parameters
+        ----------
+        url : `str`
+            The URL of the resource (on the Service Provider) to request.
+
+        endpoint : `str`
+            The URL of the ECP endpoint on the Identity Provider.
+            If not given it will be taken from the ``auth`` attribute.
+        """
+        if not isinstance(self.auth, AsyncHTTPECPAuth):
+            raise ValueError(
+                f"Cannot execute ECP authentication with {type(self.auth)}",
+            )
+        flow = self.auth._ecp_flow(url, endpoint=endpoint)
+        request = next(flow)
+        while True:
+            response = await self.send(request, auth=None)
+            try:
+                request = flow.send(response)
+            except StopIteration:
+                return
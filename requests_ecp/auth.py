@@ -21,6 +21,11 @@
 
 __author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
 
+import importlib.util
+import os
+import threading
+import time
+from collections import Counter
 from getpass import getpass
 from urllib.parse import (
     parse_qs,
@@ -28,11 +33,47 @@ from urllib.parse import (
     urlunsplit,
 )
 
-from requests import auth as requests_auth
+from requests import (
+    HTTPError,
+    Request,
+    auth as requests_auth,
+)
+from requests.cookies import RequestsCookieJar
+from requests.exceptions import UnrewindableBodyError
+from requests.models import REDIRECT_STATI
+from requests.utils import rewind_body
 
-from .ecp import authenticate as ecp_authenticate
+from .cache import (
+    DEFAULT_LIFETIME,
+    CookieCache,
+    session_expiry,
+)
+from .credentials import (
+    discard_credentials,
+    get_credentials,
+)
+from .ecp import (
+    PAOS_HEADERS,
+    authenticate as ecp_authenticate,
+)
+from .metadata import MetadataIndex
+from .retry import RetryPolicy
 
 GITLAB_AUTH_SHIB_CALLBACK_PATH = "/users/auth/shibboleth/callback"
+GITLAB_SIGN_IN_PATH = "/users/sign_in"
+GITLAB_SESSION_COOKIE = "_gitlab_session"
+
+#: Maximum size (bytes) of the body of an intercepted response that will
+#: be read so that its connection can be reused; the connection of a
+#: response with a larger body is closed instead.
+DRAIN_LIMIT = 64 * 1024
+
+#: Methods of requests for which the redirect at the end of an ECP
+#: round-trip can be followed, all others are replayed in full.
+REDIRECT_SAFE_METHODS = ("GET", "HEAD")
+
+#: Media type of a PAOS message from a Service Provider.
+PAOS_MEDIA_TYPE = "application/vnd.paos+xml"
 
 
 # -- Auth utilities ---------
@@ -48,8 +89,138 @@ def _prompt_username_password(host, username=None):
     return username, password
 
 
+def _drain(response, limit=DRAIN_LIMIT):
+    """Discard the body of a response and release its connection.
+
+    At most ``limit`` bytes of the body are read (without decoding),
+    if the body is any larger the connection is closed instead,
+    so that memory use doesn't depend on the size of the response.
+    """
+    raw = response.raw
+    if response._content_consumed or raw is None:
+        return
+    try:
+        length = int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        length = None
+    if length is None or length <= limit:
+        remaining = limit
+        while remaining >= 0:
+            chunk = raw.read(min(remaining + 1, 8192), decode_content=False)
+            if not chunk:  # end of body, so the connection can be reused
+                raw.release_conn()
+                return
+            remaining -= len(chunk)
+    # too big to be worth reading
+    response.close()
+
+
+def _set_request_cookies(request, cookies, overwrite=True):
+    """Add some cookies to a `requests.PreparedRequest`.
+
+    If ``overwrite=False`` only cookies whose names aren't already
+    present in the request will be added.
+
+    Returns
+    -------
+    added : `bool`
+        `True` if any cookies were added, otherwise `False`.
+    """
+    jar = request._cookies
+    if jar is None:
+        jar = RequestsCookieJar()
+    if not overwrite:
+        names = {cookie.name for cookie in jar}
+        cookies = [cookie for cookie in cookies if cookie.name not in names]
+    if not cookies:
+        return False
+    for cookie in cookies:
+        jar.set_cookie(cookie)
+    request.headers.pop("Cookie", None)
+    request.prepare_cookies(jar)
+    return True
+
+
+def _has_cookies(request, cookies):
+    """Return `True` if a request already carries all of the given cookies.
+    """
+    sent = {(c.name, c.value) for c in request._cookies or ()}
+    return all((c.name, c.value) in sent for c in cookies)
+
+
+def _path_prefix(path):
+    """Return the first segment of a URL path, e.g. ``/data`` for
+    ``/data/file.txt``.
+    """
+    return "/" + path.lstrip("/").split("/", 1)[0]
+
+
+def _paos_key(url):
+    """Return the ``(host, path prefix)`` key for a URL or host name.
+
+    A URL without a path (or a bare host name) matches all paths on
+    the host.
+    """
+    if "://" not in url:
+        url = "https://" + url
+    parts = urlparse(url)
+    return parts.hostname, _path_prefix(parts.path)
+
+
+def _add_paos_headers(request):
+    """Add the headers to request ECP authentication to a request.
+
+    The PAOS media type is appended to the existing ``Accept`` header,
+    so that content negotiation for the resource isn't changed.
+    """
+    accept = request.headers.get("Accept")
+    if not accept:
+        request.headers["Accept"] = PAOS_MEDIA_TYPE
+    elif PAOS_MEDIA_TYPE not in accept:
+        request.headers["Accept"] = f"{accept}, {PAOS_MEDIA_TYPE}"
+    request.headers["PAOS"] = PAOS_HEADERS["PAOS"]
+
+
+def _remove_paos_headers(request):
+    """Undo :func:`_add_paos_headers`.
+    """
+    request.headers.pop("PAOS", None)
+    accept = request.headers.get("Accept", "")
+    suffix = f", {PAOS_MEDIA_TYPE}"
+    if accept == PAOS_MEDIA_TYPE:
+        del request.headers["Accept"]
+    elif accept.endswith(suffix):
+        request.headers["Accept"] = accept[:-len(suffix)]
+
+
 # -- Response interception --
 
+def is_paos_response(response):
+    """Return `True` if a response is a PAOS request for ECP authentication.
+
+    A Service Provider responds this way (rather than with a redirect)
+    to a request that was sent with the PAOS headers.
+
+    Parameters
+    ----------
+    response : `requests.Response`
+        The response object to inspect.
+
+    Returns
+    -------
+    ispaos : `bool`
+        `True` if ``response`` carries an ECP ``<AuthnRequest>``.
+    """
+    return (
+        response.status_code == 200
+        and response.headers.get(
+            "Content-Type",
+            "",
+        ).split(";", 1)[0].strip() == PAOS_MEDIA_TYPE
+        and "PAOS" in response.request.headers
+    )
+
+
 def is_ecp_auth_redirect(response):
     """Return `True` if a response indicates a request for ECP authentication.
 
@@ -68,9 +239,13 @@ def is_ecp_auth_redirect(response):
         return False
 
     # strip out the redirect location and parse it
-    target = response.headers['location']
-    query = parse_qs(urlparse(target).query)
+    return _is_ecp_auth_location(response.headers['location'])
+
 
+def _is_ecp_auth_location(target):
+    """Return `True` if a redirect target looks like it was set by Shibboleth.
+    """
+    query = parse_qs(urlparse(target).query)
     return (
         # Identity Provider
         "SAMLRequest" in query
@@ -105,20 +280,55 @@ def is_gitlab_auth_redirect(response):
     uparts = urlparse(response.headers['location'])
 
     # if not redirecting to login, this isn't meant for us
-    if not uparts.path == "/users/sign_in":
+    if not uparts.path == GITLAB_SIGN_IN_PATH:
         return False
 
     # only redirect if there is a _gitlab_session cookie to use later
     for cookie in response.cookies:
         if (
-            cookie.name == "_gitlab_session"
+            cookie.name == GITLAB_SESSION_COOKIE
             and cookie.domain == uparts.hostname
         ):
             return True
 
 
+def _is_gitlab_sign_in(response):
+    """Return `True` if a response from GitLab asks the user to sign in.
+    """
+    if response.status_code == 401:
+        return True
+    return response.is_redirect and urlparse(
+        response.headers["location"],
+    ).path == GITLAB_SIGN_IN_PATH
+
+
 # -- Auth -------------------
 
+#: Modules that provide a Kerberos auth plugin, in order of preference.
+KERBEROS_AUTH_MODULES = (
+    "requests_gssapi",
+    # debian doesn't have requests-gssapi
+    "requests_kerberos",
+)
+
+
+def _find_kerberos_auth():
+    """Check that a Kerberos auth plugin is available, without importing it.
+
+    Importing the plugin loads the GSSAPI C bindings, which is deferred
+    until Kerberos auth is actually needed.
+    """
+    for name in KERBEROS_AUTH_MODULES:
+        if importlib.util.find_spec(name) is not None:
+            return
+    # no kerberos interface, display a useful error message
+    raise ModuleNotFoundError(
+        f"No module named {KERBEROS_AUTH_MODULES[0]!r}; you must install "
+        "requests-gssapi to use Kerberos auth",
+        name=KERBEROS_AUTH_MODULES[0],
+    )
+
+
 def _import_kerberos_auth():
     try:
         from requests_gssapi import HTTPKerberosAuth
@@ -135,17 +345,154 @@ def _import_kerberos_auth():
     return HTTPKerberosAuth
 
 
-def _kerberos_auth(url):
-    """Intialise a `requests_gssapi.HTTPKerberosAuth`.
+#: Time (seconds) for which to cache Kerberos credentials if their
+#: lifetime can't be determined.
+KERBEROS_DEFAULT_LIFETIME = 300
+
+
+def _kerberos_credentials():
+    """Acquire the default Kerberos initiator credentials.
+
+    Returns
+    -------
+    creds : `gssapi.Credentials`, `None`
+        The credentials, or `None` if they couldn't be acquired.
+
+    lifetime : `int`, `None`
+        The remaining lifetime (seconds) of the credentials, if known.
+    """
+    try:
+        import gssapi
+    except ImportError:
+        return None, None
+    try:
+        creds = gssapi.Credentials(usage="initiate")
+        return creds, creds.lifetime
+    except gssapi.exceptions.GSSError:  # no credentials
+        return None, None
+
+
+def _new_kerberos_auth(hostname, creds=None):
+    """Create a new `requests_gssapi.HTTPKerberosAuth` for an IdP host.
+
+    Parameters
+    ----------
+    hostname : `str`
+        The host name of the Identity Provider.
+
+    creds : `gssapi.Credentials`, optional
+        The Kerberos credentials to use.
+
+    Returns
+    -------
+    auth : `requests_gssapi.HTTPKerberosAuth`
+        The new auth plugin.
     """
     HTTPKerberosAuth = _import_kerberos_auth()
-    loginhost = urlparse(url).hostname
+    kwargs = {}
+    # only requests-gssapi accepts pre-acquired credentials
+    if creds is not None and HTTPKerberosAuth.__module__.startswith(
+        "requests_gssapi",
+    ):
+        kwargs["creds"] = creds
     return HTTPKerberosAuth(
         force_preemptive=True,
-        hostname_override=loginhost,
+        hostname_override=hostname,
+        **kwargs,
     )
 
 
+class KerberosAuthCache:
+    """Process-wide cache of the Kerberos credentials used to create
+    auth plugins for Identity Providers.
+
+    The user's Kerberos credentials are acquired once, and reused by
+    all `HTTPECPAuth` objects until they expire, so that the credential
+    cache is only read once.
+
+    A plugin holds the security context of the requests it is
+    authenticating, so it can't be shared between threads; a new
+    (cheap) plugin is created from the cached credentials for each
+    ECP round-trip.
+
+    The `hits` and `misses` attributes count the number of lookups
+    that did, and did not, find valid cached credentials.
+    """
+    def __init__(self):
+        self._creds = (None, 0)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, now=None):
+        """Return a new Kerberos auth plugin for an Identity Provider.
+
+        Parameters
+        ----------
+        url : `str`
+            The URL of the Identity Provider.
+
+        now : `float`
+            The current UNIX time, defaults to :func:`time.time`.
+
+        Returns
+        -------
+        auth : `requests_gssapi.HTTPKerberosAuth`
+            The auth plugin to use for one round-trip with the IdP.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            creds, expiry = self._creds
+            if expiry > now:
+                self.hits += 1
+            else:
+                self.misses += 1
+                creds, lifetime = _kerberos_credentials()
+                self._creds = (
+                    creds,
+                    now + (lifetime or KERBEROS_DEFAULT_LIFETIME),
+                )
+        return _new_kerberos_auth(urlparse(url).hostname, creds)
+
+    def clear(self):
+        """Forget the cached credentials, and reset the counters.
+        """
+        with self._lock:
+            self._creds = (None, 0)
+            self.hits = self.misses = 0
+
+
+#: The process-wide cache of Kerberos credentials.
+KERBEROS_AUTH_CACHE = KerberosAuthCache()
+
+
+def _kerberos_auth(url):
+    """Return a new `requests_gssapi.HTTPKerberosAuth` for an IdP.
+    """
+    return KERBEROS_AUTH_CACHE.get(url)
+
+
+class _ResponseHook:
+    """The response hook registered by `HTTPECPAuth` for one request.
+
+    The hook holds the authentication state of the request; `requests`
+    shares the hooks of a request with the copies it sends to follow
+    redirects, so the state covers the whole redirect chain.
+    """
+    __slots__ = ("auth", "num_ecp_auth", "paos")
+
+    def __init__(self, auth, paos=False):
+        self.auth = auth
+        # number of times authentication was handled for this request
+        self.num_ecp_auth = 0
+        # whether the request was sent with PAOS headers
+        self.paos = paos
+
+    def __call__(self, response, **kwargs):
+        return self.auth._handle_response(response, self, **kwargs)
+
+
 class HTTPECPAuth(requests_auth.AuthBase):
     """SAML2/ECP authorisation plugin for :mod:`requests`.
 
@@ -158,12 +505,78 @@ class HTTPECPAuth(requests_auth.AuthBase):
     `requests GSSAPI <https://github.com/pythongssapi/requests-gssapi>`__
     module.
 
+    If ``username`` and ``password`` aren't both given, credentials
+    are resolved (once per process) by
+    :func:`requests_ecp.credentials.get_credentials` using the
+    ``credentials`` providers, by default the environment, ``~/.netrc``,
+    and (only if running interactively) a console prompt; the system
+    keyring can be used by including
+    `~requests_ecp.credentials.KeyringCredentials`.
+
     >>> from requests import Session
     >>> from requests_ecp import HTTPECPAuth
     >>> with Session() as sess:
     ...     sess.auth = HTTPECPAuth(idp="https://idp.example.com/SAML2/SOAP/ECP")
     ...     sess.get("https://private.example.com/data")
 
+    Service Provider session cookies can be shared between processes
+    (and reused by later processes) by passing ``cookie_cache``, either
+    as a `~requests_ecp.CookieCache`, the path of a cache file, or `True`
+    to use the default cache location.
+    Cached cookies are attached to outgoing requests, and are used to
+    replay a request that is redirected for ECP authentication before
+    falling back to a full ECP round-trip.
+
+    The URL and expected expiry time of each Service Provider session
+    established by this object are recorded in the
+    `~HTTPECPAuth.sessions` attribute, using ``session_lifetime`` as
+    the lifetime of sessions whose cookies don't declare an expiry.
+
+    A single `HTTPECPAuth` object can be shared between threads; if many
+    requests to the same Service Provider are redirected at once, only one
+    thread executes the ECP round-trip, and the others replay their
+    requests with the new session cookies once it has completed.
+
+    Cookies for the Identity Provider's own session are kept in the
+    `~HTTPECPAuth.idp_cookies` jar and are used to authenticate
+    subsequent round-trips (for any Service Provider) without sending
+    the user's credentials, which are only used if the IdP rejects the
+    session; pass ``idp_session=False`` to always send credentials.
+    If the IdP never accepts its cookies alone (i.e. it sets cookies,
+    but doesn't support sessions for ECP), that is remembered and
+    only credentials are sent from then on.
+
+    Transient failures of the request to the IdP (e.g. ``503 Service
+    Unavailable``) can be retried by passing ``retry``, either as the
+    number of retries, or a `~requests_ecp.retry.RetryPolicy` (which can
+    also include a circuit breaker to fail fast while the IdP is down).
+
+    Pass ``trace`` to receive a `~requests_ecp.ecp.ECPTraceEvent` for
+    each HTTP request made during an ECP round-trip (e.g. to diagnose a
+    slow login); the `~HTTPECPAuth.counters` attribute counts the redirects
+    intercepted and the ECP round-trips attempted and failed.
+
+    Once a Service Provider has redirected a request for ECP
+    authentication, later ``GET`` requests to the same host and top-level
+    path (e.g. ``/data``) are sent with the PAOS headers whenever there
+    is no current session for that host, so that the SP responds with
+    the ECP ``<AuthnRequest>`` straight away, saving one request per
+    login; ``paos_hosts`` can list hosts (or URL prefixes) to treat this
+    way from the start, or be `False` to never send PAOS headers
+    unprompted.
+
+    If ``metadata`` is given, as a `~requests_ecp.metadata.MetadataIndex`,
+    the path of an index file, or `True` to use the default index, then
+    ``idp`` can also be given as the entityID, host name, or scope of the
+    Identity Provider, and is resolved to its ECP endpoint using the index;
+    a URL that isn't an indexed entityID is used as the endpoint as is.
+
+    For the GitLab hosts named in ``gitlab_hosts``, a ``401 Unauthorized``
+    response or a redirect to the GitLab sign-in page is handled by
+    logging in directly at GitLab's Shibboleth callback and replaying the
+    request with the new ``_gitlab_session`` cookie, which is then sent
+    with all later requests to that host (until GitLab rejects it).
+
     """   # noqa: E501
     def __init__(
             self,
@@ -171,37 +584,132 @@ class HTTPECPAuth(requests_auth.AuthBase):
             kerberos=False,
             username=None,
             password=None,
+            cookie_cache=None,
+            session_lifetime=DEFAULT_LIFETIME,
+            credentials=None,
+            idp_session=True,
+            retry=None,
+            trace=None,
+            paos_hosts=None,
+            metadata=None,
+            gitlab_hosts=None,
     ):
         #: Address of Identity Provider ECP endpoint.
+        if metadata is not None:
+            idp = self._resolve_idp(idp, metadata)
         self.idp = idp
 
         #: Authentication object to attach to requests made directly
         #: to the IdP.
         if kerberos:  # raise an ImportError early
-            _import_kerberos_auth()
+            _find_kerberos_auth()
         self.kerberos = kerberos
         self.username = username
         self.password = password
+        #: Providers of credentials to use if ``username`` and ``password``
+        #: aren't both given.
+        self.credentials = credentials
         self._idpauth = None
 
-        #: counter for authentication attemps for a single request
+        #: Identity Provider session cookies, reused between round-trips,
+        #: or `None` to disable reuse.
+        self.idp_cookies = RequestsCookieJar() if idp_session else None
+        # whether the IdP has accepted its session cookies alone (`True`),
+        # only rejected them (`False`), or hasn't been asked (`None`)
+        self._idp_session = None
+
+        #: Persistent cache of Service Provider session cookies.
+        if cookie_cache is True:
+            cookie_cache = CookieCache()
+        elif isinstance(cookie_cache, (str, os.PathLike)):
+            cookie_cache = CookieCache(cookie_cache)
+        self.cookie_cache = cookie_cache
+
+        #: Record of Service Provider sessions, keyed by host name,
+        #: each value is a ``(url, expiry)`` tuple.
+        self.sessions = {}
+        self.session_lifetime = session_lifetime
+
+        # most recent SP session cookies, keyed by host name, used to
+        # replay requests that were redirected while another thread
+        # executed the ECP round-trip
+        self._cookies = {}
+        self._login_locks = {}
+        self._lock = threading.Lock()
+
+        # total number of requests for which authentication was handled
         self._num_ecp_auth = 0
 
+        #: Connection adapter to use for ECP requests to the IdP,
+        #: if `None` the adapter of the intercepted response is used.
+        self.idp_adapter = None
+
+        #: Policy for retrying failed requests to the IdP.
+        if isinstance(retry, int):
+            retry = RetryPolicy(retries=retry)
+        self.retry = retry
+
+        #: Function to call with a `requests_ecp.ecp.ECPTraceEvent`
+        #: for each HTTP request made during an ECP round-trip.
+        self.trace = trace
+
+        #: Counts of ECP ``redirects`` and direct ``paos`` requests
+        #: intercepted, and ECP round-trip ``attempts`` and ``failures``.
+        self.counters = Counter()
+
+        # (host, path prefix) pairs for which to send PAOS headers on
+        # first contact, or `None` to never do that
+        if paos_hosts is False:
+            self._paos = None
+        else:
+            self._paos = set(map(_paos_key, paos_hosts or ()))
+
+        #: Host names of GitLab instances to log in to directly.
+        self.gitlab_hosts = frozenset(gitlab_hosts or ())
+        # GitLab session cookies, keyed by host name
+        self._gitlab_sessions = {}
+
     @staticmethod
-    def _init_auth(idp, kerberos=False, username=None, password=None):
+    def _init_auth(
+            idp,
+            kerberos=False,
+            username=None,
+            password=None,
+            credentials=None,
+    ):
         if kerberos:
             return _kerberos_auth(
                 kerberos if isinstance(kerberos, str) else idp,
             )
         elif username and password:
             return requests_auth.HTTPBasicAuth(username, password)
-        return requests_auth.HTTPBasicAuth(*_prompt_username_password(
+        return requests_auth.HTTPBasicAuth(*get_credentials(
             urlparse(idp).hostname,
             username,
+            providers=credentials,
         ))
 
+    @staticmethod
+    def _resolve_idp(idp, metadata):
+        """Resolve the ECP endpoint of an IdP using a metadata index.
+        """
+        if metadata is True:
+            metadata = MetadataIndex()
+        elif not isinstance(metadata, MetadataIndex):
+            metadata = MetadataIndex(metadata)
+        if "://" not in idp:
+            return metadata.resolve(idp)
+        # a URL may be an entityID, otherwise it is the endpoint
+        try:
+            return metadata.lookup(idp) or idp
+        except FileNotFoundError:
+            return idp
+
     def reset(self):
-        self._num_ecp_auth = 0
+        """Reset the count of requests for which authentication was handled.
+        """
+        with self._lock:
+            self._num_ecp_auth = 0
 
     # -- auth method --------
 
@@ -215,29 +723,77 @@ class HTTPECPAuth(requests_auth.AuthBase):
         """Execute ECP authenticate for a `requests.Session`.
         """
         url = url or endpoint or self.idp
-        self._authenticate(session, url=url)
+        responses = self._authenticate(session, url=url)
+        self._record_session(url, responses)
 
-    def _authenticate_response(self, response, endpoint=None, **kwargs):
+    def _authenticate_response(
+            self,
+            response,
+            endpoint=None,
+            paos=False,
+            **kwargs,
+    ):
         """Execute ECP authenticate based on a `requests.Response`.
 
+        The ECP requests are sent using the same connection adapter (and
+        so the same connection pool) as the original request, with the
+        same TLS and proxy settings, and the same cookies.
+        If ``paos=True`` then ``response`` is itself the PAOS request
+        from the SP (see `is_paos_response`), and the round-trip starts
+        from that, rather than requesting it again.
+
         Returns
         -------
         response : `requests.Response`
             The final response from the service provider that should be
             a `302 Found` redirect back to the original resource URL.
         """
-        response.raw.read()
-        response.raw.release_conn()
+        if paos:
+            kwargs["sp_response"] = response
+        else:
+            _drain(response)
+
+        # send the cookies from the original request (and any set by the
+        # redirect) with the ECP requests, e.g. for load-balancer affinity
+        cookies = RequestsCookieJar()
+        if response.request._cookies is not None:
+            cookies.update(response.request._cookies)
+        cookies.update(response.cookies)
+
         new = list(self._authenticate(
             response.connection,
             endpoint=endpoint,
             url=response.url,
+            cookies=cookies,
+            idp_connection=self.idp_adapter,
             **kwargs,
         ))
+        self._record_session(response.url, new)
+        if paos:  # don't record the original response twice
+            new.pop(0)
         r = new.pop(-1)
         r.history.extend([response] + new)
         return r
 
+    def _get_idpauth(self):
+        """Return the auth plugin for the IdP, creating it on first use.
+
+        Kerberos plugins hold the state of the requests they authenticate,
+        so a new one is returned for each round-trip.
+        """
+        if self.kerberos:
+            return self._init_auth(self.idp, kerberos=self.kerberos)
+        with self._lock:
+            if self._idpauth is None:  # init auth now
+                self._idpauth = self._init_auth(
+                    self.idp,
+                    kerberos=self.kerberos,
+                    username=self.username,
+                    password=self.password,
+                    credentials=self.credentials,
+                )
+            return self._idpauth
+
     def _authenticate(
             self,
             connection,
@@ -247,36 +803,411 @@ class HTTPECPAuth(requests_auth.AuthBase):
     ):
         """Handle user authentication with ECP.
         """
-        if self._idpauth is None:  # init auth now
-            self._idpauth = self._init_auth(
-                self.idp,
-                kerberos=self.kerberos,
-                username=self.username,
-                password=self.password,
+        idpauth = self._get_idpauth()
+        endpoint = endpoint or self.idp
+        idp_cookies = self.idp_cookies
+        if self._idp_session is False:  # the IdP doesn't do sessions
+            idp_cookies = None
+        tried_session = bool(idp_cookies)
+        self._count("attempts")
+        try:
+            responses = ecp_authenticate(
+                connection,
+                idpauth,
+                endpoint,
+                url=url,
+                idp_cookies=idp_cookies,
+                retry=self.retry,
+                trace=self.trace,
+                **kwargs,
+            )
+        except HTTPError as exc:
+            self._count("failures")
+            response = exc.response
+            if (
+                response is not None
+                and response.status_code == 401
+                and urlparse(response.url).hostname
+                == urlparse(endpoint).hostname
+            ):
+                self._discard_idpauth(idpauth)
+            raise
+        except Exception:
+            self._count("failures")
+            raise
+        if tried_session:
+            self._record_idp_session(responses[1])
+        return responses
+
+    def _record_idp_session(self, response):
+        """Record whether the IdP accepted its session cookies alone.
+
+        ``response`` is the response from the IdP for a round-trip that
+        tried the IdP session first; if that was rejected the request
+        that got ``response`` carried credentials.
+        """
+        accepted = "Authorization" not in response.request.headers
+        if accepted:
+            self._idp_session = True
+        elif self._idp_session is None:
+            # never accepted, don't try again
+            self._idp_session = False
+            self.idp_cookies.clear()
+
+    def _discard_idpauth(self, idpauth):
+        """Forget IdP credentials that the IdP rejected.
+
+        Credentials found by
+        :func:`~requests_ecp.credentials.get_credentials` are discarded
+        from its cache, so that the next attempt asks the providers again.
+        """
+        with self._lock:
+            if self._idpauth is not idpauth:  # already discarded
+                return
+            if self.kerberos or (self.username and self.password):
+                return
+            discard_credentials(
+                urlparse(self.idp).hostname,
+                self.username,
+                providers=self.credentials,
             )
+            self._idpauth = None
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    # -- session tracking ---
+
+    def _record_session(self, url, responses):
+        """Record the Service Provider session from an ECP round-trip.
+
+        The expiry time of the session is recorded in
+        `~HTTPECPAuth.sessions` and the cookies are stored in the
+        `~HTTPECPAuth.cookie_cache` (if configured).
+        """
+        idphost = urlparse(self.idp).hostname
+        cookies = [
+            cookie for r in responses
+            if urlparse(r.url or url).hostname != idphost
+            for cookie in r.cookies
+        ]
+        host = urlparse(url).hostname
+        self.sessions[host] = (
+            url,
+            session_expiry(cookies, lifetime=self.session_lifetime),
+        )
+        jar = RequestsCookieJar()
+        for cookie in cookies:
+            jar.set_cookie(cookie)
+        self._cookies[host] = jar
+        if self.cookie_cache is not None:
+            self.cookie_cache.store(url, self.idp, cookies)
+
+    # -- replay -------------
+
+    def _replay_response(self, response, cookies, **kwargs):
+        """Replay the request for a response with some extra cookies.
+
+        Returns
+        -------
+        response : `requests.Response`
+            The response to the replayed request, with the original
+            response recorded in its history.
+        """
+        _drain(response)
+        new = self._replay_request(
+            response.connection,
+            response.request,
+            cookies,
+            **kwargs,
+        )
+        new.history.insert(0, response)
+        return new
+
+    @staticmethod
+    def _replay_request(connection, request, cookies, **kwargs):
+        """Send a copy of a request with some extra cookies.
+
+        The same method, headers, and body are used; a streamed body
+        is rewound to its original position first.
+
+        Raises
+        ------
+        requests.exceptions.UnrewindableBodyError
+            If the body of the request is a stream that can't be rewound,
+            e.g. a generator, which has already been consumed by the
+            original request.
+        """
+        request = request.copy()
+        if request._body_position is not None:
+            rewind_body(request)
+        elif not isinstance(request.body, (bytes, str, type(None))):
+            raise UnrewindableBodyError(
+                "unable to replay request body after ECP authentication",
+            )
+        _set_request_cookies(request, cookies)
+        return connection.send(request, **kwargs)
+
+    def _unused_cookies(self, request):
+        """Return the known SP session cookies that a request didn't send.
 
-        # authenticate
-        return ecp_authenticate(
+        Cookies are taken from the most recent ECP round-trip executed by
+        this object, or from the `~HTTPECPAuth.cookie_cache`.
+        Cached cookies that the request did send (and so were rejected
+        by the Service Provider) are discarded from the cache, before
+        asking the cache once more for a session stored by another process.
+        If the cache can log in (e.g. a
+        `~requests_ecp.broker.BrokerClient`) it is then asked to,
+        this is the only place that such a cache is asked to log in.
+
+        Returns
+        -------
+        cookies : `requests.cookies.RequestsCookieJar`, `None`
+            The cookies to replay the request with, or `None`.
+        """
+        url = request.url
+        cookies = self._cookies.get(urlparse(url).hostname)
+        if cookies is not None and not _has_cookies(request, cookies):
+            return cookies
+        if self.cookie_cache is None:
+            return None
+        cookies = self.cookie_cache.get(url, self.idp)
+        if cookies is not None:
+            if not _has_cookies(request, cookies):
+                return cookies
+            # the SP rejected the cached cookies, so forget them, and
+            # check for a new session stored by another process
+            self.cookie_cache.discard(url, self.idp)
+            cookies = self.cookie_cache.get(url, self.idp)
+            if cookies is not None and not _has_cookies(request, cookies):
+                return cookies
+        # a shared cache (e.g. a session broker) may be able to log in
+        login = getattr(self.cookie_cache, "login", None)
+        if login is None:
+            return None
+        cookies = login(url, self.idp)
+        if cookies is not None and not _has_cookies(request, cookies):
+            return cookies
+        return None
+
+    def _expects_login(self, url):
+        """Return `True` if a request for ``url`` is expected to need
+        ECP authentication.
+
+        That is if the host (and path prefix) is known to be protected by
+        ECP, and there is no current session for the host.
+        """
+        parts = urlparse(url)
+        host = parts.hostname
+        if (
+            (host, "/") not in self._paos
+            and (host, _path_prefix(parts.path)) not in self._paos
+        ):
+            return False
+        session = self.sessions.get(host)
+        return session is None or session[1] <= time.time()
+
+    def _login_lock(self, host):
+        """Return the lock that serialises ECP logins to a Service Provider.
+        """
+        with self._lock:
+            return self._login_locks.setdefault(host, threading.Lock())
+
+    def _handle_ecp_redirect(self, response, paos=False, **kwargs):
+        """Handle an ECP redirect from a Service Provider.
+
+        Only one thread at a time may execute an ECP round-trip for a
+        given Service Provider; other threads that receive an ECP redirect
+        at the same time wait for that round-trip to complete and then
+        replay their original request with the new session cookies.
+
+        For ``GET`` and ``HEAD`` requests the final response of the ECP
+        round-trip (a redirect back to the original URL) is returned for
+        `requests` to follow; other requests are replayed (with the same
+        method, headers, and body) once the round-trip is complete.
+
+        Pass ``paos=True`` if ``response`` is a PAOS request from the SP,
+        rather than a redirect.
+
+        Returns
+        -------
+        response : `requests.Response`
+            Either the final response from the ECP round-trip, or the
+            response to the replayed original request.
+        """
+        request = response.request
+        host = urlparse(request.url).hostname
+        with self._login_lock(host):
+            cookies = self._unused_cookies(request)
+            if cookies is None:
+                final = self._authenticate_response(
+                    response,
+                    paos=paos,
+                    **kwargs,
+                )
+                if request.method in REDIRECT_SAFE_METHODS:
+                    # let requests follow the redirect from the SP
+                    return final
+                # following the redirect would lose the method and body
+                # of the original request, so replay that instead
+                _drain(final)
+                new = self._replay_request(
+                    response.connection,
+                    request,
+                    self._cookies[host],
+                    **kwargs,
+                )
+                new.history[:0] = final.history + [final]
+                return new
+        new = self._replay_response(response, cookies, **kwargs)
+        if is_ecp_auth_redirect(new):
+            # those cookies didn't work either, try again
+            return self._handle_ecp_redirect(new, **kwargs)
+        return new
+
+    # -- GitLab -------------
+
+    def _gitlab_login(self, response, **kwargs):
+        """Log in to GitLab directly at its Shibboleth callback.
+
+        Returns
+        -------
+        cookies : `requests.cookies.RequestsCookieJar`
+            The new GitLab session cookies.
+
+        Raises
+        ------
+        RuntimeError
+            If GitLab doesn't start a session.
+        """
+        parts = urlparse(response.request.url)
+        url = urlunsplit((
+            parts.scheme,
+            parts.netloc,
+            GITLAB_AUTH_SHIB_CALLBACK_PATH,
+            "",
+            "",
+        ))
+        connection = response.connection
+
+        # the callback is protected by the Shibboleth SP, so
+        # authenticate against that
+        jar = RequestsCookieJar()
+        new = list(self._authenticate(
             connection,
-            self._idpauth,
-            endpoint or self.idp,
             url=url,
+            cookies=jar,
+            idp_connection=self.idp_adapter,
+            **kwargs,
+        ))
+        self._record_session(url, new)
+        _drain(new[-1])
+
+        # then visit the callback with the SP session to sign in to GitLab
+        callback = connection.send(
+            Request("GET", url, cookies=jar).prepare(),
             **kwargs,
         )
+        _drain(callback)
+        cookies = RequestsCookieJar()
+        for cookie in callback.cookies:
+            if cookie.name == GITLAB_SESSION_COOKIE:
+                cookies.set_cookie(cookie)
+        if not cookies:
+            raise RuntimeError(f"failed to sign in to GitLab at {url}")
+        self._gitlab_sessions[parts.hostname] = cookies
+        return cookies
+
+    def _handle_gitlab_sign_in(self, response, **kwargs):
+        """Handle a request from GitLab to sign in.
+
+        As for ECP redirects, only one thread at a time may sign in to a
+        given GitLab host, others wait and replay their requests with the
+        new session cookies.
+
+        Returns
+        -------
+        response : `requests.Response`
+            The response to the replayed original request.
+        """
+        request = response.request
+        host = urlparse(request.url).hostname
+        with self._login_lock(host):
+            cookies = self._gitlab_sessions.get(host)
+            if cookies is None or _has_cookies(request, cookies):
+                # no session, or GitLab rejected it
+                cookies = self._gitlab_login(response, **kwargs)
+        return self._replay_response(response, cookies, **kwargs)
 
     # -- event handling -----
 
     def handle_response(self, response, **kwargs):
         """Handle ECP authentication based on a transation response
+
+        Each call is treated as a new request; the hooks registered by
+        :meth:`HTTPECPAuth.__call__` also remember what was done for
+        each request, so that it is only authenticated once.
+        """
+        hook = _ResponseHook(self, paos=self._paos is not None)
+        return self._handle_response(response, hook, **kwargs)
+
+    def _handled(self, hook):
+        """Record that authentication was handled for a request.
+        """
+        hook.num_ecp_auth += 1
+        with self._lock:
+            self._num_ecp_auth += 1
+
+    def _handle_response(self, response, hook, **kwargs):
+        """Handle a response for the request that registered ``hook``.
         """
+        # fast path: only a redirect (or the response to a request sent
+        # with PAOS headers) can be a request for authentication,
+        # so don't spend any time inspecting anything else
+        if response.status_code not in REDIRECT_STATI:
+            if (
+                hook.paos
+                and not hook.num_ecp_auth
+                and is_paos_response(response)
+            ):
+                self._count("paos")
+                # the request is no longer one for ECP authentication,
+                # e.g. when requests follows the redirect at the end
+                _remove_paos_headers(response.request)
+                response = self._handle_ecp_redirect(
+                    response,
+                    paos=True,
+                    **kwargs,
+                )
+                self._handled(hook)
+            elif (
+                response.status_code == 401
+                and self.gitlab_hosts
+                and not hook.num_ecp_auth
+                and urlparse(response.url).hostname in self.gitlab_hosts
+            ):
+                response = self._handle_gitlab_sign_in(response, **kwargs)
+                self._handled(hook)
+            return response
+
         # if we've already tried, don't try again,
         # otherwise we end up in an infinite loop
-        if self._num_ecp_auth:
+        if hook.num_ecp_auth:
             return response
 
+        # sign in to a known gitlab host directly
+        if (
+            self.gitlab_hosts
+            and urlparse(response.url).hostname in self.gitlab_hosts
+            and _is_gitlab_sign_in(response)
+        ):
+            response = self._handle_gitlab_sign_in(response, **kwargs)
+            self._handled(hook)
+
         # if the redirect looks like gitlab trying to go through ECP auth,
         # redirect to the shibboleth callback for gitlab
-        if is_gitlab_auth_redirect(response):
+        elif is_gitlab_auth_redirect(response):
             # redirect the redirect to the shibboleth callback URL
             parts = urlparse(response.headers['location'])
             response.headers['location'] = urlunsplit((
@@ -291,21 +1222,75 @@ class HTTPECPAuth(requests_auth.AuthBase):
         # is asking for ECP authentication, then handle that here:
         # (but only do that once)
         elif is_ecp_auth_redirect(response):
-            # authenticate and return the final redirect
-            response = self._authenticate_response(response, **kwargs)
-            self._num_ecp_auth += 1
+            self._count("redirects")
+            if self._paos is not None:
+                self._paos.add(_paos_key(response.request.url))
+            # try again using known cookies, or authenticate
+            # and return the final redirect
+            response = self._handle_ecp_redirect(response, **kwargs)
+            self._handled(hook)
 
         return response
 
+    def _is_own_hook(self, hook):
+        return isinstance(hook, _ResponseHook) and hook.auth is self
+
     def deregister(self, response):
         """Deregister the response handler
         """
-        response.request.deregister_hook('response', self.handle_response)
-        self.reset()
+        hooks = response.request.hooks['response']
+        hooks[:] = [hook for hook in hooks if not self._is_own_hook(hook)]
+
+    def _add_cookies(self, request):
+        """Attach the known GitLab and cached SP session cookies to a
+        request, without overwriting any cookies it already has.
+
+        Returns
+        -------
+        cookies : `requests.cookies.RequestsCookieJar`, `None`
+            The cookies from the `~HTTPECPAuth.cookie_cache`, if any.
+        """
+        if self.gitlab_hosts:
+            gitlab = self._gitlab_sessions.get(urlparse(request.url).hostname)
+            if gitlab is not None:
+                _set_request_cookies(request, gitlab, overwrite=False)
+        if self.cookie_cache is None:
+            return None
+        cookies = self.cookie_cache.get(request.url, self.idp)
+        if cookies is not None:
+            _set_request_cookies(request, cookies, overwrite=False)
+        return cookies
 
     def __call__(self, request):
         """Register the response handler
+
+        Each request gets its own handler, holding the authentication
+        state of that request, so that concurrent requests sharing this
+        object don't interfere with each other.
         """
-        self.reset()
-        request.register_hook('response', self.handle_response)
+        # append the handler directly, rather than via register_hook(),
+        # this is called for every request
+        hooks = request.hooks['response']
+        for hook in hooks:
+            if self._is_own_hook(hook):  # request prepared again
+                hook.num_ecp_auth = 0
+                if hook.paos:
+                    _remove_paos_headers(request)
+                    hook.paos = False
+                break
+        else:
+            hook = _ResponseHook(self)
+            hooks.append(hook)
+        cookies = self._add_cookies(request)
+        if (
+            self._paos
+            and cookies is None
+            and request.method == "GET"
+            # not a request that is already part of an ECP round-trip
+            and "PAOS" not in request.headers
+            and self._expects_login(request.url)
+        ):
+            # ask for the <AuthnRequest> straight away
+            _add_paos_headers(request)
+            hook.paos = True
         return request
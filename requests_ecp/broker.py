@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp.
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Share Service Provider sessions between worker processes.
+
+A `SessionBroker` runs in its own process and owns all ECP
+authentication for an Identity Provider, handing out Service Provider
+session cookies to any number of client processes, so that a pool of
+``N`` workers costs one IdP login per Service Provider per session,
+rather than ``N``:
+
+.. code-block:: python
+
+    >>> from requests_ecp import Session
+    >>> from requests_ecp.broker import SessionBroker
+    >>> broker = SessionBroker("https://idp.example.com/SAML/SOAP/ECP")
+    >>> broker.start()
+    >>> # then, in each worker process
+    >>> with Session(
+    ...     idp="https://idp.example.com/SAML/SOAP/ECP",
+    ...     cookie_cache=broker.client(),
+    ... ) as sess:
+    ...     sess.get("https://private.example.com/data")
+
+"""
+
+__author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
+
+import time
+from multiprocessing.managers import BaseManager
+from urllib.parse import urlparse
+
+from requests import Session
+
+from .auth import HTTPECPAuth
+from .cache import (
+    DEFAULT_LIFETIME,
+    CookieCache,
+    _serialise_cookie,
+    session_expiry,
+)
+
+#: Default time (seconds) for which a `BrokerClient` remembers that the
+#: broker has no session for a host.
+MISS_TTL = 5
+
+# the broker served by this process (only set in the broker process)
+_BROKER = None
+
+
+class _Broker:
+    """The server side of a `SessionBroker`.
+
+    All methods take and return only picklable objects.
+    """
+    def __init__(self, idp, session_lifetime=DEFAULT_LIFETIME, **kwargs):
+        self.auth = HTTPECPAuth(
+            idp,
+            session_lifetime=session_lifetime,
+            **kwargs,
+        )
+        self.session_lifetime = session_lifetime
+        # (expiry, cookies) for each SP host
+        self._entries = {}
+
+    def _login(self, url):
+        # authenticate on a scratch session so that the SP doesn't see
+        # any old cookies
+        with Session() as scratch:
+            self.auth._authenticate_session(scratch, url=url)
+        host = urlparse(url).hostname
+        return self._entry(host, self.auth._cookies[host])
+
+    def _entry(self, host, cookies):
+        cookies = list(cookies)
+        expiry = session_expiry(cookies, lifetime=self.session_lifetime)
+        self._entries[host] = entry = (
+            expiry,
+            [_serialise_cookie(cookie, host) for cookie in cookies],
+        )
+        return entry
+
+    def _valid(self, host):
+        entry = self._entries.get(host)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry
+
+    def get(self, url, idp):
+        """Return the current ``(expiry, cookies)`` session for a
+        Service Provider, or `None`.
+
+        This never logs in, see :meth:`_Broker.login`.
+        """
+        if idp != self.auth.idp:
+            return None
+        return self._valid(urlparse(url).hostname)
+
+    def login(self, url, idp):
+        """Return a valid ``(expiry, cookies)`` session for a Service Provider.
+
+        Executes an ECP round-trip if there isn't a valid session already.
+        """
+        if idp != self.auth.idp:
+            return None
+        host = urlparse(url).hostname
+        # only one login at a time per SP
+        with self.auth._login_lock(host):
+            return self._valid(host) or self._login(url)
+
+    def store(self, url, idp, cookies):
+        """Store a session established by a client.
+        """
+        if idp == self.auth.idp:
+            self._entry(
+                urlparse(url).hostname,
+                CookieCache._load({"cookies": cookies}),
+            )
+
+    def discard(self, url, idp):
+        """Forget the session for a Service Provider.
+        """
+        if idp == self.auth.idp:
+            self._entries.pop(urlparse(url).hostname, None)
+
+
+def _init_broker(idp, kwargs):
+    global _BROKER
+    _BROKER = _Broker(idp, **kwargs)
+
+
+def _get_broker():
+    return _BROKER
+
+
+class _BrokerManager(BaseManager):
+    pass
+
+
+_BrokerManager.register("get_broker", callable=_get_broker)
+
+
+class BrokerClient:
+    """Client for a `SessionBroker`.
+
+    This implements the same interface as `~requests_ecp.CookieCache`,
+    and so can be used as the ``cookie_cache`` for
+    `~requests_ecp.HTTPECPAuth` or `~requests_ecp.Session`.
+    Sessions received from the broker are remembered locally until
+    they expire, so that most requests don't need to contact the broker;
+    hosts for which the broker has no session are remembered for
+    ``miss_ttl`` seconds.
+
+    A plain lookup (:meth:`BrokerClient.get`) never causes the broker
+    to log in, that only happens when `~requests_ecp.HTTPECPAuth` sees an
+    ECP redirect and calls :meth:`BrokerClient.login`.
+
+    If the broker can't be reached, no cookies are returned, and the
+    client process will authenticate itself.
+
+    Parameters
+    ----------
+    broker
+        The broker proxy, normally created with :meth:`BrokerClient.connect`
+        or :meth:`SessionBroker.client`.
+
+    miss_ttl : `float`, optional
+        The time (seconds) for which to remember that the broker has no
+        session for a host.
+    """
+    def __init__(self, broker, miss_ttl=MISS_TTL):
+        self._broker = broker
+        self.miss_ttl = miss_ttl
+        self._memo = {}
+        # expiry of negative results, keyed like _memo
+        self._misses = {}
+
+    @classmethod
+    def connect(cls, address, authkey=None, **kwargs):
+        """Connect to a running `SessionBroker`.
+
+        Parameters
+        ----------
+        address : `str`, `tuple`
+            The address of the broker, see `SessionBroker.address`.
+
+        authkey : `bytes`
+            The authentication key for the broker.
+
+        kwargs
+            Other keyword arguments are passed to `BrokerClient`.
+        """
+        manager = _BrokerManager(address=address, authkey=authkey)
+        manager.connect()
+        return cls(manager.get_broker(), **kwargs)
+
+    @staticmethod
+    def _key(url, idp):
+        return (urlparse(url).hostname, idp)
+
+    def _ask(self, method, url, idp):
+        """Ask the broker for a session, remembering the answer.
+        """
+        key = self._key(url, idp)
+        try:
+            entry = method(url, idp)
+        except Exception:  # broker unavailable, or failed to log in
+            entry = None
+        if entry is None:
+            self._misses[key] = time.time() + self.miss_ttl
+            return None
+        self._misses.pop(key, None)
+        expiry, cookies = entry
+        jar = CookieCache._load({"cookies": cookies})
+        self._memo[key] = (expiry, jar)
+        return jar
+
+    def get(self, url, idp):
+        """Return the cookies for a Service Provider session.
+
+        Returns
+        -------
+        cookies : `requests.cookies.RequestsCookieJar`, `None`
+            The session cookies, or `None` if the broker doesn't have
+            a session.
+        """
+        key = self._key(url, idp)
+        now = time.time()
+        try:
+            expiry, jar = self._memo[key]
+        except KeyError:
+            expiry = 0
+        if expiry > now:
+            return jar
+        if self._misses.get(key, 0) > now:
+            return None
+        return self._ask(self._broker.get, url, idp)
+
+    def login(self, url, idp):
+        """Ask the broker to log in to a Service Provider.
+
+        Returns
+        -------
+        cookies : `requests.cookies.RequestsCookieJar`, `None`
+            The session cookies, or `None` if the broker can't supply them.
+        """
+        try:
+            login = self._broker.login
+        except Exception:  # broker unavailable
+            return None
+        return self._ask(login, url, idp)
+
+    def store(self, url, idp, cookies):
+        """Share a session established by this process with the broker.
+        """
+        key = self._key(url, idp)
+        self._memo.pop(key, None)
+        self._misses.pop(key, None)
+        host = urlparse(url).hostname
+        try:
+            self._broker.store(url, idp, [
+                _serialise_cookie(cookie, host) for cookie in cookies
+            ])
+        except (OSError, EOFError):  # broker unavailable
+            pass
+
+    def discard(self, url, idp):
+        """Tell the broker that the session for a Service Provider was
+        rejected.
+        """
+        self._memo.pop(self._key(url, idp), None)
+        try:
+            self._broker.discard(url, idp)
+        except (OSError, EOFError):  # broker unavailable
+            pass
+
+
+class SessionBroker:
+    """Broker for ECP-authenticated Service Provider sessions.
+
+    The broker runs in a separate process (started with
+    :meth:`SessionBroker.start`) that executes all ECP round-trips, and
+    serves the resulting session cookies to clients, see
+    :meth:`SessionBroker.client` and :meth:`BrokerClient.connect`.
+
+    Parameters
+    ----------
+    idp : `str`
+        The URL of the Identity Provider ECP endpoint.
+
+    address : `str`, `tuple`, optional
+        The address on which to serve clients, either a Unix socket path
+        or a ``(host, port)`` tuple, defaults to a new Unix socket.
+
+    authkey : `bytes`, optional
+        The authentication key for clients, defaults to the
+        ``authkey`` of the current process.
+
+    ctx : `multiprocessing.context.BaseContext`, optional
+        The multiprocessing context to use to start the broker process.
+
+    kwargs
+        Other keyword arguments are passed to `~requests_ecp.HTTPECPAuth`
+        in the broker process.
+    """
+    def __init__(self, idp, address=None, authkey=None, ctx=None, **kwargs):
+        self.idp = idp
+        self._kwargs = kwargs
+        self._manager = _BrokerManager(
+            address=address,
+            authkey=authkey,
+            ctx=ctx,
+        )
+
+    @property
+    def address(self):
+        """The address on which the broker serves clients.
+        """
+        return self._manager.address
+
+    def start(self):
+        """Start the broker process.
+        """
+        self._manager.start(
+            initializer=_init_broker,
+            initargs=(self.idp, self._kwargs),
+        )
+        return self
+
+    def shutdown(self):
+        """Stop the broker process.
+        """
+        self._manager.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def client(self):
+        """Return a new `BrokerClient` for this broker.
+        """
+        return BrokerClient(self._manager.get_broker())
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp.
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent cache of Service Provider session cookies.
+"""
+
+__author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
+
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+
+from requests.cookies import (
+    RequestsCookieJar,
+    create_cookie,
+)
+
+try:
+    import fcntl
+except ModuleNotFoundError:  # pragma: no cover
+    # no POSIX file locking (e.g. Windows), the cache is still
+    # safe for a single process
+    fcntl = None
+
+#: Prefix of the name of the Shibboleth SP session cookie.
+SHIBBOLETH_SESSION_COOKIE_PREFIX = "_shibsession_"
+
+#: Default lifetime (seconds) of a cached session whose cookies don't
+#: declare an expiry time, matches the default Shibboleth SP session
+#: inactivity ``timeout``.
+DEFAULT_LIFETIME = 3600
+
+
+def _default_path():
+    """Return the default location of the cookie cache file.
+    """
+    cachedir = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cachedir) / "requests-ecp" / "cookies.json"
+
+
+def session_expiry(cookies, lifetime=DEFAULT_LIFETIME, now=None):
+    """Return the expiry time of the SP session represented by some cookies.
+
+    Parameters
+    ----------
+    cookies : `iterable` of `http.cookiejar.Cookie`
+        The cookies received from the Service Provider.
+
+    lifetime : `int`
+        The lifetime (seconds) to assume for a session whose cookies
+        don't declare an expiry time.
+
+    now : `float`
+        The current UNIX time, defaults to :func:`time.time`.
+
+    Returns
+    -------
+    expiry : `float`
+        The UNIX time at which the session is expected to expire.
+    """
+    if now is None:
+        now = time.time()
+    cookies = list(cookies)
+    # use the Shibboleth session cookie if we have one
+    shib = [c for c in cookies if c.name.startswith(
+        SHIBBOLETH_SESSION_COOKIE_PREFIX,
+    )] or cookies
+    expires = [c.expires for c in shib if c.expires]
+    return min(expires + [now + lifetime])
+
+
+def _serialise_cookie(cookie, host):
+    return {
+        "name": cookie.name,
+        "value": cookie.value,
+        # cookies without a domain are only valid for the host that set them
+        "domain": cookie.domain or host,
+        "path": cookie.path,
+        "secure": cookie.secure,
+        "expires": cookie.expires,
+    }
+
+
+class CookieCache:
+    """On-disk cache of Service Provider session cookies.
+
+    Cookies are stored in a JSON file keyed by the Service Provider
+    host name and the Identity Provider endpoint, and are considered
+    valid until the Shibboleth session cookie expires (or for
+    ``lifetime`` seconds if the session cookie doesn't declare an expiry).
+
+    Access to the file is serialised using POSIX file locks so that
+    many processes can safely share one cache.
+
+    Parameters
+    ----------
+    path : `str`, `pathlib.Path`, optional
+        The path of the cache file, defaults to
+        ``~/.cache/requests-ecp/cookies.json``.
+
+    lifetime : `int`, optional
+        The lifetime (seconds) to assume for sessions whose cookies
+        don't declare an expiry time.
+
+    Examples
+    --------
+    >>> from requests_ecp import HTTPECPAuth
+    >>> auth = HTTPECPAuth(
+    ...     "https://idp.example.com/SAML2/SOAP/ECP",
+    ...     cookie_cache=CookieCache("/tmp/ecp-cookies.json"),
+    ... )
+    """
+    def __init__(self, path=None, lifetime=DEFAULT_LIFETIME):
+        self.path = Path(path or _default_path())
+        self.lifetime = lifetime
+        # in-memory copy of entries loaded by this process
+        self._memo = {}
+        # the state of the file when each missing key was last looked for
+        self._misses = {}
+
+    @staticmethod
+    def _key(url, idp):
+        return f"{urlparse(url).hostname} {idp}"
+
+    # -- file handling ------
+
+    @contextmanager
+    def _lock(self, exclusive=False):
+        """Hold a lock on the cache file for the duration of the context.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lockfile = self.path.with_name(self.path.name + ".lock")
+        with open(lockfile, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(
+                    lock.fileno(),
+                    fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH,
+                )
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _stat(self):
+        """Return a signature of the cache file that changes when it is
+        written (which always replaces the file).
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        # write to a temporary file and then move it into place so that
+        # readers never see a partial file
+        fd, tmp = tempfile.mkstemp(
+            dir=str(self.path.parent),
+            prefix=self.path.name,
+        )
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(entries, file)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, str(self.path))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @staticmethod
+    def _load(entry):
+        jar = RequestsCookieJar()
+        for cookie in entry["cookies"]:
+            jar.set_cookie(create_cookie(**cookie))
+        return jar
+
+    # -- cache interface ----
+
+    def get(self, url, idp):
+        """Return the cached cookies for a Service Provider.
+
+        Parameters
+        ----------
+        url : `str`
+            Any URL on the Service Provider.
+
+        idp : `str`
+            The URL of the Identity Provider ECP endpoint.
+
+        Returns
+        -------
+        cookies : `requests.cookies.RequestsCookieJar`, `None`
+            The cached cookies, or `None` if nothing valid is cached.
+        """
+        key = self._key(url, idp)
+        now = time.time()
+        try:
+            expiry, jar, _ = self._memo[key]
+        except KeyError:
+            # don't read the file again if it hasn't changed since
+            # the last time this key wasn't found
+            if key in self._misses and self._misses[key] == self._stat():
+                return None
+            with self._lock():
+                stat = self._stat()
+                entry = self._read().get(key)
+            if entry is None or entry["expiry"] <= now:
+                self._misses[key] = stat
+                return None
+            expiry = entry["expiry"]
+            jar = self._load(entry)
+            self._memo[key] = (expiry, jar, entry["cookies"])
+        if expiry <= now:
+            self._memo.pop(key, None)
+            return None
+        return jar
+
+    def store(self, url, idp, cookies):
+        """Store the cookies for a Service Provider.
+
+        Parameters
+        ----------
+        url : `str`
+            Any URL on the Service Provider.
+
+        idp : `str`
+            The URL of the Identity Provider ECP endpoint.
+
+        cookies : `iterable` of `http.cookiejar.Cookie`
+            The cookies to store.
+        """
+        key = self._key(url, idp)
+        now = time.time()
+        jar = RequestsCookieJar()
+        for cookie in cookies:
+            jar.set_cookie(cookie)
+        if not len(jar):
+            return
+        expiry = session_expiry(jar, lifetime=self.lifetime, now=now)
+        with self._lock(exclusive=True):
+            entries = {
+                k: v for k, v in self._read().items() if v["expiry"] > now
+            }
+            entries[key] = entry = {
+                "expiry": expiry,
+                "cookies": [
+                    _serialise_cookie(cookie, urlparse(url).hostname)
+                    for cookie in jar
+                ],
+            }
+            self._write(entries)
+        self._memo[key] = (expiry, self._load(entry), entry["cookies"])
+        self._misses.pop(key, None)
+
+    def discard(self, url, idp):
+        """Remove the cached cookies for a Service Provider.
+
+        This should be called when the cookies returned by
+        :meth:`CookieCache.get` are rejected.
+        If another process has since stored a new session, that is kept,
+        and is returned by the next call to :meth:`CookieCache.get`.
+        """
+        key = self._key(url, idp)
+        try:
+            _, _, rejected = self._memo.pop(key)
+        except KeyError:  # don't know what was rejected
+            rejected = None
+        self._misses.pop(key, None)
+        with self._lock(exclusive=True):
+            entries = self._read()
+            entry = entries.get(key)
+            if entry is not None and (
+                rejected is None
+                or entry["cookies"] == rejected
+            ):
+                del entries[key]
+                self._write(entries)
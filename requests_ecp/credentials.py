@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp.
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sources of username/password credentials for an Identity Provider.
+
+Credentials are resolved by :func:`get_credentials`, which asks a
+sequence of providers in turn, and remembers the result for the
+lifetime of the process:
+
+.. code-block:: python
+
+    >>> from requests_ecp import Session
+    >>> from requests_ecp.credentials import (
+    ...     EnvironmentCredentials,
+    ...     NetrcCredentials,
+    ... )
+    >>> with Session(
+    ...     idp="https://idp.example.com/SAML/SOAP/ECP",
+    ...     credentials=[EnvironmentCredentials(), NetrcCredentials()],
+    ... ) as sess:
+    ...     sess.get("https://private.example.com/data")
+
+"""
+
+__author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
+
+import os
+import sys
+import threading
+
+# resolved credentials, keyed by (host, username, providers)
+_CACHE = {}
+_LOCK = threading.Lock()
+
+
+class CredentialProvider:
+    """Base class for credential providers.
+
+    Subclasses should implement :meth:`get`.
+
+    Providers of the same type with the same (public) attributes compare
+    equal, so that credentials found by one are reused by the other,
+    see :func:`get_credentials`.
+    """
+    def _params(self):
+        return tuple(
+            (key, value) for key, value in sorted(vars(self).items())
+            if not key.startswith("_")
+        )
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._params() == other._params()
+
+    def __hash__(self):
+        return hash((type(self), self._params()))
+
+    def get(self, host, username=None):
+        """Return the credentials to use for an Identity Provider.
+
+        Parameters
+        ----------
+        host : `str`
+            The host name of the Identity Provider.
+
+        username : `str`, optional
+            The username to find the password for, if known.
+
+        Returns
+        -------
+        credentials : `tuple`, `None`
+            A ``(username, password)`` tuple, or `None` if this provider
+            doesn't have credentials for ``host``.
+        """
+        raise NotImplementedError
+
+
+class EnvironmentCredentials(CredentialProvider):
+    """Read credentials from environment variables.
+
+    Parameters
+    ----------
+    username_variable : `str`
+        The name of the variable holding the username; this is only
+        used if the username isn't otherwise known.
+
+    password_variable : `str`
+        The name of the variable holding the password.
+    """
+    def __init__(
+            self,
+            username_variable="ECP_USERNAME",
+            password_variable="ECP_PASSWORD",
+    ):
+        self.username_variable = username_variable
+        self.password_variable = password_variable
+
+    def get(self, host, username=None):
+        username = username or os.getenv(self.username_variable)
+        password = os.getenv(self.password_variable)
+        if username and password:
+            return username, password
+        return None
+
+
+class NetrcCredentials(CredentialProvider):
+    """Read credentials from a ``netrc`` file.
+
+    Parameters
+    ----------
+    path : `str`, optional
+        The path of the netrc file, defaults to ``~/.netrc``.
+    """
+    def __init__(self, path=None):
+        self.path = path
+
+    def get(self, host, username=None):
+        import netrc
+        try:
+            entry = netrc.netrc(self.path).authenticators(host)
+        except (OSError, netrc.NetrcParseError):
+            return None
+        if entry is None:
+            return None
+        login, _, password = entry
+        if username and login != username:
+            return None
+        return login, password
+
+
+class KeyringCredentials(CredentialProvider):
+    """Read credentials from the system keyring.
+
+    This provider isn't used by default, because unlocking the keyring
+    may need user interaction, add it to the ``credentials`` to use it.
+
+    This requires the `keyring <https://pypi.org/project/keyring/>`__
+    package, if it isn't installed no credentials are returned.
+
+    Parameters
+    ----------
+    service : `str`, optional
+        The name of the keyring service, defaults to the host name of
+        the Identity Provider.
+    """
+    def __init__(self, service=None):
+        self.service = service
+
+    def get(self, host, username=None):
+        try:
+            import keyring
+        except ImportError:
+            return None
+        try:
+            credential = keyring.get_credential(self.service or host, username)
+        except Exception:  # keyring backend errors are many and varied
+            return None
+        if credential is None:
+            return None
+        return credential.username, credential.password
+
+
+class FileDescriptorCredentials(CredentialProvider):
+    """Read credentials from a file descriptor (e.g. a pipe).
+
+    The descriptor is read (to the end) the first time credentials are
+    requested; the content should be either a password, or a username
+    and a password on separate lines.
+
+    Parameters
+    ----------
+    fd : `int`
+        The file descriptor to read.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self._lines = None
+
+    def get(self, host, username=None):
+        if self._lines is None:
+            with os.fdopen(self.fd, "r", closefd=False) as file:
+                self._lines = file.read().splitlines()
+        lines = self._lines
+        if len(lines) >= 2:
+            login, password = lines[:2]
+            if username and login != username:
+                return None
+            return login, password
+        if lines and username:
+            return username, lines[0]
+        return None
+
+
+class CallableCredentials(CredentialProvider):
+    """Get credentials from a function.
+
+    Parameters
+    ----------
+    func : `callable`
+        A function that takes ``(host, username)`` arguments and returns
+        a ``(username, password)`` tuple, or `None`.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def get(self, host, username=None):
+        return self.func(host, username)
+
+
+class PromptCredentials(CredentialProvider):
+    """Prompt for credentials on the console.
+
+    Credentials are only prompted for if standard input is a terminal,
+    or :func:`getpass.getpass` has been replaced by an interactive
+    frontend (e.g. a Jupyter kernel), so that non-interactive processes
+    never block.
+    """
+    def get(self, host, username=None):
+        if not _interactive():
+            return None
+        from .auth import _prompt_username_password
+        return _prompt_username_password(host, username)
+
+
+def _interactive():
+    """Return `True` if the user can be prompted for credentials.
+    """
+    if sys.stdin is not None and sys.stdin.isatty():
+        return True
+    # e.g. IPython kernels provide their own prompt
+    import getpass
+    return getpass.getpass not in {
+        getattr(getpass, name, None) for name in (
+            "unix_getpass",
+            "win_getpass",
+            "fallback_getpass",
+        )
+    }
+
+
+#: The providers used by :func:`get_credentials` by default, in order.
+DEFAULT_PROVIDERS = (
+    EnvironmentCredentials(),
+    NetrcCredentials(),
+    PromptCredentials(),
+)
+
+
+def _providers(providers):
+    """Return a `tuple` of credential providers.
+    """
+    if providers is None:
+        return DEFAULT_PROVIDERS
+    if callable(providers) or isinstance(providers, CredentialProvider):
+        return (providers,)
+    return tuple(providers)
+
+
+def get_credentials(host, username=None, providers=None):
+    """Return the credentials to use for an Identity Provider.
+
+    Credentials are taken from the first provider that has any, and are
+    then reused for the same ``(host, username, providers)`` for the
+    lifetime of the process, or until :func:`discard_credentials` is called.
+
+    Parameters
+    ----------
+    host : `str`
+        The host name of the Identity Provider.
+
+    username : `str`, optional
+        The username to find the password for, if known.
+
+    providers : `list` of `CredentialProvider`, optional
+        The providers to ask, defaults to `DEFAULT_PROVIDERS`.
+        Plain functions are wrapped with `CallableCredentials`.
+
+    Returns
+    -------
+    username, password : `str`
+        The credentials.
+
+    Raises
+    ------
+    RuntimeError
+        If no provider has credentials for ``host``.
+    """
+    providers = _providers(providers)
+    key = (host, username, providers)
+    # hold the lock while resolving so that concurrent callers don't
+    # prompt (or read a file descriptor) more than once
+    with _LOCK:
+        try:
+            return _CACHE[key]
+        except KeyError:
+            pass
+        for provider in providers:
+            if not isinstance(provider, CredentialProvider):
+                provider = CallableCredentials(provider)
+            credentials = provider.get(host, username)
+            if credentials is not None:
+                _CACHE[key] = credentials = tuple(credentials)
+                return credentials
+    raise RuntimeError(f"no credentials found for {host}")
+
+
+def discard_credentials(host, username=None, providers=None):
+    """Forget the credentials resolved by :func:`get_credentials`.
+
+    This should be called when the Identity Provider rejects the
+    credentials, so that the next call asks the providers again.
+
+    Parameters
+    ----------
+    host, username, providers
+        The arguments given to :func:`get_credentials`.
+    """
+    with _LOCK:
+        _CACHE.pop((host, username, _providers(providers)), None)
+
+
+def clear_cache():
+    """Forget all resolved credentials.
+    """
+    with _LOCK:
+        _CACHE.clear()
@@ -21,36 +21,328 @@
 
 __author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
 
-from lxml import etree
+import re
+import time
+from collections import namedtuple
+from functools import (
+    lru_cache,
+    partial,
+)
+from itertools import chain
 
 from requests import (
     HTTPError,
     Request,
     Session,
 )
+from requests.cookies import RequestsCookieJar
+
+from .retry import (
+    CircuitOpenError,
+    _is_transient,
+)
+
+
+#: Headers to send to a Service Provider to request ECP authentication.
+PAOS_HEADERS = {
+    'Accept': 'text/html; application/vnd.paos+xml',
+    'PAOS': 'ver="urn:liberty:paos:2003-08";'
+            '"urn:oasis:names:tc:SAML:2.0:profiles:SSO:ecp"',
+}
+
+#: Headers to send to an Identity Provider with a SOAP request.
+IDP_HEADERS = {"Content-Type": "text/xml; charset=utf-8"}
+
+#: Headers to send to a Service Provider with a PAOS response.
+SP_HEADERS = {'Content-Type': 'application/vnd.paos+xml'}
+
+SOAP_FAULT_MESSAGE = (
+    "responseConsumerURL from SP and assertionConsumerServiceURL "
+    "from IdP do not match"
+)
+
+
+#: Record of one HTTP request made during an ECP round-trip, passed to
+#: the ``trace`` callback of :func:`authenticate`.
+#:
+#: - ``step``: one of ``"sp"`` (the PAOS request to the Service Provider),
+#:   ``"idp"`` (the SOAP request to the Identity Provider), ``"acs"``
+#:   (the response to the Assertion Consumer Service), or ``"fault"``
+#:   (a SOAP fault reported to the Service Provider)
+#: - ``method``, ``url``, ``status_code``: the request and its outcome
+#: - ``elapsed``: the time (seconds) taken to send the request and receive
+#:   the response
+#: - ``bytes_sent``, ``bytes_received``: the size of the request and
+#:   response bodies
+#: - ``reused``: whether an existing connection was reused, or `None`
+#:   if that can't be determined
+ECPTraceEvent = namedtuple("ECPTraceEvent", (
+    "step",
+    "method",
+    "url",
+    "status_code",
+    "elapsed",
+    "bytes_sent",
+    "bytes_received",
+    "reused",
+))
+
+#: XML namespaces used in ECP messages.
+NAMESPACES = {
+    'ecp': 'urn:oasis:names:tc:SAML:2.0:profiles:SSO:ecp',
+    'S': 'http://schemas.xmlsoap.org/soap/envelope/',
+    'paos': 'urn:liberty:paos:2003-08'
+}
+
+#: Size (bytes) of chunks read from a response when parsing XML.
+XML_CHUNK_SIZE = 64 * 1024
+
+#: Maximum size (bytes) of a response to read while looking for the end
+#: of its SOAP header, before parsing the whole document instead.
+HEADER_READ_LIMIT = 1024 * 1024
+
+
+#: XPath expressions used for every ECP round-trip.
+RELAY_STATE = "//ecp:RelayState"
+RESPONSE_CONSUMER_URL = (
+    "/S:Envelope/S:Header/paos:Request/@responseConsumerURL"
+)
+ASSERTION_CONSUMER_SERVICE_URL = (
+    "/S:Envelope/S:Header/ecp:Response/@AssertionConsumerServiceURL"
+)
+SOAP_HEADER = "/S:Envelope/S:Header"
+IDP_RESPONSE = "/S:Envelope/S:Header/ecp:Response"
+
+# the start tag of a SOAP envelope, and any whitespace after it
+_ENVELOPE_START = re.compile(
+    rb"(<(?:([A-Za-z_][\w.-]*):)?Envelope\b[^>]*>)\s*",
+)
+
+# the end tag of a SOAP header
+_HEADER_END = re.compile(rb"</(?:[A-Za-z_][\w.-]*:)?Header>")
+
+# the encoding declared in an XML declaration
+_XML_ENCODING = re.compile(rb"encoding=[\"']([\w.-]+)")
+
+# encodings in which the envelope markup can be found as ASCII bytes
+_ASCII_ENCODINGS = {b"utf-8", b"utf8", b"us-ascii", b"ascii"}
+
+# NOTE: lxml is imported by the functions that need it, rather than
+#       at module level, so that `import requests_ecp` doesn't pay for
+#       it when no ECP round-trip is ever executed
 
 
 # -- utilities --------------
 
+@lru_cache()
+def _xpath(path):
+    """Compile an XPath expression using the ECP namespaces.
+
+    Compiled expressions are cached, so each is only compiled once.
+    """
+    from lxml import etree
+    return etree.XPath(path, namespaces=NAMESPACES)
+
+
 def _get_xml_attribute(xdata, path):
     """Parse an attribute from an XML document
     """
-    namespaces = {
-        'ecp': 'urn:oasis:names:tc:SAML:2.0:profiles:SSO:ecp',
-        'S': 'http://schemas.xmlsoap.org/soap/envelope/',
-        'paos': 'urn:liberty:paos:2003-08'
-    }
-    return xdata.xpath(path, namespaces=namespaces)[0]
+    return _xpath(path)(xdata)[0]
+
+
+def _parse_xml(source):
+    """Parse an XML document.
+
+    Parameters
+    ----------
+    source : `bytes`, `requests.Response`, iterable of `bytes`
+        The document to parse. Responses and iterables of chunks are
+        parsed incrementally, so the body is never held in memory
+        as a single `bytes` object.
+
+    Returns
+    -------
+    root : `lxml.etree._Element`
+        The root element of the document.
+
+    Raises
+    ------
+    lxml.etree.XMLSyntaxError
+        If the document cannot be parsed.
+    """
+    from lxml import etree
+    if isinstance(source, bytes):
+        chunks = (source,)
+    elif hasattr(source, "iter_content"):
+        chunks = source.iter_content(chunk_size=XML_CHUNK_SIZE)
+    else:
+        chunks = source
+    parser = etree.XMLParser(resolve_entities=False)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def _read_header(source):
+    """Read a document up to the end of its SOAP header.
+
+    Responses are read in chunks only until the ``</Header>`` end tag
+    (or `HEADER_READ_LIMIT` bytes) has been read, the rest is left in
+    the content stream.
+
+    Parameters
+    ----------
+    source : `bytes`, `requests.Response`
+        The document to read.
+
+    Returns
+    -------
+    head : `bytes`
+        The start of the document.
+
+    rest : iterable of `bytes`
+        The remaining chunks of the document.
+    """
+    if isinstance(source, bytes):
+        return source, ()
+    chunks = source.iter_content(chunk_size=XML_CHUNK_SIZE)
+    head = bytearray()
+    for chunk in chunks:
+        # the end tag may span two chunks
+        pos = max(len(head) - 64, 0)
+        head += chunk
+        if (
+            _HEADER_END.search(head, pos)
+            or len(head) >= HEADER_READ_LIMIT
+        ):
+            break
+    return bytes(head), chunks
+
+
+def _parse_header(content):
+    """Parse only the ``<Header>`` of a SOAP envelope.
+
+    The envelope is split by byte offsets, and only the start tag of the
+    envelope and its header are parsed, so that the (potentially large)
+    ``<Body>`` doesn't have to be parsed or re-serialised.
+
+    Parameters
+    ----------
+    content : `bytes`
+        The SOAP envelope.
+
+    Returns
+    -------
+    envelope : `lxml.etree._Element`, `None`
+        The envelope, containing only the header, or `None` if the
+        envelope can't be split this way, in which case the whole
+        document should be parsed instead.
+
+    start, header_start, end : `int`
+        The byte offsets in ``content`` of the envelope start tag, the
+        header start tag, and the end of the header.
+    """
+    from lxml import etree
+    match = _ENVELOPE_START.search(content)
+    if match is None:
+        return None, None, None, None
+    start = match.start()
+    encoding = _XML_ENCODING.search(content, 0, start)
+    if encoding and encoding.group(1).lower() not in _ASCII_ENCODINGS:
+        return None, None, None, None
+    prefix = match.group(2) + b":" if match.group(2) else b""
+    header_start = match.end()
+    if not content.startswith(b"<" + prefix + b"Header", header_start):
+        return None, None, None, None
+    close = b"</" + prefix + b"Header>"
+    end = content.find(close, header_start)
+    if end < 0:
+        return None, None, None, None
+    end += len(close)
+
+    # parse the envelope with the header but without the body
+    try:
+        envelope = etree.fromstring(
+            content[start:end] + b"</" + prefix + b"Envelope>",
+            parser=etree.XMLParser(resolve_entities=False),
+        )
+    except etree.XMLSyntaxError:
+        return None, None, None, None
+    soap = "{{{}}}".format(NAMESPACES["S"])
+    if (
+        envelope.tag != soap + "Envelope"
+        or len(envelope) != 1
+        or envelope[0].tag != soap + "Header"
+    ):
+        return None, None, None, None
+    return envelope, start, header_start, end
+
+
+def _connection_pool(connection, url, verify=True, proxies=None, cert=None):
+    """Return the `urllib3` connection pool that will be used for a URL.
+
+    The pool is looked up in the same way as the adapter does when
+    sending a request (including the TLS settings and any proxy),
+    so this doesn't create any pools that won't be used.
+
+    Returns `None` if the pool can't be determined.
+    """
+    if isinstance(connection, Session):
+        settings = connection.merge_environment_settings(
+            url,
+            {},
+            None,
+            None,
+            None,
+        )
+        verify = settings["verify"]
+        proxies = settings["proxies"]
+        cert = settings["cert"]
+        connection = connection.get_adapter(url)
+    try:
+        get_connection = connection.get_connection_with_tls_context
+    except AttributeError:  # not an HTTPAdapter, or requests < 2.32.2
+        return None
+    try:
+        return get_connection(
+            Request("GET", url).prepare(),
+            verify,
+            proxies=proxies,
+            cert=cert,
+        )
+    except Exception:  # don't let tracing break the request
+        return None
 
 
 def _send(
     connection,
     method,
     url,
+    trace=None,
+    step=None,
     **kwargs,
 ):
     """Format and send a request.
+
+    When sending via a connection adapter, any cookies set by the response
+    are added to the ``cookies`` jar (if given), so that a jar can be
+    shared across a sequence of requests in the same way as with a
+    `requests.Session`.
+
+    If ``trace`` is given, it is called with an `ECPTraceEvent` for
+    the request labelled as ``step``.
     """
+    if trace is not None:
+        pool = _connection_pool(
+            connection,
+            url,
+            verify=kwargs.get("verify", True),
+            proxies=kwargs.get("proxies"),
+            cert=kwargs.get("cert"),
+        )
+        nconn = getattr(pool, "num_connections", None)
+        start = time.perf_counter()
+
     request_kw = {k: kwargs.pop(k) for k in (
         "auth",
         "cookies",
@@ -77,27 +369,157 @@ def _send(
             **request_kw,
         ).prepare()
         response = connection.send(request, **kwargs)
+        if request_kw.get("cookies") is not None:
+            request_kw["cookies"].update(response.cookies)
+
+    if trace is not None:
+        # read the body now so that the download is included in the timing
+        response.content
+        _trace(trace, step, response, time.perf_counter() - start, pool, nconn)
 
     response.raise_for_status()
     return response
 
 
-def _report_soap_fault(
+def _trace(trace, step, response, elapsed, pool, nconn):
+    """Emit an `ECPTraceEvent` for a response.
+    """
+    request = response.request
+    body = getattr(request, "body", None) or b""
+    try:
+        received = response.raw.tell()
+    except AttributeError:  # no raw response (e.g. mocked)
+        received = len(response.content)
+    trace(ECPTraceEvent(
+        step,
+        getattr(request, "method", None),
+        response.url,
+        response.status_code,
+        elapsed,
+        len(body),
+        received,
+        None if nconn is None else pool.num_connections == nconn,
+    ))
+
+
+def _no_auth(request):
+    """Null authentication, to override the auth of a `requests.Session`.
+    """
+    return request
+
+
+def _post_idp(connection, auth, endpoint, idpbody, relaystate, **kwargs):
+    """Send an ``<AuthnRequest>`` to the Identity Provider and parse the reply.
+    """
+    response = _send(
+        connection,
+        method="POST",
+        url=endpoint,
+        step="idp",
+        auth=auth,
+        data=idpbody,
+        headers=IDP_HEADERS,
+        **kwargs,
+    )
+    try:
+        return (response,) + _parse_idp_response(
+            response,
+            endpoint,
+            relaystate,
+        )
+    finally:
+        response.raw.release_conn()
+
+
+def _authenticate_idp(
     connection,
-    url,
-    message=(
-        "responseConsumerURL from SP and assertionConsumerServiceURL "
-        "from IdP do not match"
-    ),
+    auth,
+    endpoint,
+    idpbody,
+    relaystate,
+    idp_cookies=None,
+    retry=None,
     **kwargs,
 ):
-    """Report a problem with the SOAP configuration of SP/IdP pair.
+    """Authenticate an ``<AuthnRequest>`` with the Identity Provider.
+
+    If ``idp_cookies`` holds an IdP session, that is tried first without
+    credentials, and ``auth`` is only used if the IdP rejects the session
+    (``401``/``403``, or a response without an assertion), in which case
+    the session is forgotten.
+    All requests are retried according to the ``retry`` policy, if given;
+    a transient failure is raised, and doesn't discard the IdP session.
+
+    Returns
+    -------
+    response : `requests.Response`
+        The response from the IdP.
+
+    spbody : `bytes`
+        The PAOS message to return to the Service Provider.
+
+    acsurl : `str`
+        The ``AssertionConsumerServiceURL`` declared by the Identity Provider.
     """
-    return _send(
-        connection,
-        "POST",
-        url,
-        data=f"""
+    # the IdP has its own cookies, Service Provider cookies are never sent
+    if idp_cookies is not None:
+        kwargs["cookies"] = idp_cookies
+    elif not isinstance(connection, Session):
+        kwargs["cookies"] = RequestsCookieJar()
+    else:
+        kwargs.pop("cookies", None)
+
+    def post(auth):
+        func = partial(
+            _post_idp,
+            connection,
+            auth,
+            endpoint,
+            idpbody,
+            relaystate,
+            **kwargs,
+        )
+        if retry is None:
+            return func()
+        return retry.call(endpoint, func)
+
+    if idp_cookies is None:
+        return post(auth)
+
+    result = None
+    if len(idp_cookies):  # try the existing IdP session first
+        try:
+            result = post(_no_auth)
+        except CircuitOpenError:
+            raise
+        except (HTTPError, RuntimeError) as exc:
+            if _is_transient(exc):  # the IdP is unavailable, try later
+                raise
+            if isinstance(exc, HTTPError):
+                response = exc.response
+                if response is not None:
+                    response.close()
+                rejected = (
+                    response is not None
+                    and response.status_code in (401, 403)
+                )
+            else:  # no assertion
+                rejected = True
+            if rejected:
+                idp_cookies.clear()
+    if result is None:
+        result = post(auth)
+
+    # keep the IdP session for next time
+    for cookie in result[0].cookies:
+        idp_cookies.set_cookie(cookie)
+    return result
+
+
+def _soap_fault(message=SOAP_FAULT_MESSAGE):
+    """Format a SOAP fault message to report to a Service Provider.
+    """
+    return f"""
 <S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">
   <S:Body>
     <S:Fault>
@@ -105,11 +527,170 @@ def _report_soap_fault(
       <faultstring>{message}</faultstring>
     </S:Fault>
   </S:Body>
-</S:Envelope>""".strip(), # noqa
-        headers={'Content-Type': 'application/vnd.paos+xml'},
+</S:Envelope>""".strip()
+
+
+def _report_soap_fault(
+    connection,
+    url,
+    message=SOAP_FAULT_MESSAGE,
+    **kwargs,
+):
+    """Report a problem with the SOAP configuration of SP/IdP pair.
+    """
+    return _send(
+        connection,
+        "POST",
+        url,
+        step="fault",
+        data=_soap_fault(message),
+        headers=SP_HEADERS,
+        **kwargs,
     )
 
 
+# -- ECP messages -----------
+
+def _parse_sp_request(content):
+    """Parse the PAOS ``<AuthnRequest>`` message from a Service Provider.
+
+    Parameters
+    ----------
+    content : `bytes`, `requests.Response`
+        The body of the Service Provider response, or the response itself.
+
+    Returns
+    -------
+    idpbody : `bytes`
+        The SOAP message to forward to the Identity Provider.
+
+    relaystate : `lxml.etree._Element`
+        The ``<ecp:RelayState>`` element to return to the Service Provider.
+
+    rcurl : `str`
+        The ``responseConsumerURL`` declared by the Service Provider.
+    """
+    from lxml import etree
+    head, rest = _read_header(content)
+
+    # fast path: cut the header out of the envelope by byte offsets
+    envelope, start, header_start, end = _parse_header(head)
+    if envelope is not None:
+        return (
+            b"".join(chain((head[start:header_start], head[end:]), rest)),
+            _get_xml_attribute(envelope, RELAY_STATE),
+            _get_xml_attribute(envelope, RESPONSE_CONSUMER_URL),
+        )
+
+    # otherwise parse the rest of the stream incrementally
+    spetree = _parse_xml(chain((head,), rest))
+
+    # pick out the relay state element from the SP so that it can
+    # be included later in the response to the SP
+    relaystate = _get_xml_attribute(spetree, RELAY_STATE)
+
+    # pick out the responseConsumerURL to validate against the
+    # AssertionConsumerServiceURL we receive later from the IdP
+    rcurl = _get_xml_attribute(spetree, RESPONSE_CONSUMER_URL)
+
+    # remove the PAOS header to create a SOAP package for the IdP
+    idpbody = spetree
+    idpbody.remove(_xpath(SOAP_HEADER)(idpbody)[0])
+
+    return etree.tostring(idpbody), relaystate, rcurl
+
+
+def _replace_idp_response(envelope, relaystate):
+    """Replace the ``<ecp:Response>`` in an IdP envelope with the SP's
+    ``<ecp:RelayState>``.
+    """
+    response = _xpath(IDP_RESPONSE)(envelope)[0]
+    response.getparent().replace(response, relaystate)
+
+
+def _parse_idp_response(content, endpoint, relaystate):
+    """Parse the SOAP ``<Response>`` message from an Identity Provider.
+
+    Parameters
+    ----------
+    content : `bytes`, `requests.Response`
+        The body of the Identity Provider response, or the response itself.
+
+    endpoint : `str`
+        The URL of the Identity Provider (used in error messages).
+
+    relaystate : `lxml.etree._Element`
+        The ``<ecp:RelayState>`` element received from the Service Provider.
+
+    Returns
+    -------
+    spbody : `bytes`
+        The PAOS message to return to the Service Provider.
+
+    acsurl : `str`
+        The ``AssertionConsumerServiceURL`` declared by the Identity Provider.
+
+    Raises
+    ------
+    RuntimeError
+        If the response cannot be parsed as XML, or doesn't declare an
+        ``AssertionConsumerServiceURL``.
+    """
+    from lxml import etree
+    head, rest = _read_header(content)
+
+    # fast path: rewrite only the header, and pass the body (including
+    # any signed assertion) through untouched
+    envelope, start, header_start, end = _parse_header(head)
+    if envelope is not None:
+        try:
+            acsurl = _get_xml_attribute(
+                envelope,
+                ASSERTION_CONSUMER_SERVICE_URL,
+            )
+        except IndexError:  # let the slow path report the error
+            pass
+        else:
+            _replace_idp_response(envelope, relaystate)
+            header = envelope[0]
+            return (
+                b"".join(chain(
+                    (
+                        head[start:header_start],
+                        etree.tostring(header, with_tail=False),
+                        head[end:],
+                    ),
+                    rest,
+                )),
+                acsurl,
+            )
+
+    # otherwise parse the rest of the stream incrementally
+    try:
+        idptree = _parse_xml(chain((head,), rest))
+    except etree.XMLSyntaxError:
+        raise RuntimeError(
+            "Failed to parse response from {}, you most "
+            "likely incorrectly entered your passphrase".format(
+                endpoint,
+            ),
+        )
+    try:
+        acsurl = _get_xml_attribute(idptree, ASSERTION_CONSUMER_SERVICE_URL)
+    except IndexError:  # probably a SOAP fault
+        raise RuntimeError(
+            f"Failed to find AssertionConsumerServiceURL in response "
+            f"from {endpoint}",
+        )
+
+    # replace the IdP's <Response> with the `<RelayState>` we
+    # received originally...
+    actree = idptree
+    _replace_idp_response(actree, relaystate)
+
+    return etree.tostring(actree), acsurl
+
+
 # -- ECP worker -------------
 
 def authenticate(
@@ -117,6 +698,12 @@ def authenticate(
     auth,
     endpoint,
     url,
+    cookies=None,
+    idp_connection=None,
+    idp_cookies=None,
+    retry=None,
+    trace=None,
+    sp_response=None,
     **kwargs,
 ):
     """Perform an ECP authorisation round-trip.
@@ -144,6 +731,39 @@ def authenticate(
     url : `str`
         The URL of the resource on the Service Provider to request.
 
+    cookies : `http.cookiejar.CookieJar`, optional
+        The cookies to send with each request to the Service Provider,
+        only used when ``connection`` is not a `requests.Session`, in
+        which case cookies set by each response are added to this jar for
+        use in subsequent requests; if not given an empty jar is used.
+        These cookies are never sent to the Identity Provider.
+
+    idp_connection : `requests.Session`, `requests.adapters.HTTPAdapter`
+        The thing to use to send the request to the Identity Provider,
+        defaults to ``connection``.
+
+    idp_cookies : `http.cookiejar.CookieJar`, optional
+        A jar of Identity Provider session cookies; if not empty the
+        IdP is first asked to authenticate using only these cookies,
+        with ``auth`` only used if that is rejected.
+        Cookies set by the IdP are added to this jar for reuse in
+        future round-trips.
+
+    retry : `requests_ecp.retry.RetryPolicy`, optional
+        The policy for retrying transient failures of the request
+        to the Identity Provider, by default requests are not retried.
+
+    trace : `callable`, optional
+        A function to call with an `ECPTraceEvent` for each HTTP request
+        made during the round-trip.
+
+    sp_response : `requests.Response`, optional
+        A response from the Service Provider to a request for ``url``
+        that already carries the PAOS ``<AuthnRequest>`` (because the
+        request was sent with the `PAOS_HEADERS`), in which case the
+        first step of the round-trip is skipped, and this response is
+        returned in its place.
+
     kwargs
         Other keyword arguments are passed directly to
         :meth:`requests.Session.request` or `http.client.HTTPConnection`.
@@ -156,96 +776,67 @@ def authenticate(
         _should_ include a ``302 Found`` redirect back to the original
         requested resource.
     """
+    if trace is not None:
+        kwargs["trace"] = trace
+
+    # share cookies between requests (a Session does this for us)
+    if not isinstance(connection, Session):
+        if cookies is None:
+            cookies = RequestsCookieJar()
+        kwargs["cookies"] = cookies
+
     # -- step 1: initiate ECP request -----------
 
-    # request resource via ECP
-    resp1 = _send(
-        connection,
-        method="GET",
-        url=url,
-        headers={
-            'Accept': 'text/html; application/vnd.paos+xml',
-            'PAOS': 'ver="urn:liberty:paos:2003-08";'
-                    '"urn:oasis:names:tc:SAML:2.0:profiles:SSO:ecp"',
-        },
-        **kwargs,
-    )
+    # request resource via ECP (unless the SP already sent the request)
+    resp1 = sp_response
+    if resp1 is None:
+        resp1 = _send(
+            connection,
+            method="GET",
+            url=url,
+            step="sp",
+            headers=PAOS_HEADERS,
+            **kwargs,
+        )
 
     # the response from the SP _should be_ an `<AuthnRequest>` message
     # to be relayed to the IdP.
     try:
-        spetree = etree.XML(resp1.content)
+        idpbody, relaystate, rcurl = _parse_sp_request(resp1)
     finally:
         resp1.raw.release_conn()
 
-    # pick out the relay state element from the SP so that it can
-    # be included later in the response to the SP
-    relaystate = _get_xml_attribute(
-        spetree,
-        "//ecp:RelayState",
-    )
-
-    # pick out the responseConsumerURL to validate against the
-    # AssertionConsumerServiceURL we receive later from the IdP
-    rcurl = _get_xml_attribute(
-        spetree,
-        "/S:Envelope/S:Header/paos:Request/@responseConsumerURL",
-    )
-
     # -- step 2: authenticate with endpoint -----
 
-    # remove the PAOS header to create a SOAP package for the IdP
-    idpbody = spetree
-    idpbody.remove(idpbody[0])
-
     # forward <AuthnRequest> to Identity Provider using SOAP
-    resp2 = _send(
-        connection,
-        method="POST",
-        url=endpoint,
-        auth=auth,
-        data=etree.tostring(idpbody),
-        headers={"Content-Type": "text/xml; charset=utf-8"},
+    resp2, spbody, acsurl = _authenticate_idp(
+        idp_connection or connection,
+        auth,
+        endpoint,
+        idpbody,
+        relaystate,
+        idp_cookies=idp_cookies,
+        retry=retry,
         **kwargs,
     )
 
-    try:
-        idptree = etree.XML(resp2.content)
-    except etree.XMLSyntaxError:
-        raise RuntimeError(
-            "Failed to parse response from {}, you most "
-            "likely incorrectly entered your passphrase".format(
-                endpoint,
-            ),
-        )
-    finally:
-        resp2.raw.release_conn()
-    acsurl = _get_xml_attribute(
-        idptree,
-        "/S:Envelope/S:Header/ecp:Response/@AssertionConsumerServiceURL",
-    )
-
     # validate URLs between SP and IdP
     if acsurl != rcurl:
         try:
-            _report_soap_fault(connection, rcurl)
+            _report_soap_fault(connection, rcurl, **kwargs)
         except HTTPError:
             pass  # don't care, just doing a service
 
     # -- step 3: post back to the SP ------------
 
-    # replace the IdP's <Response> with the `<RelayState>` we
-    # received originally...
-    actree = idptree
-    actree[0][0] = relaystate
-
-    # and post back to the SP's ECP endpoint
+    # post the IdP's response back to the SP's ECP endpoint
     resp3 = _send(
         connection,
         method="POST",
         url=acsurl,
-        data=etree.tostring(actree),
-        headers={'Content-Type': 'application/vnd.paos+xml'},
+        step="acs",
+        data=spbody,
+        headers=SP_HEADERS,
         **kwargs,
     )
 
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp.
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Resolve Identity Provider ECP endpoints from SAML federation metadata.
+
+Federation metadata aggregates are large, so they are parsed once
+(incrementally, without ever holding the whole document in memory) into
+a compact on-disk `MetadataIndex` that maps each IdP's entityID, host
+name, and scopes to its ECP endpoint:
+
+.. code-block:: python
+
+    >>> from requests_ecp import Session
+    >>> from requests_ecp.metadata import MetadataIndex
+    >>> index = MetadataIndex()
+    >>> index.refresh("https://md.example.org/federation-metadata.xml")
+    >>> with Session(idp="login.example.org", metadata=index) as sess:
+    ...     sess.get("https://private.example.com/data")
+
+"""
+
+__author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
+
+import json
+import mmap
+import os
+import tempfile
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+
+#: XML namespaces used in SAML metadata.
+NAMESPACES = {
+    "md": "urn:oasis:names:tc:SAML:2.0:metadata",
+    "shibmd": "urn:mace:shibboleth:metadata:1.0",
+}
+
+#: The SAML binding of the ``SingleSignOnService`` used for ECP.
+SOAP_BINDING = "urn:oasis:names:tc:SAML:2.0:bindings:SOAP"
+
+# the first line of every index file
+_HEADER_PREFIX = b"# requests-ecp metadata index "
+
+# NOTE: lxml is imported by the functions that need it, rather than
+#       at module level, see requests_ecp.ecp
+
+
+def _default_path():
+    """Return the default location of the metadata index file.
+    """
+    cachedir = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cachedir) / "requests-ecp" / "metadata.idx"
+
+
+def iter_ecp_endpoints(source):
+    """Parse the ECP endpoints of the Identity Providers in some metadata.
+
+    The metadata are parsed incrementally, and each ``<EntityDescriptor>``
+    is discarded once it has been read, so that memory use doesn't
+    depend on the size of the document.
+
+    Parameters
+    ----------
+    source : `str`, `pathlib.Path`, file-like
+        The metadata document to parse.
+
+    Yields
+    ------
+    entityid : `str`
+        The entityID of the Identity Provider.
+
+    endpoint : `str`
+        The URL of the ECP (SAML2 SOAP) ``SingleSignOnService``.
+
+    scopes : `list` of `str`
+        The (non-regular-expression) scopes declared by the IdP.
+    """
+    from lxml import etree
+    if isinstance(source, Path):
+        source = str(source)
+    sso = etree.ETXPath(
+        "{{{md}}}IDPSSODescriptor/{{{md}}}SingleSignOnService".format(
+            **NAMESPACES,
+        ),
+    )
+    scope = etree.ETXPath(
+        "{{{md}}}IDPSSODescriptor/{{{md}}}Extensions/{{{shibmd}}}Scope".format(
+            **NAMESPACES,
+        ),
+    )
+    for _, elem in etree.iterparse(
+        source,
+        events=("end",),
+        tag="{{{md}}}EntityDescriptor".format(**NAMESPACES),
+        resolve_entities=False,
+        huge_tree=True,
+    ):
+        endpoint = next((
+            service.get("Location") for service in sso(elem)
+            if service.get("Binding") == SOAP_BINDING
+        ), None)
+        if endpoint:
+            yield (
+                elem.get("entityID"),
+                endpoint,
+                [
+                    s.text.strip() for s in scope(elem)
+                    if s.text and s.get("regexp", "false") != "true"
+                ],
+            )
+        # free the memory used by this entity and its predecessors
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def _index_keys(entityid, endpoint, scopes):
+    """Return the keys under which to index an Identity Provider.
+    """
+    yield entityid
+    yield urlparse(entityid).hostname
+    yield urlparse(endpoint).hostname
+    yield from scopes
+
+
+def _check_https(url):
+    """Raise a `ValueError` if a metadata URL isn't ``https://``.
+
+    The metadata signature isn't verified, so the document must come
+    from an authenticated server.
+    """
+    if urlparse(url).scheme != "https":
+        raise ValueError(
+            f"metadata must be downloaded over HTTPS, not '{url}'",
+        )
+
+
+class MetadataIndex:
+    """On-disk index of Identity Provider ECP endpoints.
+
+    The index is a sorted text file of ``key<TAB>endpoint`` lines that
+    is memory-mapped and binary-searched, so lookups are fast, and cost
+    no memory beyond the pages of the file that are touched.
+
+    Parameters
+    ----------
+    path : `str`, `pathlib.Path`, optional
+        The path of the index file, defaults to
+        ``~/.cache/requests-ecp/metadata.idx``.
+
+    Examples
+    --------
+    >>> index = MetadataIndex("/tmp/metadata.idx")
+    >>> index.build("federation-metadata.xml")
+    >>> index.resolve("login.example.org")
+    'https://login.example.org/idp/profile/SAML2/SOAP/ECP'
+    """
+    def __init__(self, path=None):
+        self.path = Path(path or _default_path())
+        self._mmap = None
+        self._start = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Release the memory map of the index file.
+        """
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = None
+
+    # -- building -----------
+
+    def build(self, source, **info):
+        """Build the index from a metadata document.
+
+        The new index replaces the existing one atomically, so readers
+        (in this or any other process) never see a partial index.
+
+        Parameters
+        ----------
+        source : `str`, `pathlib.Path`, file-like
+            The metadata document to index.
+
+        info
+            Other keyword arguments are recorded in the index header,
+            see `MetadataIndex.info`.
+
+        Returns
+        -------
+        count : `int`
+            The number of keys in the index.
+        """
+        entries = {}
+        for entityid, endpoint, scopes in iter_ecp_endpoints(source):
+            for key in _index_keys(entityid, endpoint, scopes):
+                if key and not any(c in key for c in "\t\n\r"):
+                    entries.setdefault(key.lower().encode("utf-8"), endpoint)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(
+            dir=str(self.path.parent),
+            prefix=self.path.name,
+        )
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(
+                    _HEADER_PREFIX
+                    + json.dumps(info).encode("utf-8")
+                    + b"\n",
+                )
+                for key in sorted(entries):
+                    file.write(
+                        key + b"\t" + entries[key].encode("utf-8") + b"\n",
+                    )
+            os.replace(tmp, str(self.path))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.close()  # the next lookup maps the new file
+        return len(entries)
+
+    def refresh(self, url, session=None, **kwargs):
+        """Rebuild the index from a remote metadata document, if it changed.
+
+        A conditional request is sent using the ``ETag`` and
+        ``Last-Modified`` of the document the index was last built from,
+        so an unchanged document isn't downloaded again.
+
+        The XML signature of the metadata document is *not* verified,
+        the document is trusted on the strength of the HTTPS connection
+        it is downloaded over, so only ``https://`` URLs are accepted.
+        To use a document whose signature has been verified separately
+        (e.g. with ``xmlsec1 --verify``), pass the local file to
+        :meth:`MetadataIndex.build`.
+
+        Parameters
+        ----------
+        url : `str`
+            The URL of the metadata document.
+
+        session : `requests.Session`, optional
+            The session to use to download the document.
+
+        kwargs
+            Other keyword arguments are passed to
+            :meth:`requests.Session.get`.
+
+        Returns
+        -------
+        updated : `bool`
+            `True` if the index was rebuilt, or `False` if the document
+            hasn't changed.
+
+        Raises
+        ------
+        ValueError
+            If ``url`` (or the URL it redirects to) isn't ``https://``.
+
+        requests.HTTPError
+            If the document can't be downloaded.
+        """
+        _check_https(url)
+        info = self.info
+        headers = kwargs.pop("headers", None) or {}
+        if info.get("url") == url:
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+            if info.get("last_modified"):
+                headers["If-Modified-Since"] = info["last_modified"]
+        get = requests.get if session is None else session.get
+        with get(url, headers=headers, stream=True, **kwargs) as response:
+            if response.status_code == 304:  # Not Modified
+                return False
+            response.raise_for_status()
+            _check_https(response.url)
+            response.raw.decode_content = True
+            self.build(
+                response.raw,
+                url=url,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+        return True
+
+    # -- lookups ------------
+
+    def _map(self):
+        """Return the memory map of the index file, mapping it if needed.
+        """
+        with self._lock:
+            if self._mmap is None:
+                with open(self.path, "rb") as file:
+                    self._mmap = mmap.mmap(
+                        file.fileno(),
+                        0,
+                        access=mmap.ACCESS_READ,
+                    )
+                self._start = self._mmap.find(b"\n") + 1
+            return self._mmap
+
+    @property
+    def info(self):
+        """The information recorded when the index was built.
+
+        This is an empty `dict` if the index doesn't exist.
+        """
+        try:
+            mm = self._map()
+        except FileNotFoundError:
+            return {}
+        header = mm[:self._start].rstrip(b"\n")
+        if not header.startswith(_HEADER_PREFIX):
+            return {}
+        return json.loads(header[len(_HEADER_PREFIX):])
+
+    def lookup(self, key):
+        """Return the ECP endpoint indexed under exactly ``key``.
+
+        Parameters
+        ----------
+        key : `str`
+            An entityID, host name, or scope.
+
+        Returns
+        -------
+        endpoint : `str`, `None`
+            The ECP endpoint URL, or `None` if ``key`` isn't indexed.
+        """
+        mm = self._map()
+        key = key.lower().encode("utf-8")
+        # binary search between line starts lo and hi
+        lo, hi = self._start, len(mm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = mm.rfind(b"\n", lo, mid) + 1 or lo
+            end = mm.find(b"\n", pos)
+            this, _, endpoint = mm[pos:end].partition(b"\t")
+            if this == key:
+                return endpoint.decode("utf-8")
+            if this < key:
+                lo = end + 1
+            else:
+                hi = pos
+        return None
+
+    def resolve(self, name):
+        """Resolve the ECP endpoint of an Identity Provider.
+
+        Parameters
+        ----------
+        name : `str`
+            The entityID, host name, or scope of the IdP; host names that
+            aren't indexed are also matched against the scopes of their
+            parent domains, e.g. ``login.example.org`` matches an IdP
+            with the scope ``example.org``.
+
+        Returns
+        -------
+        endpoint : `str`
+            The ECP endpoint URL.
+
+        Raises
+        ------
+        ValueError
+            If no Identity Provider matches ``name``.
+        FileNotFoundError
+            If the index hasn't been built.
+        """
+        name = name.strip()
+        endpoint = self.lookup(name)
+        if endpoint is None and "://" not in name and ":" not in name:
+            labels = name.split(".")
+            # stop before the top-level domain
+            for i in range(1, len(labels) - 1):
+                endpoint = self.lookup(".".join(labels[i:]))
+                if endpoint is not None:
+                    break
+        if endpoint is None:
+            raise ValueError(
+                f"no ECP endpoint found for {name!r} in {self.path}",
+            )
+        return endpoint
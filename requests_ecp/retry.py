@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp.
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Retry and circuit-breaking for requests to an Identity Provider.
+"""
+
+__author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
+
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from requests.exceptions import (
+    ConnectionError,
+    HTTPError,
+    Timeout,
+)
+
+#: HTTP status codes from an IdP that are worth retrying.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _is_transient(exc):
+    """Return `True` if an exception indicates a transient IdP failure.
+    """
+    if isinstance(exc, HTTPError):
+        return (
+            exc.response is not None
+            and exc.response.status_code in RETRY_STATUS_CODES
+        )
+    return isinstance(exc, (ConnectionError, Timeout))
+
+
+class CircuitOpenError(RuntimeError):
+    """Error raised when requests to an IdP are blocked by a
+    `CircuitBreaker`.
+    """
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker for requests to Identity Providers.
+
+    After ``threshold`` consecutive transient failures for a host the
+    circuit 'opens', and all requests to that host fail immediately with
+    a `CircuitOpenError` for ``reset_timeout`` seconds.
+    After that a single trial request is allowed through; if it succeeds
+    the circuit closes again, otherwise it stays open for another
+    ``reset_timeout`` seconds.
+
+    Parameters
+    ----------
+    threshold : `int`
+        The number of consecutive failures after which to open the circuit.
+
+    reset_timeout : `float`
+        The time (seconds) for which to block requests once the circuit
+        is open.
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        # (failures, opened) for each host
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def check(self, url, now=None):
+        """Raise a `CircuitOpenError` if requests to a host are blocked.
+        """
+        if now is None:
+            now = time.time()
+        host = urlparse(url).hostname
+        with self._lock:
+            failures, opened = self._state.get(host, (0, None))
+            if opened is None:
+                return
+            if now < opened + self.reset_timeout:
+                raise CircuitOpenError(
+                    f"{host} is unavailable after {failures} failures, "
+                    f"not retrying for {opened + self.reset_timeout - now:.0f}"
+                    " seconds",
+                )
+            # half-open: let this request through, but block others
+            # until it completes
+            self._state[host] = (failures, now)
+
+    def record_success(self, url):
+        """Record a successful request, closing the circuit for a host.
+        """
+        with self._lock:
+            self._state.pop(urlparse(url).hostname, None)
+
+    def record_failure(self, url, now=None):
+        """Record a failed request, opening the circuit if needed.
+        """
+        if now is None:
+            now = time.time()
+        host = urlparse(url).hostname
+        with self._lock:
+            failures, opened = self._state.get(host, (0, None))
+            failures += 1
+            if failures >= self.threshold:
+                opened = now
+            self._state[host] = (failures, opened)
+
+
+#: The process-wide circuit breaker shared by all `RetryPolicy` objects
+#: created with ``circuit_breaker=True``.
+CIRCUIT_BREAKER = CircuitBreaker()
+
+
+class RetryPolicy:
+    """Retry policy for requests to an Identity Provider.
+
+    Requests that fail with a connection error, timeout, or a
+    transient HTTP status (see `RETRY_STATUS_CODES`) are retried up to
+    ``retries`` times, waiting a random time of up to
+    ``backoff_factor * 2 ** attempt`` seconds (capped at ``backoff_max``)
+    before each retry, so that many clients don't retry in lock-step.
+
+    Parameters
+    ----------
+    retries : `int`
+        The maximum number of retries.
+
+    backoff_factor : `float`
+        The base backoff time (seconds).
+
+    backoff_max : `float`
+        The maximum backoff time (seconds).
+
+    circuit_breaker : `CircuitBreaker`, `bool`, optional
+        The circuit breaker to use, or `True` to use the process-wide
+        `CIRCUIT_BREAKER`.
+    """
+    def __init__(
+            self,
+            retries=3,
+            backoff_factor=0.5,
+            backoff_max=30,
+            circuit_breaker=None,
+    ):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        if circuit_breaker is True:
+            circuit_breaker = CIRCUIT_BREAKER
+        self.circuit_breaker = circuit_breaker
+
+    def backoff(self, attempt):
+        """Return the time (seconds) to wait before a retry.
+
+        Uses 'full jitter', a uniform random time between zero and the
+        exponential backoff time.
+        """
+        return random.uniform(0, min(
+            self.backoff_max,
+            self.backoff_factor * 2 ** attempt,
+        ))
+
+    def call(self, url, func, sleep=time.sleep):
+        """Call a function that makes a request to ``url``, with retries.
+
+        Returns
+        -------
+        result
+            The return value of ``func()``.
+        """
+        breaker = self.circuit_breaker
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.check(url)
+            try:
+                result = func()
+            except Exception as exc:
+                if not _is_transient(exc):
+                    # the IdP is up, even if it didn't like the request
+                    if breaker is not None:
+                        breaker.record_success(url)
+                    raise
+                if breaker is not None:
+                    breaker.record_failure(url)
+                if attempt >= self.retries:
+                    raise
+                if isinstance(exc, HTTPError):
+                    exc.response.close()
+                sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            if breaker is not None:
+                breaker.record_success(url)
+            return result
@@ -21,11 +21,60 @@
 
 __author__ = "Duncan Macleod <duncan.macleod@ligo.org>"
 
+import threading
+import time
+import warnings
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
 from requests import (
     Session as _Session,
 )
+from requests.adapters import HTTPAdapter
+
+from .auth import (
+    HTTPECPAuth,
+    _is_gitlab_sign_in,
+    is_ecp_auth_redirect,
+)
+from .cache import (
+    DEFAULT_LIFETIME,
+    SHIBBOLETH_SESSION_COOKIE_PREFIX,
+)
+from .ecp import _no_auth
+
+#: Interval (seconds) between attempts to refresh a session after
+#: a failed refresh.
+REFRESH_RETRY_INTERVAL = 30
+
+#: Time (seconds) since a Service Provider was last used, after which
+#: its session is no longer refreshed in the background.
+REFRESH_WINDOW = 3600
+
+#: Outcome of authenticating against one Service Provider, see
+#: :meth:`Session.ecp_authenticate_many`.
+ECPAuthResult = namedtuple("ECPAuthResult", ("url", "ok", "error", "elapsed"))
+
+#: Time (seconds) for which to cache the result of
+#: :meth:`Session.ecp_session_status`.
+SESSION_STATUS_TTL = 5
+
+#: Status of a Service Provider session, see
+#: :meth:`Session.ecp_session_status`.
+ECPSessionStatus = namedtuple("ECPSessionStatus", ("valid", "expires_in"))
 
-from .auth import HTTPECPAuth
+
+def _domain_match(host, domain):
+    """Return `True` if a cookie for ``domain`` is sent to ``host``.
+
+    ``domain`` matches itself and its subdomains only, so that
+    ``example.com`` doesn't match ``evilexample.com``.
+    """
+    host = host.lower()
+    domain = domain.lstrip(".").lower()
+    return host == domain or host.endswith("." + domain)
 
 
 class ECPAuthSessionMixin:
@@ -46,6 +95,24 @@ class ECPAuthSessionMixin:
     of the inheritance order that may impact which mixin preserves the final
     `~requests.Session.auth` attribute.
 
+    If ``refresh_margin`` is given, a background thread re-authenticates
+    each Service Provider session ``refresh_margin`` seconds before it is
+    expected to expire, so that requests on the session are not
+    redirected for ECP authentication when the session expires.
+    Sessions whose cookies don't declare an expiry time are assumed to
+    last for ``session_lifetime`` seconds.
+    Only sessions for hosts that were requested through this session
+    within the last ``refresh_window`` seconds are refreshed, idle
+    sessions are left to expire.
+
+    The connection pools can be configured with the ``pool_connections``,
+    ``pool_maxsize``, ``max_retries``, and ``pool_block`` keywords, see
+    `requests.adapters.HTTPAdapter` for details.
+    If any of these are given, the Identity Provider is also given its
+    own connection pool (sized by ``idp_pool_maxsize``, if given) so that
+    ECP requests to the IdP are never starved by bulk traffic to the
+    Service Providers.
+
     See also
     --------
     requests_ecp.Session
@@ -57,15 +124,174 @@ class ECPAuthSessionMixin:
             kerberos=False,
             username=None,
             password=None,
+            cookie_cache=None,
+            refresh_margin=None,
+            refresh_window=REFRESH_WINDOW,
+            session_lifetime=DEFAULT_LIFETIME,
+            credentials=None,
+            idp_session=True,
+            retry=None,
+            trace=None,
+            paos_hosts=None,
+            metadata=None,
+            gitlab_hosts=None,
+            pool_connections=None,
+            pool_maxsize=None,
+            max_retries=None,
+            pool_block=None,
+            idp_pool_maxsize=None,
             **kwargs,
     ):
+        if refresh_margin is not None and refresh_margin >= session_lifetime:
+            raise ValueError(
+                "refresh_margin must be less than session_lifetime",
+            )
         super().__init__(**kwargs)
         self.auth = HTTPECPAuth(
             idp,
             kerberos=kerberos,
             username=username,
             password=password,
+            cookie_cache=cookie_cache,
+            session_lifetime=session_lifetime,
+            credentials=credentials,
+            idp_session=idp_session,
+            retry=retry,
+            trace=trace,
+            paos_hosts=paos_hosts,
+            metadata=metadata,
+            gitlab_hosts=gitlab_hosts,
         )
+        self._mount_adapters(
+            self.auth.idp,
+            idp_pool_maxsize=idp_pool_maxsize,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries,
+            pool_block=pool_block,
+        )
+        self._session_status = {}
+        self._last_used = {}
+        self.refresh_margin = refresh_margin
+        self.refresh_window = refresh_window
+        self._refresh_stop = threading.Event()
+        self._refresh_thread = None
+        if refresh_margin is not None:
+            # the thread only holds a weak reference to this session,
+            # so that an unclosed session can still be garbage-collected
+            self._refresh_thread = threading.Thread(
+                target=_refresh_loop,
+                args=(weakref.ref(self), self._refresh_stop),
+                name="requests-ecp-refresh",
+                daemon=True,
+            )
+            weakref.finalize(self, self._refresh_stop.set)
+            self._refresh_thread.start()
+
+    def send(self, request, **kwargs):
+        self._last_used[urlparse(request.url).hostname] = time.time()
+        return super().send(request, **kwargs)
+
+    def close(self):
+        self._refresh_stop.set()
+        thread = self._refresh_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        super().close()
+
+    # -- connection pools ---
+
+    def _mount_adapters(self, idp, idp_pool_maxsize=None, **pool_kw):
+        """Mount connection adapters with custom pool settings.
+
+        Does nothing if no pool settings are given.
+        """
+        pool_kw = {k: v for k, v in pool_kw.items() if v is not None}
+        if not pool_kw and idp_pool_maxsize is None:
+            return
+        for prefix in ("https://", "http://"):
+            self.mount(prefix, HTTPAdapter(**pool_kw))
+
+        if not idp:
+            return
+        # mount a dedicated adapter for the IdP, only one host
+        # so only one pool is needed
+        pool_kw["pool_connections"] = 1
+        if idp_pool_maxsize is not None:
+            pool_kw["pool_maxsize"] = idp_pool_maxsize
+        adapter = HTTPAdapter(**pool_kw)
+        parts = urlparse(idp)
+        self.mount(f"{parts.scheme}://{parts.netloc}/", adapter)
+        self.auth.idp_adapter = adapter
+
+    # -- session refresh ----
+
+    def _ecp_refresh(self, url):
+        """Re-authenticate the Service Provider session for a URL.
+
+        The ECP round-trip is executed on a scratch session that shares
+        this session's connection pools and settings, but not its cookies,
+        so that the Service Provider doesn't see the current (valid)
+        session; the new session cookies then replace the old ones.
+        """
+        scratch = _Session()
+        scratch.adapters = self.adapters
+        for attr in ("headers", "proxies", "verify", "cert", "trust_env"):
+            setattr(scratch, attr, getattr(self, attr))
+        self.auth._authenticate_session(scratch, url=url)
+        for cookie in scratch.cookies:
+            self.cookies.set_cookie(cookie)
+
+    def _refresh_sessions(self, now=None):
+        """Refresh all recently-used Service Provider sessions that are
+        due to expire.
+
+        Returns
+        -------
+        wait : `float`
+            The time (seconds) until the next session is due to be
+            refreshed.
+        """
+        if now is None:
+            now = time.time()
+        margin = self.refresh_margin
+        wait = margin
+        sessions = getattr(self.auth, "sessions", {})
+        for host, (url, expiry) in list(sessions.items()):
+            # leave sessions for idle hosts to expire
+            last_used = self._last_used.get(host)
+            if last_used is None or now - last_used > self.refresh_window:
+                continue
+            due = expiry - margin
+            if due > now:
+                wait = min(wait, due - now)
+                continue
+            try:
+                self._ecp_refresh(url)
+            except Exception as exc:
+                warnings.warn(
+                    f"failed to refresh ECP session for {host}: {exc}",
+                )
+                wait = min(wait, REFRESH_RETRY_INTERVAL)
+        # don't spin if the SP hands out sessions shorter than the margin
+        return max(wait, 1)
+
+
+def _refresh_loop(ref, stop):
+    """Refresh the sessions of a weakly-referenced session until stopped.
+    """
+    wait = 0
+    while not stop.wait(wait):
+        session = ref()
+        if session is None:  # garbage-collected
+            return
+        try:
+            wait = session._refresh_sessions()
+        except Exception as exc:  # never let the thread die
+            warnings.warn(f"failed to refresh ECP sessions: {exc}")
+            wait = REFRESH_RETRY_INTERVAL
+        # don't keep the session alive while waiting
+        del session
 
 
 class Session(ECPAuthSessionMixin, _Session):
@@ -118,3 +344,141 @@ class Session(ECPAuthSessionMixin, _Session):
             url=url,
             **kwargs
         )
+
+    def ecp_authenticate_many(self, urls, endpoint=None, max_workers=8):
+        """Manually authenticate against many Service Providers in parallel.
+
+        The ECP round-trip for each URL is executed on a thread pool,
+        with the Identity Provider credentials set up only once (up front).
+
+        Parameters
+        ----------
+        urls : `list` of `str`
+            The URLs of resources (on each Service Provider) to request.
+
+        endpoint : `str`
+            The URL of the ECP endpoint on the Identity Provider.
+            If not given it will be taken from the ``auth`` attribute.
+
+        max_workers : `int`
+            The maximum number of concurrent authentications.
+
+        Returns
+        -------
+        results : `list` of `ECPAuthResult`
+            One ``(url, ok, error, elapsed)`` record per URL, in the same
+            order as ``urls``; ``error`` is the exception raised by a failed
+            authentication (or `None`), and ``elapsed`` is the time taken
+            in seconds.
+        """
+        if not isinstance(self.auth, HTTPECPAuth):
+            raise ValueError(
+                f"Cannot execute ECP authentication with {type(self.auth)}",
+            )
+        # set up the credentials now, so that any prompt happens once
+        # in the calling thread
+        self.auth._get_idpauth()
+
+        def _authenticate(url):
+            start = time.perf_counter()
+            try:
+                self.ecp_authenticate(url, endpoint=endpoint)
+            except Exception as exc:
+                return ECPAuthResult(
+                    url,
+                    False,
+                    exc,
+                    time.perf_counter() - start,
+                )
+            return ECPAuthResult(url, True, None, time.perf_counter() - start)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(_authenticate, urls))
+
+    def ecp_session_status(self, url, ttl=SESSION_STATUS_TTL):
+        """Check whether this session is authenticated with a Service Provider.
+
+        The check is made with a ``HEAD`` request (that is never itself
+        authenticated, but carries the known session cookies, including
+        those from the ``cookie_cache``) and the result is cached for
+        ``ttl`` seconds
+        (or until a new session is established), so this can be called
+        frequently.
+
+        Parameters
+        ----------
+        url : `str`
+            The URL of a resource on the Service Provider.
+
+        ttl : `float`
+            The time (seconds) for which to reuse the result of a check
+            for the same Service Provider.
+
+        Returns
+        -------
+        status : `ECPSessionStatus`
+            A ``(valid, expires_in)`` tuple, where ``valid`` is `True` if
+            the Service Provider accepted the session, and ``expires_in``
+            is the time (seconds) until the session is expected to
+            expire, or `None` if that isn't known.
+        """
+        host = urlparse(url).hostname
+        now = time.time()
+        # the ECP session recorded for this host, a new session
+        # invalidates the cached result
+        session = getattr(self.auth, "sessions", {}).get(host)
+        try:
+            checked, valid, expiry, checked_session = (
+                self._session_status[host]
+            )
+        except KeyError:
+            checked = None
+        if (
+            checked is None
+            or now >= checked + ttl
+            or session != checked_session
+        ):
+            response = self.head(
+                url,
+                auth=self._ecp_cookies_only,
+                allow_redirects=False,
+            )
+            response.close()
+            # a redirect to log in means there is no valid session
+            valid = (
+                response.status_code < 400
+                and not is_ecp_auth_redirect(response)
+                and not _is_gitlab_sign_in(response)
+            )
+            expiry = self._ecp_session_expiry(host) if valid else None
+            self._session_status[host] = (now, valid, expiry, session)
+        return ECPSessionStatus(
+            valid,
+            None if expiry is None else max(expiry - now, 0),
+        )
+
+    def _ecp_cookies_only(self, request):
+        """Attach the known session cookies to a request, without
+        registering the ECP response handler.
+        """
+        try:
+            add_cookies = self.auth._add_cookies
+        except AttributeError:  # not ECP auth
+            return _no_auth(request)
+        add_cookies(request)
+        return request
+
+    def _ecp_session_expiry(self, host):
+        """Return the expected expiry time of the session for a host.
+        """
+        try:
+            return self.auth.sessions[host][1]
+        except (AttributeError, KeyError):
+            pass
+        expires = [
+            cookie.expires for cookie in self.cookies
+            if cookie.name.startswith(SHIBBOLETH_SESSION_COOKIE_PREFIX)
+            and cookie.expires
+            and _domain_match(host, cookie.domain)
+        ]
+        return min(expires, default=None)
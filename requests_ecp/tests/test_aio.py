@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for requests_ecp.aio.
+"""
+
+import asyncio
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from requests_ecp import aio as requests_ecp_aio  # noqa: E402
+
+from .test_ecp import (  # noqa: E402
+    IDP_ECP_SOAP_RESPONSE,
+    SP_ECP_PAOS_RESPONSE,
+)
+
+IDP = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+
+
+def mock_service(request):
+    """Mock a Shibboleth-protected SP and its IdP.
+    """
+    url = str(request.url)
+    if url == IDP:
+        assert request.headers["Authorization"].startswith("Basic ")
+        return httpx.Response(200, content=IDP_ECP_SOAP_RESPONSE)
+    if url == "https://example.com/Shibboleth.sso/SAML2/ECP":
+        return httpx.Response(
+            302,
+            headers={
+                "Location": "https://example.com/data",
+                "Set-Cookie": "_shibsession_abc=123; Path=/",
+            },
+        )
+    if "PAOS" in request.headers:
+        return httpx.Response(200, content=SP_ECP_PAOS_RESPONSE)
+    if "_shibsession_abc=123" in request.headers.get("Cookie", ""):
+        return httpx.Response(200, text="data")
+    if url == "https://example.com/Shibboleth.sso/Login":
+        return httpx.Response(200, text="login page")
+    return httpx.Response(
+        302,
+        headers={"Location": "https://example.com/Shibboleth.sso/Login"},
+    )
+
+
+@pytest.mark.parametrize(("response", "result"), [
+    (httpx.Response(200), False),
+    (httpx.Response(304), False),
+    (httpx.Response(302, headers={"Location": "https://example.com/"}), False),
+    (httpx.Response(
+        302,
+        headers={"Location": "https://idp.test.com/?SAMLRequest=1"},
+    ), True),
+])
+def test_is_ecp_auth_redirect(response, result):
+    assert requests_ecp_aio.is_ecp_auth_redirect(response) is result
+
+
+class TestAsyncSession:
+    TEST_CLASS = requests_ecp_aio.AsyncSession
+
+    def _session(self):
+        return self.TEST_CLASS(
+            idp=IDP,
+            username="user",
+            password="passwd",
+            transport=httpx.MockTransport(mock_service),
+        )
+
+    def test_get(self):
+        """Test that an ECP redirect is intercepted and the request replayed.
+        """
+        async def _get():
+            async with self._session() as sess:
+                resp = await sess.get("https://example.com/data")
+                # check that the session cookie was stored
+                assert sess.cookies["_shibsession_abc"] == "123"
+                return resp
+
+        resp = asyncio.run(_get())
+        assert resp.status_code == 200
+        assert resp.text == "data"
+        # original request, then ECP x 3, before the replayed request
+        assert [r.status_code for r in resp.history] == [302, 200, 200, 302]
+
+    def test_get_follow_redirects(self):
+        """Test that an ECP redirect followed by the client is handled.
+        """
+        async def _get():
+            async with self.TEST_CLASS(
+                idp=IDP,
+                username="user",
+                password="passwd",
+                transport=httpx.MockTransport(mock_service),
+                follow_redirects=True,
+            ) as sess:
+                return await sess.get("https://example.com/data")
+
+        resp = asyncio.run(_get())
+        assert resp.status_code == 200
+        assert resp.text == "data"
+
+    def test_get_single_flight(self):
+        """Test that concurrent ECP redirects only trigger one login.
+        """
+        idp_requests = []
+
+        async def _service(request):
+            if str(request.url) == IDP:
+                idp_requests.append(request)
+            # let the other requests run
+            await asyncio.sleep(0.01)
+            return mock_service(request)
+
+        async def _get():
+            async with self.TEST_CLASS(
+                idp=IDP,
+                username="user",
+                password="passwd",
+                transport=httpx.MockTransport(_service),
+            ) as sess:
+                return await asyncio.gather(*(
+                    sess.get("https://example.com/data") for _ in range(5)
+                ))
+
+        assert [resp.text for resp in asyncio.run(_get())] == ["data"] * 5
+        assert len(idp_requests) == 1
+
+    def test_ecp_authenticate(self):
+        """Test that `AsyncSession.ecp_authenticate` stores the session cookie.
+        """
+        async def _auth():
+            async with self._session() as sess:
+                await sess.ecp_authenticate("https://example.com/data")
+                return (await sess.get("https://example.com/data")).text
+
+        assert asyncio.run(_auth()) == "data"
+
+    def test_sync_client(self):
+        """Test that `AsyncHTTPECPAuth` also works with `httpx.Client`.
+        """
+        auth = requests_ecp_aio.AsyncHTTPECPAuth(
+            IDP,
+            username="user",
+            password="passwd",
+        )
+        with httpx.Client(
+            auth=auth,
+            transport=httpx.MockTransport(mock_service),
+        ) as client:
+            assert client.get("https://example.com/data").text == "data"
+
+    def test_sync_client_follow_redirects(self):
+        """Test that `httpx.Client` redirects followed per-request
+        are handled.
+        """
+        auth = requests_ecp_aio.AsyncHTTPECPAuth(
+            IDP,
+            username="user",
+            password="passwd",
+        )
+        with httpx.Client(
+            auth=auth,
+            transport=httpx.MockTransport(mock_service),
+        ) as client:
+            assert client.get(
+                "https://example.com/data",
+                follow_redirects=True,
+            ).text == "data"
@@ -19,17 +19,32 @@
 """Tests for requests_ecp.auth.
 """
 
+import threading
+import time
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
 
 import requests
-from requests.auth import HTTPBasicAuth
+from requests.auth import (
+    HTTPBasicAuth,
+    _basic_auth_str,
+)
+from requests.cookies import create_cookie
+from requests.exceptions import UnrewindableBodyError
 
 from requests_mock import CookieJar as MockCookieJar
+from urllib3 import HTTPResponse
 
 import requests_ecp
 from requests_ecp import auth as requests_ecp_auth
+from requests_ecp.credentials import PromptCredentials
+from .test_ecp import (
+    IDP_ECP_SOAP_RESPONSE,
+    SP_ECP_PAOS_RESPONSE,
+)
 
 
 def mock_authenticate_response(url):
@@ -151,21 +166,91 @@ def test_is_gitlab_auth_redirect_false(requests_mock, response_kwargs):
     assert not requests_ecp_auth.is_gitlab_auth_redirect(resp)
 
 
+def _stream_response(body, **headers):
+    response = requests.Response()
+    response.status_code = 302
+    response.headers.update(headers)
+    response.raw = HTTPResponse(
+        body=BytesIO(body),
+        preload_content=False,
+    )
+    response.raw.release_conn = mock.Mock()
+    return response
+
+
+def test_drain():
+    """Test that `_drain` reads small bodies to reuse the connection.
+    """
+    response = _stream_response(b"x" * 100)
+    requests_ecp_auth._drain(response)
+    assert response.raw.tell() == 100
+    response.raw.release_conn.assert_called_once()
+
+
+@pytest.mark.parametrize("headers", [
+    {"Content-Length": str(2**20)},
+    {},  # unknown length
+])
+def test_drain_large(headers):
+    """Test that `_drain` doesn't read large bodies.
+    """
+    response = _stream_response(b"x" * 2**20, **headers)
+    requests_ecp_auth._drain(response)
+    assert response.raw.tell() <= requests_ecp_auth.DRAIN_LIMIT + 8192
+    assert response.raw.closed
+
+
+@mock.patch(
+    "requests_ecp.auth._kerberos_credentials",
+    return_value=(None, 100),
+)
+@mock.patch("requests_ecp.auth._import_kerberos_auth")
+def test_kerberos_auth_cache(import_auth, credentials):
+    """Test that `KerberosAuthCache` shares credentials, but not plugins.
+    """
+    import_auth.return_value = mock.Mock
+    cache = requests_ecp_auth.KerberosAuthCache()
+
+    auth = cache.get("https://idp.test.com/idp/profile/SAML2/SOAP/ECP", now=0)
+    assert auth.hostname_override == "idp.test.com"
+    other = cache.get("https://idp.test.com/other", now=50)
+    assert other is not auth
+    assert other.hostname_override == "idp.test.com"
+    assert cache.get(
+        "https://idp2.test.com",
+        now=50,
+    ).hostname_override == "idp2.test.com"
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert credentials.call_count == 1
+
+    # credentials are only reused for their lifetime
+    cache.get("https://idp.test.com", now=101)
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert credentials.call_count == 2
+
+    cache.clear()
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
 class TestHTTPECPAuth(object):
     TEST_CLASS = requests_ecp.HTTPECPAuth
 
     # -- test init ----------
 
+    @mock.patch.dict("requests_ecp.credentials._CACHE", clear=True)
+    @mock.patch("requests_ecp.credentials._interactive", return_value=True)
     @mock.patch("requests_ecp.auth.input", return_value="user")
     @mock.patch("requests_ecp.auth.getpass", return_value="passwd")
-    def test_init_auth(self, input_, getpass_):
+    def test_init_auth(self, input_, getpass_, _):
         auth = self.TEST_CLASS._init_auth("https://idp.test.com")
         assert isinstance(auth, HTTPBasicAuth)
         assert auth.username == "user"
         assert auth.password == "passwd"
 
+    @mock.patch.dict("requests_ecp.credentials._CACHE", clear=True)
+    @mock.patch("requests_ecp.credentials._interactive", return_value=True)
     @mock.patch("requests_ecp.auth.getpass", return_value="passwd")
-    def test_init_auth_username(self, getpass_):
+    def test_init_auth_username(self, getpass_, _):
         auth = self.TEST_CLASS._init_auth(
             "https://idp.test.com",
             username="me",
@@ -174,6 +259,86 @@ class TestHTTPECPAuth(object):
         assert auth.username == "me"
         assert auth.password == "passwd"
 
+    @mock.patch.dict("requests_ecp.credentials._CACHE", clear=True)
+    @mock.patch("requests_ecp.credentials._interactive", return_value=False)
+    @mock.patch("requests_ecp.auth.input")
+    def test_init_auth_noninteractive(self, input_, _):
+        """Test that `HTTPECPAuth` doesn't prompt when not interactive.
+        """
+        with pytest.raises(RuntimeError, match="no credentials found"):
+            self.TEST_CLASS._init_auth(
+                "https://idp.test.com",
+                credentials=[PromptCredentials()],
+            )
+        input_.assert_not_called()
+
+    @mock.patch.dict("requests_ecp.credentials._CACHE", clear=True)
+    def test_authenticate_rejected_credentials(self, requests_mock):
+        """Test that credentials rejected by the IdP are asked for again.
+        """
+        idp = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+        requests_mock.get(
+            "https://example.com/data",
+            content=SP_ECP_PAOS_RESPONSE,
+        )
+        requests_mock.post(idp, status_code=401)
+        provider = mock.Mock(side_effect=[
+            ("user", "wrong"),
+            ("user", "passwd"),
+        ])
+        auth = self.TEST_CLASS(idp=idp, credentials=[provider])
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                auth._authenticate(
+                    requests_mock._adapter,
+                    url="https://example.com/data",
+                )
+        assert provider.call_count == 2
+        assert [
+            req.headers["Authorization"]
+            for req in requests_mock.request_history if req.url == idp
+        ] == [
+            _basic_auth_str("user", "wrong"),
+            _basic_auth_str("user", "passwd"),
+        ]
+
+    def test_authenticate_idp_without_sessions(self, requests_mock):
+        """Test that an IdP that never accepts its cookies alone is only
+        sent credentials after it has rejected them once.
+        """
+        idp = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+        requests_mock.get(
+            "https://example.com/data",
+            content=SP_ECP_PAOS_RESPONSE,
+        )
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"location": "https://example.com/data"},
+        )
+        requests_mock.post(
+            idp,
+            content=IDP_ECP_SOAP_RESPONSE,
+            cookies={"JSESSIONID": "abc"},
+            additional_matcher=lambda r: "Authorization" in r.headers,
+        )
+        requests_mock.post(
+            idp,
+            status_code=401,
+            additional_matcher=lambda r: "Authorization" not in r.headers,
+        )
+        auth = self.TEST_CLASS(idp=idp, username="user", password="passwd")
+        for _ in range(3):
+            auth._authenticate(
+                requests_mock._adapter,
+                url="https://example.com/data",
+            )
+        assert [
+            "Authorization" in req.headers
+            for req in requests_mock.request_history if req.url == idp
+        ] == [True, False, True, True]
+        assert auth._idp_session is False
+
     def test_init_auth_username_password(self):
         auth = self.TEST_CLASS._init_auth(
             "https://idp.test.com",
@@ -218,6 +383,79 @@ class TestHTTPECPAuth(object):
 
     # -- test handle_response
 
+    @mock.patch("requests_ecp.auth.is_ecp_auth_redirect")
+    @mock.patch("requests_ecp.auth.is_gitlab_auth_redirect")
+    def test_handle_response_fast_path(self, is_gitlab, is_ecp):
+        """Test that non-redirect responses are returned without inspection.
+        """
+        response = requests.Response()
+        response.status_code = 200
+        auth = self.TEST_CLASS(idp="test")
+        assert auth.handle_response(response) is response
+        is_gitlab.assert_not_called()
+        is_ecp.assert_not_called()
+
+    @mock.patch("requests_ecp.auth.is_paos_response")
+    def test_hook_fast_path(self, is_paos):
+        """Test that the registered hook doesn't inspect a response to
+        a request that wasn't sent with PAOS headers.
+        """
+        auth = self.TEST_CLASS(idp="test")
+        request = auth(requests.Request("GET", "https://test").prepare())
+        hook, = request.hooks["response"]
+        assert not hook.paos
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        assert hook(response) is response
+        is_paos.assert_not_called()
+
+    def test_call_registers_hook_once(self):
+        """Test that `HTTPECPAuth.__call__` doesn't duplicate the hook.
+        """
+        auth = self.TEST_CLASS(idp="test")
+        request = requests.Request("GET", "https://test").prepare()
+        auth(auth(request))
+        hook, = request.hooks["response"]
+        assert hook.auth is auth
+
+    @mock.patch(
+        "requests_ecp.auth.is_ecp_auth_redirect",
+        return_value=True,
+    )
+    def test_handle_response_per_request_state(self, _):
+        """Test that each request is authenticated at most once, regardless
+        of other requests sharing the auth.
+        """
+        auth = self.TEST_CLASS(idp="test")
+        first = auth(requests.Request("GET", "https://test/a").prepare())
+        # preparing another request doesn't reset the first one
+        second = auth(requests.Request("GET", "https://test/b").prepare())
+
+        def _redirect(request):
+            response = requests.Response()
+            response.status_code = 302
+            response.url = request.url
+            response.request = request
+            return response
+
+        with mock.patch.object(
+            self.TEST_CLASS,
+            "_handle_ecp_redirect",
+            side_effect=lambda response, **kwargs: response,
+        ) as handle:
+            for request in (first, first, second):
+                requests.hooks.dispatch_hook(
+                    "response",
+                    request.hooks,
+                    _redirect(request),
+                )
+
+        # once for each request, the second redirect for the first
+        # request is passed through
+        assert handle.call_count == 2
+        assert auth._num_ecp_auth == 2
+
     @mock.patch(
         "requests_ecp.auth.is_ecp_auth_redirect",
         return_value=False,
@@ -242,7 +480,7 @@ class TestHTTPECPAuth(object):
         return_value=mock_authenticate_response("https://test"),
     )
     def test_handle_response_auth(self, mock_authenticate, _, requests_mock):
-        requests_mock.get("https://test")
+        requests_mock.get("https://test", status_code=302)
         with requests.Session() as session:
             session.auth = self.TEST_CLASS(
                 idp="test",
@@ -256,6 +494,8 @@ class TestHTTPECPAuth(object):
             requests_mock._adapter,
             endpoint=None,
             url="https://test/",
+            cookies=mock.ANY,
+            idp_connection=None,
             timeout=mock.ANY,
             verify=mock.ANY,
             proxies=mock.ANY,
@@ -267,3 +507,458 @@ class TestHTTPECPAuth(object):
         assert response.headers['location'] == "https://test"
         # make sure that we log that we did the auth loop
         assert session.auth._num_ecp_auth
+
+    def test_call_paos(self):
+        """Test that PAOS headers are sent on first contact with known SPs.
+        """
+        auth = self.TEST_CLASS(
+            idp="test",
+            paos_hosts=["https://example.com/data"],
+        )
+
+        def _prepare(url):
+            return auth(requests.Request(
+                "GET",
+                url,
+                headers={"Accept": "application/json"},
+            ).prepare())
+
+        headers = _prepare("https://example.com/data/file").headers
+        assert headers["Accept"] == "application/json, {}".format(
+            requests_ecp_auth.PAOS_MEDIA_TYPE,
+        )
+        assert "PAOS" in headers
+        # other paths and hosts are left alone
+        assert "PAOS" not in _prepare("https://example.com/other").headers
+        assert "PAOS" not in _prepare("https://example.org/data").headers
+        # as are hosts with a current session
+        auth.sessions["example.com"] = (
+            "https://example.com/data",
+            time.time() + 60,
+        )
+        headers = _prepare("https://example.com/data/file").headers
+        assert "PAOS" not in headers
+        assert headers["Accept"] == "application/json"
+
+    @mock.patch(
+        "requests_ecp.auth.is_ecp_auth_redirect",
+        return_value=True,
+    )
+    @mock.patch(
+        "requests_ecp.auth.HTTPECPAuth._authenticate",
+        return_value=mock_authenticate_response("https://test/data/file"),
+    )
+    def test_handle_response_learn_paos(self, _, __, requests_mock):
+        """Test that `HTTPECPAuth` learns which hosts are protected by ECP.
+        """
+        requests_mock.get("https://test/data/file", status_code=302)
+        auth = self.TEST_CLASS(idp="test", username="user", password="pass")
+        with requests.Session() as session:
+            session.auth = auth
+            session.get("https://test/data/file", allow_redirects=False)
+            # expire the session
+            auth.sessions["test"] = ("https://test/data/file", 0)
+            request = session.prepare_request(
+                requests.Request("GET", "https://test/data/other"),
+            )
+        assert "PAOS" in request.headers
+        assert auth.counters["redirects"] == 1
+
+    def test_handle_response_paos(self, requests_mock):
+        """Test that a direct PAOS response from an SP is handled.
+        """
+        url = "https://example.com/data"
+        idp = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+
+        # the SP sends the <AuthnRequest> straight away if asked
+        requests_mock.get(
+            url,
+            content=SP_ECP_PAOS_RESPONSE,
+            headers={"Content-Type": requests_ecp_auth.PAOS_MEDIA_TYPE},
+            additional_matcher=lambda r: "PAOS" in r.headers,
+        )
+        requests_mock.get(
+            url,
+            text="data",
+            additional_matcher=lambda r: "PAOS" not in r.headers,
+        )
+        requests_mock.post(idp, content=IDP_ECP_SOAP_RESPONSE)
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"Location": url},
+            cookies={"_shibsession_abc": "123"},
+        )
+
+        with requests.Session() as session:
+            session.auth = auth = self.TEST_CLASS(
+                idp=idp,
+                username="user",
+                password="passwd",
+                paos_hosts=["example.com"],
+            )
+            response = session.get(url)
+
+        assert response.text == "data"
+        assert [r.status_code for r in response.history] == [302]
+        # one request less than via a redirect
+        assert requests_mock.call_count == 4
+        assert auth.counters["paos"] == 1
+        assert auth.counters["redirects"] == 0
+        assert "example.com" in auth.sessions
+        # the resource was requested again without the PAOS headers
+        last = requests_mock.last_request
+        assert "PAOS" not in last.headers
+        assert last.headers["Accept"] == "*/*"
+
+    def test_handle_response_gitlab(self, requests_mock):
+        """Test that GitLab hosts are signed in to at the Shibboleth callback.
+        """
+        api = "https://git.example.com/api/v4/user"
+        callback = "https://git.example.com/users/auth/shibboleth/callback"
+        idp = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+
+        def _signed_in(request):
+            return "_gitlab_session=abc" in request.headers.get("Cookie", "")
+
+        requests_mock.get(
+            api,
+            status_code=401,
+            additional_matcher=lambda r: not _signed_in(r),
+        )
+        requests_mock.get(api, json={"id": 1}, additional_matcher=_signed_in)
+        # the callback is protected by the SP
+        requests_mock.get(
+            callback,
+            content=SP_ECP_PAOS_RESPONSE,
+            additional_matcher=lambda r: "PAOS" in r.headers,
+        )
+        requests_mock.post(idp, content=IDP_ECP_SOAP_RESPONSE)
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"Location": callback},
+            cookies={"_shibsession_abc": "123"},
+        )
+        # and signs in to gitlab given an SP session
+        requests_mock.get(
+            callback,
+            status_code=302,
+            headers={"Location": "https://git.example.com/"},
+            cookies={"_gitlab_session": "abc"},
+            additional_matcher=lambda r: "_shibsession_abc=123" in (
+                r.headers.get("Cookie", "")
+            ),
+        )
+
+        auth = self.TEST_CLASS(
+            idp=idp,
+            username="user",
+            password="passwd",
+            gitlab_hosts=["git.example.com"],
+        )
+        with requests.Session() as session:
+            session.auth = auth
+            response = session.get(api)
+        assert response.json() == {"id": 1}
+        assert response.history[0].status_code == 401
+        # 401, PAOS, IdP, ACS, callback, replay
+        assert requests_mock.call_count == 6
+        assert auth.counters["redirects"] == 0
+
+        # the gitlab session is reused by a new requests session
+        with requests.Session() as session:
+            session.auth = auth
+            assert session.get(api).json() == {"id": 1}
+        assert requests_mock.call_count == 7
+
+    def test_handle_response_cookie_cache(self, requests_mock, tmp_path):
+        """Test that an ECP redirect is handled using cached cookies.
+        """
+        idp = "https://idp.test.com/ECP"
+        cache = requests_ecp.CookieCache(tmp_path / "cookies.json")
+        auth = self.TEST_CLASS(idp=idp, cookie_cache=cache)
+
+        # the SP redirects unless it gets a session cookie
+        requests_mock.get(
+            "https://test.com/data",
+            status_code=302,
+            headers={"Location": "https://test.com/Shibboleth.sso/Login"},
+            additional_matcher=lambda r: "Cookie" not in r.headers,
+        )
+        requests_mock.get(
+            "https://test.com/data",
+            text="data",
+            additional_matcher=lambda r: "Cookie" in r.headers,
+        )
+
+        with requests.Session() as session:
+            session.auth = auth
+            # prepare a request with an empty cache
+            request = session.prepare_request(
+                requests.Request("GET", "https://test.com/data"),
+            )
+            assert "Cookie" not in request.headers
+            # then have another process populate the cache
+            cache.store(
+                "https://test.com",
+                idp,
+                [create_cookie("_shibsession_abc", "123")],
+            )
+            response = session.send(request)
+
+        assert response.text == "data"
+        assert response.history[0].status_code == 302
+        assert requests_mock.last_request.headers["Cookie"] == (
+            "_shibsession_abc=123"
+        )
+
+    def test_handle_response_stream(self, requests_mock, tmp_path):
+        """Test that a large redirect body isn't read, and that the
+        replayed response is still streamed.
+        """
+        idp = "https://idp.test.com/ECP"
+        cache = requests_ecp.CookieCache(tmp_path / "cookies.json")
+        cache.store(
+            "https://test.com",
+            idp,
+            [create_cookie("_shibsession_abc", "123")],
+        )
+        auth = self.TEST_CLASS(idp=idp, cookie_cache=cache)
+
+        requests_mock.get(
+            "https://test.com/data",
+            status_code=302,
+            headers={"Location": "https://test.com/Shibboleth.sso/Login"},
+            content=b"x" * 2**20,
+            additional_matcher=lambda r: "Cookie" not in r.headers,
+        )
+        requests_mock.get(
+            "https://test.com/data",
+            content=b"data",
+            additional_matcher=lambda r: "Cookie" in r.headers,
+        )
+
+        with requests.Session() as session:
+            session.auth = auth
+            request = session.prepare_request(
+                requests.Request("GET", "https://test.com/data"),
+            )
+            # remove the cached cookie from the request, as if it
+            # had been prepared before the cache was populated
+            request.headers.pop("Cookie")
+            request._cookies.clear()
+            response = session.send(request, stream=True)
+
+        redirect = response.history[0]
+        assert redirect.raw.tell() <= requests_ecp_auth.DRAIN_LIMIT + 8192
+        assert not response._content_consumed
+        assert response.raw.read() == b"data"
+
+    @pytest.mark.parametrize("body", [
+        b"upload",
+        BytesIO(b"upload"),
+    ])
+    def test_handle_response_replay_post(self, requests_mock, body):
+        """Test that a POST is replayed in full after ECP authentication.
+        """
+        url = "https://example.com/data"
+        idp = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+
+        def _no_session(request):
+            if "Cookie" in request.headers:
+                return False
+            if hasattr(request.body, "read"):  # consume the upload
+                request.body.read()
+            return True
+
+        # the SP redirects unless it gets a session cookie
+        requests_mock.post(
+            url,
+            status_code=302,
+            headers={"Location": "https://example.com/Shibboleth.sso/Login"},
+            additional_matcher=_no_session,
+        )
+        requests_mock.post(
+            url,
+            status_code=201,
+            additional_matcher=lambda r: "Cookie" in r.headers,
+        )
+        requests_mock.get(url, content=SP_ECP_PAOS_RESPONSE)
+        requests_mock.post(idp, content=IDP_ECP_SOAP_RESPONSE)
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"Location": url},
+            cookies={"_shibsession_abc": "123"},
+        )
+
+        with requests.Session() as session:
+            session.auth = self.TEST_CLASS(
+                idp=idp,
+                username="user",
+                password="passwd",
+            )
+            response = session.post(url, data=body)
+
+        assert response.status_code == 201
+        assert [r.status_code for r in response.history] == [
+            302,
+            200,
+            200,
+            302,
+        ]
+        last = requests_mock.last_request
+        assert last.method == "POST"
+        body = last.body
+        if hasattr(body, "read"):
+            body = body.read()
+        assert body == b"upload"
+        assert last.headers["Cookie"] == "_shibsession_abc=123"
+
+    def test_handle_response_replay_generator(self, requests_mock):
+        """Test that a request with a generator body isn't replayed empty.
+        """
+        url = "https://example.com/data"
+        idp = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+        requests_mock.post(
+            url,
+            status_code=302,
+            headers={"Location": "https://example.com/Shibboleth.sso/Login"},
+        )
+        requests_mock.get(url, content=SP_ECP_PAOS_RESPONSE)
+        requests_mock.post(idp, content=IDP_ECP_SOAP_RESPONSE)
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"Location": url},
+            cookies={"_shibsession_abc": "123"},
+        )
+
+        def _upload():
+            yield b"upload"
+
+        with requests.Session() as session:
+            session.auth = auth = self.TEST_CLASS(
+                idp=idp,
+                username="user",
+                password="passwd",
+            )
+            with pytest.raises(UnrewindableBodyError):
+                session.post(url, data=_upload())
+
+        # the login still happened, so the upload can be retried
+        assert auth._cookies["example.com"]["_shibsession_abc"] == "123"
+        assert requests_mock.last_request.method == "POST"
+        assert requests_mock.last_request.url == (
+            "https://example.com/Shibboleth.sso/SAML2/ECP"
+        )
+
+    def test_handle_response_single_flight(self, requests_mock):
+        """Test that concurrent ECP redirects only trigger one login.
+        """
+        url = "https://test.com/data"
+        nthreads = 8
+        barrier = threading.Barrier(nthreads)
+
+        # the SP redirects unless it gets a session cookie
+        requests_mock.get(
+            url,
+            status_code=302,
+            headers={"Location": "https://test.com/Shibboleth.sso/Login"},
+            additional_matcher=lambda r: "Cookie" not in r.headers,
+        )
+        requests_mock.get(
+            url,
+            text="data",
+            additional_matcher=lambda r: "Cookie" in r.headers,
+        )
+
+        def _authenticate(*args, **kwargs):
+            time.sleep(.2)  # give the other threads time to pile up
+            responses = mock_authenticate_response(url)
+            responses[2].cookies.set(
+                "_shibsession_abc",
+                "123",
+                domain="test.com",
+            )
+            return responses
+
+        def _get(session):
+            barrier.wait()
+            return session.get(url, allow_redirects=False)
+
+        auth = self.TEST_CLASS(idp="test", username="user", password="pass")
+        with mock.patch.object(
+            self.TEST_CLASS,
+            "_authenticate",
+            side_effect=_authenticate,
+        ) as mock_authenticate, requests.Session() as session:
+            session.auth = auth
+            with ThreadPoolExecutor(nthreads) as pool:
+                responses = list(pool.map(_get, [session] * nthreads))
+
+        mock_authenticate.assert_called_once()
+        # one thread gets the final ECP redirect, the rest get the data
+        assert sorted(r.status_code for r in responses) == (
+            [200] * (nthreads - 1) + [302]
+        )
+
+    def test_handle_response_stress(self, requests_mock):
+        """Test that many threads hammering one auth log in exactly once.
+        """
+        url = "https://test.com/data"
+        nthreads = 64
+        nrequests = 4 * nthreads
+        barrier = threading.Barrier(nthreads)
+
+        # the SP redirects unless it gets a session cookie
+        requests_mock.get(
+            url,
+            status_code=302,
+            headers={"Location": "https://test.com/Shibboleth.sso/Login"},
+            additional_matcher=lambda r: "Cookie" not in r.headers,
+        )
+        requests_mock.get(
+            url,
+            text="data",
+            additional_matcher=lambda r: "Cookie" in r.headers,
+        )
+
+        def _authenticate(*args, **kwargs):
+            time.sleep(.1)  # give the other threads time to pile up
+            responses = mock_authenticate_response(url)
+            responses[2].cookies.set(
+                "_shibsession_abc",
+                "123",
+                domain="test.com",
+            )
+            return responses
+
+        auth = self.TEST_CLASS(idp="test", username="user", password="pass")
+
+        def _get(i):
+            if i < nthreads:
+                barrier.wait()
+            # use a session per request so that only the auth is shared
+            with requests.Session() as session:
+                session.auth = auth
+                return session.get(url, allow_redirects=False)
+
+        with mock.patch.object(
+            self.TEST_CLASS,
+            "_authenticate",
+            side_effect=_authenticate,
+        ) as mock_authenticate:
+            with ThreadPoolExecutor(nthreads) as pool:
+                responses = list(pool.map(_get, range(nrequests)))
+
+        mock_authenticate.assert_called_once()
+        statuses = sorted(r.status_code for r in responses)
+        # one request gets the final ECP redirect, the rest replay theirs
+        # with the new session
+        assert statuses.count(302) == 1
+        assert statuses.count(200) == nrequests - 1
+        # every request was redirected (no session shares cookies), and
+        # each redirect was handled exactly once
+        assert auth._num_ecp_auth == nrequests
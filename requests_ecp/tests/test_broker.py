@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for requests_ecp.broker.
+"""
+
+import multiprocessing
+
+import pytest
+from requests.cookies import RequestsCookieJar
+
+import requests_ecp
+from requests_ecp import broker as requests_ecp_broker
+from .test_ecp import (
+    IDP_ECP_SOAP_RESPONSE,
+    SP_ECP_PAOS_RESPONSE,
+)
+
+IDP = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+
+
+def _sp(request, context):
+    if "_shibsession_abc=123" in request.headers.get("Cookie", ""):
+        return b"data"
+    if "PAOS" in request.headers:
+        return SP_ECP_PAOS_RESPONSE
+    context.status_code = 302
+    context.headers["location"] = "https://example.com/Shibboleth.sso/Login"
+    return b""
+
+
+@pytest.fixture
+def service(requests_mock):
+    requests_mock.get("https://example.com/data", content=_sp)
+    requests_mock.post(IDP, content=IDP_ECP_SOAP_RESPONSE)
+    requests_mock.post(
+        "https://example.com/Shibboleth.sso/SAML2/ECP",
+        status_code=302,
+        headers={"location": "https://example.com/data"},
+        cookies={"_shibsession_abc": "123"},
+    )
+    return requests_mock
+
+
+def _broker():
+    return requests_ecp_broker._Broker(
+        IDP,
+        username="user",
+        password="passwd",
+    )
+
+
+def _logins(requests_mock):
+    return sum(req.url == IDP for req in requests_mock.request_history)
+
+
+def test_broker_login(service):
+    """Test that the broker logs in once per SP session.
+    """
+    broker = _broker()
+    expiry, cookies = broker.login("https://example.com/data", IDP)
+    assert [(c["name"], c["value"]) for c in cookies] == [
+        ("_shibsession_abc", "123"),
+    ]
+    assert broker.login("https://example.com/other", IDP) == (
+        expiry,
+        cookies,
+    )
+    assert broker.get("https://example.com/other", IDP) == (expiry, cookies)
+    assert _logins(service) == 1
+
+    # once discarded, the next login logs in again
+    broker.discard("https://example.com/data", IDP)
+    broker.login("https://example.com/data", IDP)
+    assert _logins(service) == 2
+
+
+def test_broker_get(service):
+    """Test that a plain lookup never makes the broker log in.
+    """
+    broker = _broker()
+    assert broker.get("https://example.com/data", IDP) is None
+    assert _logins(service) == 0
+
+
+def test_broker_store(service):
+    """Test that the broker serves sessions stored by clients.
+    """
+    broker = _broker()
+    client = requests_ecp_broker.BrokerClient(broker)
+    jar = RequestsCookieJar()
+    jar.set("_shibsession_abc", "456", domain="example.com")
+    client.store("https://example.com/data", IDP, jar)
+    expiry, cookies = broker.get("https://example.com/data", IDP)
+    assert [(c["name"], c["value"]) for c in cookies] == [
+        ("_shibsession_abc", "456"),
+    ]
+    assert _logins(service) == 0
+
+
+def test_broker_get_other_idp():
+    """Test that the broker doesn't serve other IdPs.
+    """
+    assert _broker().get("https://example.com/data", "other") is None
+
+
+def test_client(service):
+    """Test that `BrokerClient` works as a cookie cache for a Session.
+    """
+    client = requests_ecp_broker.BrokerClient(_broker())
+    for _ in range(2):
+        with requests_ecp.Session(idp=IDP, cookie_cache=client) as sess:
+            sess.get("https://example.com/data")
+        assert service.last_request.headers["Cookie"] == (
+            "_shibsession_abc=123"
+        )
+    assert _logins(service) == 1
+
+
+def test_client_miss(requests_mock):
+    """Test that `BrokerClient` remembers that the broker has no session.
+    """
+    class _Counting:
+        calls = 0
+
+        def get(self, url, idp):
+            self.calls += 1
+
+    broker = _Counting()
+    client = requests_ecp_broker.BrokerClient(broker)
+    requests_mock.get("https://example.com/public", text="public")
+    with requests_ecp.Session(idp=IDP, cookie_cache=client) as sess:
+        for _ in range(3):
+            sess.get("https://example.com/public")
+    assert broker.calls == 1
+    assert requests_mock.call_count == 3
+
+    # the miss expires
+    client.miss_ttl = 0
+    client._misses.clear()
+    client.get("https://example.com/public", IDP)
+    client.get("https://example.com/public", IDP)
+    assert broker.calls == 3
+
+
+def test_client_unavailable():
+    """Test that `BrokerClient` returns nothing if the broker fails.
+    """
+    class _Failing:
+        def get(self, url, idp):
+            raise EOFError
+
+    client = requests_ecp_broker.BrokerClient(_Failing())
+    assert client.get("https://example.com/data", IDP) is None
+    assert client.login("https://example.com/data", IDP) is None
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(),
+    reason="requires fork",
+)
+def test_session_broker(service):
+    """Test that a `SessionBroker` serves sessions from another process.
+    """
+    with requests_ecp_broker.SessionBroker(
+        IDP,
+        ctx=multiprocessing.get_context("fork"),
+        username="user",
+        password="passwd",
+    ) as broker:
+        client = broker.client()
+        assert client.get("https://example.com/data", IDP) is None
+        jar = client.login("https://example.com/data", IDP)
+        assert jar["_shibsession_abc"] == "123"
+        # connect a new client by address
+        jar = requests_ecp_broker.BrokerClient.connect(
+            broker.address,
+            authkey=multiprocessing.current_process().authkey,
+        ).get("https://example.com/data", IDP)
+        assert jar["_shibsession_abc"] == "123"
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for requests_ecp.cache.
+"""
+
+import time
+from unittest import mock
+
+from requests.cookies import create_cookie
+
+from requests_ecp import cache as requests_ecp_cache
+
+IDP = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+
+
+def test_session_expiry():
+    """Test that `session_expiry` prefers the Shibboleth session cookie.
+    """
+    cookies = [
+        create_cookie("other", "value", expires=100),
+        create_cookie("_shibsession_abc", "value", expires=200),
+    ]
+    assert requests_ecp_cache.session_expiry(cookies, now=0) == 200
+
+
+def test_session_expiry_default():
+    """Test that `session_expiry` falls back to the default lifetime.
+    """
+    cookies = [create_cookie("_shibsession_abc", "value")]
+    assert requests_ecp_cache.session_expiry(
+        cookies,
+        lifetime=10,
+        now=0,
+    ) == 10
+
+
+class TestCookieCache:
+    TEST_CLASS = requests_ecp_cache.CookieCache
+
+    def test_store_get(self, tmp_path):
+        """Test that cookies stored by one cache can be read by another.
+        """
+        path = tmp_path / "cookies.json"
+        self.TEST_CLASS(path).store(
+            "https://example.com/data",
+            IDP,
+            [create_cookie("_shibsession_abc", "123", domain="example.com")],
+        )
+        jar = self.TEST_CLASS(path).get("https://example.com/other", IDP)
+        assert jar["_shibsession_abc"] == "123"
+        # check that the key includes the IdP
+        assert self.TEST_CLASS(path).get("https://example.com", "idp") is None
+
+    def test_get_expired(self, tmp_path):
+        """Test that expired sessions are not returned.
+        """
+        cache = self.TEST_CLASS(tmp_path / "cookies.json")
+        cache.store(
+            "https://example.com/data",
+            IDP,
+            [create_cookie("_shibsession_abc", "123", expires=time.time())],
+        )
+        assert cache.get("https://example.com/data", IDP) is None
+
+    def test_discard(self, tmp_path):
+        """Test that `CookieCache.discard` removes an entry.
+        """
+        path = tmp_path / "cookies.json"
+        cache = self.TEST_CLASS(path)
+        cache.store(
+            "https://example.com/data",
+            IDP,
+            [create_cookie("_shibsession_abc", "123")],
+        )
+        cache.discard("https://example.com/data", IDP)
+        assert cache.get("https://example.com/data", IDP) is None
+        assert self.TEST_CLASS(path).get("https://example.com", IDP) is None
+
+    def test_get_miss(self, tmp_path):
+        """Test that a miss isn't read again until the file changes.
+        """
+        path = tmp_path / "cookies.json"
+        cache = self.TEST_CLASS(path)
+        with mock.patch.object(
+            cache,
+            "_read",
+            wraps=cache._read,
+        ) as read:
+            for _ in range(3):
+                assert cache.get("https://example.com/data", IDP) is None
+            assert read.call_count == 1
+
+            # another process stores a session
+            self.TEST_CLASS(path).store(
+                "https://example.com/data",
+                IDP,
+                [create_cookie("_shibsession_abc", "123")],
+            )
+            jar = cache.get("https://example.com/data", IDP)
+            assert jar["_shibsession_abc"] == "123"
+            assert read.call_count == 2
+
+    def test_discard_keeps_new_session(self, tmp_path):
+        """Test that `CookieCache.discard` doesn't remove a session
+        stored by another process.
+        """
+        path = tmp_path / "cookies.json"
+        url = "https://example.com/data"
+        first = self.TEST_CLASS(path)
+        first.store(url, IDP, [create_cookie("_shibsession_abc", "old")])
+        assert first.get(url, IDP)["_shibsession_abc"] == "old"
+
+        # another process logs in again
+        self.TEST_CLASS(path).store(
+            url,
+            IDP,
+            [create_cookie("_shibsession_abc", "new")],
+        )
+
+        # the SP rejects the old cookies, the new ones are kept
+        first.discard(url, IDP)
+        assert first.get(url, IDP)["_shibsession_abc"] == "new"
+        assert self.TEST_CLASS(path).get(url, IDP)["_shibsession_abc"] == (
+            "new"
+        )
+
+        # the rejected new cookies are removed
+        first.discard(url, IDP)
+        assert self.TEST_CLASS(path).get(url, IDP) is None
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for requests_ecp.credentials.
+"""
+
+import os
+from unittest import mock
+
+import pytest
+
+from requests_ecp import credentials as requests_ecp_credentials
+
+HOST = "idp.test.com"
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    requests_ecp_credentials.clear_cache()
+    yield
+    requests_ecp_credentials.clear_cache()
+
+
+def test_environment_credentials(monkeypatch):
+    provider = requests_ecp_credentials.EnvironmentCredentials()
+    assert provider.get(HOST) is None
+    monkeypatch.setenv("ECP_USERNAME", "user")
+    monkeypatch.setenv("ECP_PASSWORD", "passwd")
+    assert provider.get(HOST) == ("user", "passwd")
+    assert provider.get(HOST, "me") == ("me", "passwd")
+
+
+def test_netrc_credentials(tmp_path):
+    netrc = tmp_path / "netrc"
+    netrc.write_text(f"machine {HOST} login user password passwd\n")
+    netrc.chmod(0o600)
+    provider = requests_ecp_credentials.NetrcCredentials(netrc)
+    assert provider.get(HOST) == ("user", "passwd")
+    assert provider.get(HOST, "me") is None
+    assert provider.get("other.test.com") is None
+    assert requests_ecp_credentials.NetrcCredentials(
+        tmp_path / "missing",
+    ).get(HOST) is None
+
+
+@mock.patch.dict("sys.modules", {"keyring": None})
+def test_keyring_credentials_missing():
+    assert requests_ecp_credentials.KeyringCredentials().get(HOST) is None
+
+
+@pytest.mark.parametrize(("content", "username", "result"), [
+    ("user\npasswd\n", None, ("user", "passwd")),
+    ("passwd\n", "me", ("me", "passwd")),
+    ("passwd\n", None, None),
+])
+def test_file_descriptor_credentials(content, username, result):
+    read, write = os.pipe()
+    os.write(write, content.encode())
+    os.close(write)
+    try:
+        provider = requests_ecp_credentials.FileDescriptorCredentials(read)
+        assert provider.get(HOST, username) == result
+        # the content is remembered
+        assert provider.get(HOST, username) == result
+    finally:
+        os.close(read)
+
+
+def test_prompt_credentials_noninteractive():
+    with mock.patch(
+        "requests_ecp.credentials._interactive",
+        return_value=False,
+    ), mock.patch("requests_ecp.auth.input") as input_:
+        assert requests_ecp_credentials.PromptCredentials().get(HOST) is None
+    input_.assert_not_called()
+
+
+def test_get_credentials():
+    """Test that `get_credentials` uses the first provider with
+    credentials, and remembers the result.
+    """
+    empty = mock.Mock(return_value=None)
+    provider = mock.Mock(return_value=("user", "passwd"))
+    for _ in range(2):
+        assert requests_ecp_credentials.get_credentials(
+            HOST,
+            providers=[empty, provider],
+        ) == ("user", "passwd")
+    empty.assert_called_once_with(HOST, None)
+    provider.assert_called_once_with(HOST, None)
+
+
+def test_get_credentials_providers():
+    """Test that `get_credentials` remembers credentials per provider.
+    """
+    first = mock.Mock(return_value=("user", "passwd"))
+    second = mock.Mock(return_value=("other", "passwd2"))
+    assert requests_ecp_credentials.get_credentials(
+        HOST,
+        providers=first,
+    ) == ("user", "passwd")
+    assert requests_ecp_credentials.get_credentials(
+        HOST,
+        providers=[second],
+    ) == ("other", "passwd2")
+
+
+def test_get_credentials_equal_providers(monkeypatch):
+    """Test that equal providers share cached credentials.
+    """
+    monkeypatch.setenv("ECP_USERNAME", "user")
+    monkeypatch.setenv("ECP_PASSWORD", "passwd")
+    assert requests_ecp_credentials.get_credentials(
+        HOST,
+        providers=[requests_ecp_credentials.EnvironmentCredentials()],
+    ) == ("user", "passwd")
+    monkeypatch.setenv("ECP_PASSWORD", "changed")
+    assert requests_ecp_credentials.get_credentials(
+        HOST,
+        providers=[requests_ecp_credentials.EnvironmentCredentials()],
+    ) == ("user", "passwd")
+    # but not with different providers
+    monkeypatch.setenv("OTHER", "other")
+    assert requests_ecp_credentials.get_credentials(
+        HOST,
+        providers=[requests_ecp_credentials.EnvironmentCredentials(
+            password_variable="ECP_PASSWORD",
+            username_variable="OTHER",
+        )],
+    ) == ("other", "changed")
+
+
+def test_interactive_getpass(monkeypatch):
+    """Test that a replaced `getpass.getpass` counts as interactive.
+    """
+    import getpass
+    monkeypatch.setattr("sys.stdin", None)
+    assert not requests_ecp_credentials._interactive()
+    monkeypatch.setattr(getpass, "getpass", lambda prompt="": "passwd")
+    assert requests_ecp_credentials._interactive()
+
+
+def test_default_providers():
+    """Test that the keyring isn't used by default.
+    """
+    assert not any(
+        isinstance(provider, requests_ecp_credentials.KeyringCredentials)
+        for provider in requests_ecp_credentials.DEFAULT_PROVIDERS
+    )
+
+
+def test_discard_credentials():
+    """Test that `discard_credentials` makes `get_credentials` ask again.
+    """
+    provider = mock.Mock(side_effect=[("user", "wrong"), ("user", "passwd")])
+    assert requests_ecp_credentials.get_credentials(
+        HOST,
+        providers=[provider],
+    ) == ("user", "wrong")
+    requests_ecp_credentials.discard_credentials(HOST, providers=[provider])
+    assert requests_ecp_credentials.get_credentials(
+        HOST,
+        providers=[provider],
+    ) == ("user", "passwd")
+
+
+def test_get_credentials_error():
+    with pytest.raises(RuntimeError, match="no credentials found"):
+        requests_ecp_credentials.get_credentials(
+            HOST,
+            providers=lambda host, username: None,
+        )
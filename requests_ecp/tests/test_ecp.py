@@ -19,9 +19,28 @@
 """Tests for requests_ecp.auth.
 """
 
+import threading
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from io import BytesIO
+
+import pytest
 from lxml import etree
 
+from requests import (
+    HTTPError,
+    Request,
+    Response,
+)
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.cookies import RequestsCookieJar
+from requests_mock import Adapter as MockAdapter
+
 from requests_ecp import ecp
+from requests_ecp.retry import RetryPolicy
 
 
 SP_ECP_PAOS_RESPONSE = b"""
@@ -182,3 +201,379 @@ def test_get_xml_attribute():
         etree.XML(SP_ECP_PAOS_RESPONSE),
         "//ecp:RelayState",
     ).text.strip() == "relay_state_text"
+
+
+def _body(content):
+    """Return the bytes of the SOAP body of an envelope.
+    """
+    start = content.index(b"Body>") - 10
+    start = content.index(b"<", start)
+    return content[start:content.rindex(b"Body>") + 5]
+
+
+def test_parse_sp_request():
+    """Test that `_parse_sp_request` passes the SOAP body through untouched.
+    """
+    idpbody, relaystate, rcurl = ecp._parse_sp_request(SP_ECP_PAOS_RESPONSE)
+    assert _body(SP_ECP_PAOS_RESPONSE) in idpbody
+    assert [child.tag for child in etree.XML(idpbody).iterchildren(
+        tag=etree.Element,
+    )] == ["{http://schemas.xmlsoap.org/soap/envelope/}Body"]
+    assert relaystate.text.strip() == "relay_state_text"
+    assert rcurl == "https://example.com/Shibboleth.sso/SAML2/ECP"
+
+
+def test_parse_idp_response():
+    """Test that `_parse_idp_response` passes the SOAP body through untouched.
+    """
+    relaystate = ecp._parse_sp_request(SP_ECP_PAOS_RESPONSE)[1]
+    spbody, acsurl = ecp._parse_idp_response(
+        IDP_ECP_SOAP_RESPONSE,
+        "https://idp.example.com",
+        relaystate,
+    )
+    assert _body(IDP_ECP_SOAP_RESPONSE) in spbody
+    header = etree.XML(spbody)[0]
+    assert header[0].tag == (
+        "{urn:oasis:names:tc:SAML:2.0:profiles:SSO:ecp}RelayState"
+    )
+    assert acsurl == "https://example.com/Shibboleth.sso/SAML2/ECP"
+
+
+@pytest.mark.parametrize("content", [
+    # comment before the header
+    SP_ECP_PAOS_RESPONSE.replace(b"<S:Header>", b"<!-- c --><S:Header>"),
+    # not an ASCII-compatible encoding
+    b'<?xml version="1.0" encoding="ISO-8859-1"?>' + SP_ECP_PAOS_RESPONSE,
+])
+def test_parse_sp_request_fallback(content):
+    """Test that `_parse_sp_request` parses the whole envelope if it must.
+    """
+    assert ecp._parse_header(content)[0] is None
+    idpbody, relaystate, rcurl = ecp._parse_sp_request(content)
+    assert [child.tag for child in etree.XML(idpbody).iterchildren(
+        tag=etree.Element,
+    )] == ["{http://schemas.xmlsoap.org/soap/envelope/}Body"]
+    assert relaystate.text.strip() == "relay_state_text"
+    assert rcurl == "https://example.com/Shibboleth.sso/SAML2/ECP"
+
+
+def _response(content):
+    response = Response()
+    response.raw = BytesIO(content)
+    return response
+
+
+@pytest.mark.parametrize("content", [
+    SP_ECP_PAOS_RESPONSE,
+    # fallback
+    SP_ECP_PAOS_RESPONSE.replace(b"<S:Header>", b"<!-- c --><S:Header>"),
+])
+def test_parse_sp_request_stream(monkeypatch, content):
+    """Test that `_parse_sp_request` reads a response in chunks.
+    """
+    monkeypatch.setattr(ecp, "XML_CHUNK_SIZE", 16)
+    idpbody, relaystate, rcurl = ecp._parse_sp_request(content)
+    assert ecp._parse_sp_request(_response(content))[::2] == (
+        idpbody,
+        rcurl,
+    )
+
+
+def test_read_header(monkeypatch):
+    """Test that `_read_header` stops reading after the SOAP header.
+    """
+    monkeypatch.setattr(ecp, "XML_CHUNK_SIZE", 16)
+    content = IDP_ECP_SOAP_RESPONSE
+    head, rest = ecp._read_header(_response(content))
+    end = content.index(b"</soap11:Header>") + len(b"</soap11:Header>")
+    assert end <= len(head) < end + 16
+    assert head + b"".join(rest) == content
+
+
+def test_authenticate_adapter_cookies(requests_mock):
+    """Test that `authenticate` shares cookies between requests when
+    given a connection adapter.
+    """
+    requests_mock.get(
+        "https://example.com/data",
+        content=SP_ECP_PAOS_RESPONSE,
+        cookies={"_opensaml_req": "abc"},
+    )
+    requests_mock.post(
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        content=IDP_ECP_SOAP_RESPONSE,
+    )
+    requests_mock.post(
+        "https://example.com/Shibboleth.sso/SAML2/ECP",
+        status_code=302,
+        headers={"location": "https://example.com/data"},
+    )
+
+    cookies = RequestsCookieJar()
+    cookies.set("affinity", "1")
+    ecp.authenticate(
+        requests_mock._adapter,
+        HTTPBasicAuth("user", "passwd"),
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        "https://example.com/data",
+        cookies=cookies,
+    )
+
+    first, idp, last = requests_mock.request_history
+    assert first.headers["Cookie"] == "affinity=1"
+    # SP cookies aren't sent to the IdP
+    assert "Cookie" not in idp.headers
+    assert sorted(last.headers["Cookie"].split("; ")) == [
+        "_opensaml_req=abc",
+        "affinity=1",
+    ]
+
+
+def test_authenticate_idp_connection():
+    """Test that `authenticate` sends the IdP request via ``idp_connection``.
+    """
+    sp = MockAdapter()
+    sp.register_uri(
+        "GET",
+        "https://example.com/data",
+        content=SP_ECP_PAOS_RESPONSE,
+    )
+    sp.register_uri(
+        "POST",
+        "https://example.com/Shibboleth.sso/SAML2/ECP",
+        status_code=302,
+        headers={"location": "https://example.com/data"},
+    )
+    idp = MockAdapter()
+    idp.register_uri(
+        "POST",
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        content=IDP_ECP_SOAP_RESPONSE,
+    )
+
+    ecp.authenticate(
+        sp,
+        HTTPBasicAuth("user", "passwd"),
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        "https://example.com/data",
+        idp_connection=idp,
+    )
+    assert sp.call_count == 2
+    assert idp.call_count == 1
+
+
+def _mock_sp(requests_mock):
+    requests_mock.get(
+        "https://example.com/data",
+        content=SP_ECP_PAOS_RESPONSE,
+    )
+    requests_mock.post(
+        "https://example.com/Shibboleth.sso/SAML2/ECP",
+        status_code=302,
+        headers={"location": "https://example.com/data"},
+    )
+
+
+def test_authenticate_idp_cookies(requests_mock):
+    """Test that `authenticate` reuses the IdP session when it can.
+    """
+    _mock_sp(requests_mock)
+    idp = requests_mock.post(
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        content=IDP_ECP_SOAP_RESPONSE,
+        cookies={"shib_idp_session": "abc"},
+    )
+
+    idp_cookies = RequestsCookieJar()
+    for _ in range(2):
+        ecp.authenticate(
+            requests_mock._adapter,
+            HTTPBasicAuth("user", "passwd"),
+            "https://idp.example.com/profile/SAML2/SOAP/ECP",
+            "https://example.com/data",
+            idp_cookies=idp_cookies,
+        )
+    assert idp_cookies["shib_idp_session"] == "abc"
+
+    # the first round-trip used credentials, the second only the session
+    first, second = idp.request_history
+    assert "Authorization" in first.headers
+    assert "Authorization" not in second.headers
+    assert second.headers["Cookie"] == "shib_idp_session=abc"
+
+
+def test_authenticate_idp_cookies_rejected(requests_mock):
+    """Test that `authenticate` falls back to credentials when the IdP
+    rejects the session.
+    """
+    _mock_sp(requests_mock)
+    idp = requests_mock.post(
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        [
+            {"status_code": 401},
+            {"content": IDP_ECP_SOAP_RESPONSE},
+        ],
+    )
+
+    idp_cookies = RequestsCookieJar()
+    idp_cookies.set("shib_idp_session", "expired")
+    ecp.authenticate(
+        requests_mock._adapter,
+        HTTPBasicAuth("user", "passwd"),
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        "https://example.com/data",
+        idp_cookies=idp_cookies,
+    )
+
+    rejected, accepted = idp.request_history
+    assert "Authorization" not in rejected.headers
+    assert "Authorization" in accepted.headers
+    assert not len(idp_cookies)
+
+
+def test_authenticate_idp_cookies_transient(requests_mock):
+    """Test that `authenticate` retries the IdP session after a transient
+    failure, and doesn't discard it.
+    """
+    _mock_sp(requests_mock)
+    idp = requests_mock.post(
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        [
+            {"status_code": 503},
+            {"content": IDP_ECP_SOAP_RESPONSE},
+            {"status_code": 503},
+        ],
+    )
+
+    idp_cookies = RequestsCookieJar()
+    idp_cookies.set("shib_idp_session", "abc")
+    ecp.authenticate(
+        requests_mock._adapter,
+        HTTPBasicAuth("user", "passwd"),
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        "https://example.com/data",
+        idp_cookies=idp_cookies,
+        retry=RetryPolicy(retries=1, backoff_factor=0),
+    )
+    assert [
+        "Authorization" in req.headers for req in idp.request_history
+    ] == [False, False]
+    assert idp_cookies["shib_idp_session"] == "abc"
+
+    # without retries the error is raised, and the session kept
+    with pytest.raises(HTTPError):
+        ecp.authenticate(
+            requests_mock._adapter,
+            HTTPBasicAuth("user", "passwd"),
+            "https://idp.example.com/profile/SAML2/SOAP/ECP",
+            "https://example.com/data",
+            idp_cookies=idp_cookies,
+        )
+    assert idp_cookies["shib_idp_session"] == "abc"
+
+
+def test_authenticate_trace(requests_mock):
+    """Test that `authenticate` emits a trace event for each request.
+    """
+    _mock_sp(requests_mock)
+    requests_mock.post(
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        content=IDP_ECP_SOAP_RESPONSE,
+    )
+
+    events = []
+    ecp.authenticate(
+        requests_mock._adapter,
+        HTTPBasicAuth("user", "passwd"),
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        "https://example.com/data",
+        trace=events.append,
+    )
+
+    assert [(e.step, e.method, e.status_code) for e in events] == [
+        ("sp", "GET", 200),
+        ("idp", "POST", 200),
+        ("acs", "POST", 302),
+    ]
+    sp, idp, acs = events
+    assert sp.bytes_sent == 0
+    assert sp.bytes_received == len(SP_ECP_PAOS_RESPONSE)
+    assert idp.bytes_sent > 0
+    assert all(e.elapsed >= 0 for e in events)
+    # can't tell if a mock adapter reuses connections
+    assert all(e.reused is None for e in events)
+
+
+@pytest.fixture
+def http_server():
+    """A local HTTP server that responds to every GET with ``ok``.
+    """
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_send_trace_reused(http_server):
+    """Test that `_send` reports connection reuse with an `HTTPAdapter`.
+    """
+    events = []
+    adapter = HTTPAdapter()
+    try:
+        for _ in range(2):
+            ecp._send(adapter, "GET", http_server, trace=events.append)
+    finally:
+        adapter.close()
+    assert [e.reused for e in events] == [False, True]
+
+
+def test_connection_pool():
+    """Test that `_connection_pool` finds the pool an `HTTPAdapter` uses,
+    without creating any others.
+    """
+    url = "https://example.com/data"
+    adapter = HTTPAdapter()
+    pool = ecp._connection_pool(adapter, url)
+    assert pool is adapter.get_connection_with_tls_context(
+        Request("GET", url).prepare(),
+        True,
+    )
+    assert len(adapter.poolmanager.pools) == 1
+
+
+def test_authenticate_retry(requests_mock):
+    """Test that `authenticate` retries transient IdP failures.
+    """
+    _mock_sp(requests_mock)
+    idp = requests_mock.post(
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        [
+            {"status_code": 503},
+            {"content": IDP_ECP_SOAP_RESPONSE},
+        ],
+    )
+    ecp.authenticate(
+        requests_mock._adapter,
+        HTTPBasicAuth("user", "passwd"),
+        "https://idp.example.com/profile/SAML2/SOAP/ECP",
+        "https://example.com/data",
+        retry=RetryPolicy(retries=1, backoff_factor=0),
+    )
+    assert idp.call_count == 2
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the import-time cost of requests_ecp.
+"""
+
+import subprocess
+import sys
+
+import pytest
+
+#: Modules that should not be imported by `import requests_ecp`.
+HEAVY_MODULES = (
+    "gssapi",
+    "lxml",
+    "requests_gssapi",
+    "requests_kerberos",
+)
+
+#: Budget for the import time of requests_ecp itself (excluding requests),
+#: as a multiple of the import time of requests, so that the test
+#: doesn't depend on the speed of the machine.
+IMPORT_TIME_FACTOR = 1
+
+
+def _importtime(code):
+    """Run ``code`` with ``-X importtime`` and return the timing table.
+
+    Returns
+    -------
+    times : `dict`
+        ``(self, cumulative)`` import times (microseconds) keyed by
+        module name.
+    """
+    proc = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", code],
+        check=True,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        try:
+            self_, cumulative, name = line.split(":", 1)[1].split("|")
+        except ValueError:  # not an importtime line
+            continue
+        try:
+            times[name.strip()] = (int(self_), int(cumulative))
+        except ValueError:  # header line
+            continue
+    return times
+
+
+@pytest.fixture(scope="module")
+def importtime():
+    # import once first, so that byte-compiling isn't timed
+    _importtime("import requests_ecp")
+    return _importtime("import requests_ecp")
+
+
+@pytest.mark.parametrize("module", HEAVY_MODULES)
+def test_import_lazy(importtime, module):
+    """Test that `import requests_ecp` doesn't import heavy modules.
+    """
+    imported = {name.split(".", 1)[0] for name in importtime}
+    assert module not in imported
+
+
+def test_import_budget(importtime):
+    """Test that `import requests_ecp` stays within its startup budget.
+    """
+    requests = importtime["requests"][1]
+    total = importtime["requests_ecp"][1] - requests
+    assert total < IMPORT_TIME_FACTOR * requests
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for requests_ecp.metadata.
+"""
+
+from io import BytesIO
+
+import pytest
+
+from requests_ecp import HTTPECPAuth
+from requests_ecp import metadata as requests_ecp_metadata
+
+ECP = "https://login.example.org/idp/profile/SAML2/SOAP/ECP"
+
+METADATA = b"""<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor
+    xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    xmlns:shibmd="urn:mace:shibboleth:metadata:1.0">
+  <md:EntityDescriptor entityID="https://login.example.org/idp/shibboleth">
+    <md:IDPSSODescriptor
+        protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:Extensions>
+        <shibmd:Scope regexp="false">example.org</shibmd:Scope>
+        <shibmd:Scope regexp="true">^.*\\.example\\.net$</shibmd:Scope>
+      </md:Extensions>
+      <md:SingleSignOnService
+          Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+          Location="https://login.example.org/idp/profile/SAML2/Redirect/SSO"/>
+      <md:SingleSignOnService
+          Binding="urn:oasis:names:tc:SAML:2.0:bindings:SOAP"
+          Location="https://login.example.org/idp/profile/SAML2/SOAP/ECP"/>
+    </md:IDPSSODescriptor>
+  </md:EntityDescriptor>
+  <md:EntityDescriptor entityID="urn:example:web-only">
+    <md:IDPSSODescriptor
+        protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:SingleSignOnService
+          Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+          Location="https://web.example.com/SSO"/>
+    </md:IDPSSODescriptor>
+  </md:EntityDescriptor>
+  <md:EntityDescriptor entityID="https://sp.example.com/shibboleth">
+    <md:SPSSODescriptor
+        protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol"/>
+  </md:EntityDescriptor>
+</md:EntitiesDescriptor>
+"""
+
+
+def test_iter_ecp_endpoints():
+    """Test that `iter_ecp_endpoints` finds only IdPs that support ECP.
+    """
+    assert list(requests_ecp_metadata.iter_ecp_endpoints(
+        BytesIO(METADATA),
+    )) == [(
+        "https://login.example.org/idp/shibboleth",
+        ECP,
+        ["example.org"],
+    )]
+
+
+class TestMetadataIndex:
+    TEST_CLASS = requests_ecp_metadata.MetadataIndex
+
+    @pytest.fixture
+    def index(self, tmp_path):
+        with self.TEST_CLASS(tmp_path / "metadata.idx") as index:
+            index.build(BytesIO(METADATA), url="test")
+            yield index
+
+    @pytest.mark.parametrize("name", [
+        "https://login.example.org/idp/shibboleth",
+        "login.example.org",
+        "LOGIN.example.org",
+        "example.org",
+        # matched by scope
+        "other.example.org",
+    ])
+    def test_resolve(self, index, name):
+        """Test that `MetadataIndex.resolve` finds the ECP endpoint.
+        """
+        assert index.resolve(name) == ECP
+
+    @pytest.mark.parametrize("name", [
+        "example.com",
+        "org",
+        "urn:example:web-only",
+        "https://sp.example.com/shibboleth",
+    ])
+    def test_resolve_error(self, index, name):
+        """Test that `MetadataIndex.resolve` errors for unknown IdPs.
+        """
+        with pytest.raises(ValueError, match="no ECP endpoint found"):
+            index.resolve(name)
+
+    def test_lookup_many(self, tmp_path):
+        """Test that `MetadataIndex.lookup` finds every key in a large index.
+        """
+        entities = b"".join(
+            b'<md:EntityDescriptor entityID="https://idp%d.example.org/idp">'
+            b'<md:IDPSSODescriptor><md:SingleSignOnService '
+            b'Binding="urn:oasis:names:tc:SAML:2.0:bindings:SOAP" '
+            b'Location="https://idp%d.example.org/ECP"/>'
+            b'</md:IDPSSODescriptor></md:EntityDescriptor>' % (i, i)
+            for i in range(500)
+        )
+        source = BytesIO(
+            b'<md:EntitiesDescriptor '
+            b'xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">'
+            + entities
+            + b'</md:EntitiesDescriptor>',
+        )
+        with self.TEST_CLASS(tmp_path / "metadata.idx") as index:
+            assert index.build(source) == 1000
+            for i in range(500):
+                assert index.lookup(f"idp{i}.example.org") == (
+                    f"https://idp{i}.example.org/ECP"
+                )
+            assert index.lookup("aaa") is None
+            assert index.lookup("zzz") is None
+
+    def test_info(self, index, tmp_path):
+        """Test that `MetadataIndex.info` returns the build information.
+        """
+        assert index.info == {"url": "test"}
+        assert self.TEST_CLASS(tmp_path / "missing.idx").info == {}
+
+    def test_refresh(self, tmp_path, requests_mock):
+        """Test that `MetadataIndex.refresh` sends conditional requests.
+        """
+        url = "https://md.example.org/metadata.xml"
+        requests_mock.get(
+            url,
+            content=METADATA,
+            headers={"ETag": '"abc"'},
+            additional_matcher=lambda r: "If-None-Match" not in r.headers,
+        )
+        requests_mock.get(
+            url,
+            status_code=304,
+            additional_matcher=lambda r: r.headers.get(
+                "If-None-Match",
+            ) == '"abc"',
+        )
+        with self.TEST_CLASS(tmp_path / "metadata.idx") as index:
+            assert index.refresh(url) is True
+            assert index.info["etag"] == '"abc"'
+            assert index.refresh(url) is False
+            assert index.resolve("example.org") == ECP
+
+    def test_refresh_https(self, tmp_path, requests_mock):
+        """Test that `MetadataIndex.refresh` only downloads over HTTPS.
+        """
+        requests_mock.get(
+            "https://md.example.org/metadata.xml",
+            status_code=301,
+            headers={"Location": "http://md.example.org/metadata.xml"},
+        )
+        requests_mock.get(
+            "http://md.example.org/metadata.xml",
+            content=METADATA,
+        )
+        with self.TEST_CLASS(tmp_path / "metadata.idx") as index:
+            with pytest.raises(ValueError, match="HTTPS"):
+                index.refresh("http://md.example.org/metadata.xml")
+            assert requests_mock.call_count == 0
+            # not even via a redirect
+            with pytest.raises(ValueError, match="HTTPS"):
+                index.refresh("https://md.example.org/metadata.xml")
+            assert index.info == {}
+
+
+def test_auth_metadata(tmp_path):
+    """Test that `HTTPECPAuth` can resolve its IdP using metadata.
+    """
+    path = tmp_path / "metadata.idx"
+    requests_ecp_metadata.MetadataIndex(path).build(BytesIO(METADATA))
+    assert HTTPECPAuth("login.example.org", metadata=path).idp == ECP
+    # an entityID URL is resolved
+    assert HTTPECPAuth(
+        "https://login.example.org/idp/shibboleth",
+        metadata=path,
+    ).idp == ECP
+    # any other URL is used as is
+    assert HTTPECPAuth("https://idp", metadata=path).idp == "https://idp"
+    assert HTTPECPAuth(
+        "https://idp",
+        metadata=tmp_path / "missing.idx",
+    ).idp == "https://idp"
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Cardiff University (2020-2022)
+#
+# This file is part of requests_ecp
+#
+# requests_ecp is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# requests_ecp is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with requests_ecp.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for requests_ecp.retry.
+"""
+
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from requests import (
+    HTTPError,
+    Response,
+)
+from requests.exceptions import ConnectionError
+
+from requests_ecp import retry as requests_ecp_retry
+
+IDP = "https://idp.example.com/idp/profile/SAML2/SOAP/ECP"
+
+
+def _http_error(status):
+    response = Response()
+    response.status_code = status
+    response.raw = BytesIO()
+    return HTTPError(response=response)
+
+
+def test_circuit_breaker():
+    breaker = requests_ecp_retry.CircuitBreaker(threshold=2, reset_timeout=10)
+    breaker.record_failure(IDP, now=0)
+    breaker.check(IDP, now=1)  # still closed
+    breaker.record_failure(IDP, now=1)
+    with pytest.raises(requests_ecp_retry.CircuitOpenError):
+        breaker.check(IDP, now=2)
+    # other hosts are unaffected
+    breaker.check("https://other.example.com", now=2)
+
+    # half-open: one trial request is allowed, others are blocked
+    breaker.check(IDP, now=12)
+    with pytest.raises(requests_ecp_retry.CircuitOpenError):
+        breaker.check(IDP, now=13)
+
+    # a success closes the circuit
+    breaker.record_success(IDP)
+    breaker.check(IDP, now=13)
+
+
+@pytest.mark.parametrize("error", [
+    ConnectionError(),
+    _http_error(503),
+])
+def test_retry_policy_call(error):
+    func = mock.Mock(side_effect=[error, error, "ok"])
+    sleep = mock.Mock()
+    policy = requests_ecp_retry.RetryPolicy(retries=2, backoff_factor=1)
+    assert policy.call(IDP, func, sleep=sleep) == "ok"
+    assert func.call_count == 3
+    assert sleep.call_count == 2
+    # the backoff is jittered, but bounded
+    assert 0 <= sleep.call_args_list[1][0][0] <= 2
+
+
+def test_retry_policy_call_not_transient():
+    func = mock.Mock(side_effect=_http_error(401))
+    policy = requests_ecp_retry.RetryPolicy(retries=2)
+    with pytest.raises(HTTPError):
+        policy.call(IDP, func, sleep=mock.Mock())
+    func.assert_called_once()
+
+
+def test_retry_policy_call_circuit_breaker():
+    func = mock.Mock(side_effect=ConnectionError())
+    policy = requests_ecp_retry.RetryPolicy(
+        retries=5,
+        circuit_breaker=requests_ecp_retry.CircuitBreaker(threshold=2),
+    )
+    with pytest.raises(requests_ecp_retry.CircuitOpenError):
+        policy.call(IDP, func, sleep=mock.Mock())
+    assert func.call_count == 2
+
+    # while the circuit is open, requests fail fast
+    with pytest.raises(requests_ecp_retry.CircuitOpenError):
+        policy.call(IDP, func, sleep=mock.Mock())
+    assert func.call_count == 2
+
+
+def test_retry_policy_backoff():
+    policy = requests_ecp_retry.RetryPolicy(backoff_factor=1, backoff_max=5)
+    for attempt in range(10):
+        assert 0 <= policy.backoff(attempt) <= 5
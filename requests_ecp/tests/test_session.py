@@ -19,6 +19,14 @@
 """Tests for requests_ecp.session.
 """
 
+import gc
+import weakref
+from unittest import mock
+
+import pytest
+from requests import HTTPError
+from requests.cookies import create_cookie
+
 import requests_ecp
 from .test_ecp import (
     IDP_ECP_SOAP_RESPONSE,
@@ -69,3 +77,332 @@ class TestSession:
             sess.ecp_authenticate("https://example.com/data")
 
         assert requests_mock.call_count == 3
+
+    def test_ecp_authenticate_paos_hosts(self, requests_mock):
+        """Test that `Session.ecp_authenticate` works for a host that
+        gets PAOS headers on first contact.
+        """
+        requests_mock.get(
+            "https://example.com/data",
+            content=SP_ECP_PAOS_RESPONSE,
+            headers={"Content-Type": "application/vnd.paos+xml"},
+        )
+        requests_mock.post(
+            "https://idp.example.com/profile/SAML2/SOAP/ECP",
+            content=IDP_ECP_SOAP_RESPONSE
+        )
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"location": "https://example.com/data"},
+        )
+
+        with self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            username="user",
+            password="passwd",
+            paos_hosts=["example.com"],
+        ) as sess:
+            sess.ecp_authenticate("https://example.com/data")
+            assert sess.auth.counters["paos"] == 0
+
+        assert requests_mock.call_count == 3
+
+    def test_ecp_authenticate_cookie_cache(self, requests_mock, tmp_path):
+        """Test that SP cookies are shared via a `CookieCache`.
+        """
+        cache = tmp_path / "cookies.json"
+        requests_mock.get(
+            "https://example.com/data",
+            content=SP_ECP_PAOS_RESPONSE,
+        )
+        requests_mock.post(
+            "https://idp.example.com/profile/SAML2/SOAP/ECP",
+            content=IDP_ECP_SOAP_RESPONSE
+        )
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"location": "https://example.com/data"},
+            cookies={"_shibsession_abc": "123"},
+        )
+
+        # authenticate once, populating the cache
+        with self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            username="user",
+            password="passwd",
+            cookie_cache=cache,
+        ) as sess:
+            sess.ecp_authenticate("https://example.com/data")
+        assert requests_mock.call_count == 3
+
+        # then check that a new session sends the cached cookie
+        with self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            cookie_cache=cache,
+        ) as sess:
+            sess.get("https://example.com/data")
+        assert requests_mock.call_count == 4
+        assert requests_mock.last_request.headers["Cookie"] == (
+            "_shibsession_abc=123"
+        )
+
+    def test_init_refresh_margin_error(self):
+        """Test that a refresh margin longer than the session is rejected.
+        """
+        with pytest.raises(ValueError, match="refresh_margin"):
+            self.TEST_CLASS(idp="test", refresh_margin=10, session_lifetime=5)
+
+    def test_refresh_sessions(self, requests_mock):
+        """Test that sessions are refreshed before they expire.
+        """
+        requests_mock.get(
+            "https://example.com/data",
+            content=SP_ECP_PAOS_RESPONSE,
+        )
+        requests_mock.post(
+            "https://idp.example.com/profile/SAML2/SOAP/ECP",
+            content=IDP_ECP_SOAP_RESPONSE
+        )
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            [{
+                "status_code": 302,
+                "headers": {"location": "https://example.com/data"},
+                "cookies": {"_shibsession_abc": value},
+            } for value in ("123", "456")],
+        )
+
+        with self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            username="user",
+            password="passwd",
+            refresh_margin=60,
+            session_lifetime=3600,
+        ) as sess:
+            sess.ecp_authenticate("https://example.com/data")
+            url, expiry = sess.auth.sessions["example.com"]
+            assert url == "https://example.com/data"
+
+            # not due yet, so nothing happens
+            assert sess._refresh_sessions(now=expiry - 90) == 30
+            assert requests_mock.call_count == 3
+
+            # due, so the session is refreshed
+            sess._refresh_sessions(now=expiry - 30)
+            assert requests_mock.call_count == 6
+            assert sess.auth.sessions["example.com"][1] > expiry - 30
+
+    def test_refresh_sessions_idle(self, requests_mock):
+        """Test that sessions for idle hosts are not refreshed.
+        """
+        with self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            refresh_margin=60,
+            refresh_window=600,
+        ) as sess:
+            sess.auth = mock.Mock(sessions={
+                "example.com": ("https://example.com/data", 1000),
+                "other.example.com": ("https://other.example.com/", 1000),
+            })
+            sess._last_used["example.com"] = 500
+            with mock.patch.object(sess, "_ecp_refresh") as refresh:
+                sess._refresh_sessions(now=960)
+            refresh.assert_called_once_with("https://example.com/data")
+
+            # no longer used recently, so left to expire
+            with mock.patch.object(sess, "_ecp_refresh") as refresh:
+                sess._refresh_sessions(now=1200)
+            refresh.assert_not_called()
+
+    def test_refresh_sessions_no_ecp_auth(self):
+        """Test that refreshing tolerates a session without ECP auth.
+        """
+        with self.TEST_CLASS(idp="test", refresh_margin=60) as sess:
+            sess.auth = None
+            assert sess._refresh_sessions() == 60
+
+    def test_refresh_thread(self):
+        """Test that the refresh thread is stopped by `close()`
+        and doesn't keep an unclosed session alive.
+        """
+        sess = self.TEST_CLASS(idp="test", refresh_margin=60)
+        thread = sess._refresh_thread
+        assert thread.is_alive()
+        sess.close()
+        assert not thread.is_alive()
+
+        sess = self.TEST_CLASS(idp="test", refresh_margin=60)
+        thread = sess._refresh_thread
+        ref = weakref.ref(sess)
+        del sess
+        gc.collect()
+        assert ref() is None
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    def test_init_pool(self):
+        """Test that connection pool settings are applied.
+        """
+        sess = self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            pool_connections=4,
+            pool_maxsize=32,
+            idp_pool_maxsize=8,
+        )
+        sp = sess.get_adapter("https://example.com/data")
+        assert sp._pool_connections == 4
+        assert sp._pool_maxsize == 32
+        idp = sess.get_adapter("https://idp.example.com/profile/SAML2")
+        assert idp is sess.auth.idp_adapter
+        assert idp._pool_connections == 1
+        assert idp._pool_maxsize == 8
+
+    def test_init_pool_default(self):
+        """Test that no adapters are mounted by default.
+        """
+        sess = self.TEST_CLASS(idp="https://idp.example.com")
+        assert sess.auth.idp_adapter is None
+        assert set(sess.adapters) == {"https://", "http://"}
+
+    def test_ecp_authenticate_many(self, requests_mock):
+        """Test that many SPs can be authenticated in parallel.
+        """
+        for host in ("sp1.example.com", "sp2.example.com"):
+            requests_mock.get(
+                f"https://{host}/data",
+                content=SP_ECP_PAOS_RESPONSE,
+            )
+        requests_mock.post(
+            "https://idp.example.com/profile/SAML2/SOAP/ECP",
+            content=IDP_ECP_SOAP_RESPONSE,
+        )
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+        )
+        requests_mock.get("https://bad.example.com/data", status_code=500)
+
+        with self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            username="user",
+            password="passwd",
+        ) as sess, mock.patch.object(
+            sess.auth,
+            "_init_auth",
+            wraps=sess.auth._init_auth,
+        ) as init_auth:
+            results = sess.ecp_authenticate_many([
+                "https://sp1.example.com/data",
+                "https://bad.example.com/data",
+                "https://sp2.example.com/data",
+            ], max_workers=3)
+
+        init_auth.assert_called_once()
+        assert sess.auth.counters == {"attempts": 3, "failures": 1}
+        assert [r.url for r in results] == [
+            "https://sp1.example.com/data",
+            "https://bad.example.com/data",
+            "https://sp2.example.com/data",
+        ]
+        assert [r.ok for r in results] == [True, False, True]
+        assert results[0].error is None
+        assert isinstance(results[1].error, HTTPError)
+        assert all(r.elapsed >= 0 for r in results)
+
+    def test_ecp_session_status(self, requests_mock):
+        """Test that `Session.ecp_session_status` probes the SP session.
+        """
+        url = "https://example.com/data"
+
+        def _head(request, context):
+            if "_shibsession_abc=123" not in request.headers.get("Cookie", ""):
+                context.status_code = 302
+                context.headers["Location"] = (
+                    "https://example.com/Shibboleth.sso/Login"
+                )
+            return b""
+
+        probe = requests_mock.head(url, content=_head)
+        requests_mock.get(url, content=SP_ECP_PAOS_RESPONSE)
+        requests_mock.post(
+            "https://idp.example.com/profile/SAML2/SOAP/ECP",
+            content=IDP_ECP_SOAP_RESPONSE
+        )
+        requests_mock.post(
+            "https://example.com/Shibboleth.sso/SAML2/ECP",
+            status_code=302,
+            headers={"location": url},
+        )
+
+        with self.TEST_CLASS(
+            idp="https://idp.example.com/profile/SAML2/SOAP/ECP",
+            username="user",
+            password="passwd",
+            session_lifetime=600,
+        ) as sess:
+            # no session, and the probe doesn't trigger a login
+            assert sess.ecp_session_status(url) == (False, None)
+            assert requests_mock.call_count == 1
+
+            sess.ecp_authenticate(url)
+            # requests_mock doesn't add cookies to the session jar
+            sess.cookies.set("_shibsession_abc", "123", domain="example.com")
+            status = sess.ecp_session_status(url, ttl=60)
+            assert status.valid
+            assert 590 < status.expires_in <= 600
+
+            # the result is cached
+            sess.ecp_session_status(url, ttl=60)
+            assert probe.call_count == 2
+
+    def test_ecp_session_status_sign_in(self, requests_mock):
+        """Test that a redirect to a GitLab sign-in page isn't a session.
+        """
+        url = "https://git.example.com/project"
+        requests_mock.head(
+            url,
+            status_code=302,
+            headers={"Location": "https://git.example.com/users/sign_in"},
+        )
+        with self.TEST_CLASS(idp="https://idp.example.com") as sess:
+            assert sess.ecp_session_status(url) == (False, None)
+
+    def test_ecp_session_expiry_domain(self):
+        """Test that session cookies only match their domain and subdomains.
+        """
+        with self.TEST_CLASS(idp="https://idp.example.com") as sess:
+            sess.cookies.set(
+                "_shibsession_abc",
+                "123",
+                domain=".example.com",
+                expires=1000,
+            )
+            assert sess._ecp_session_expiry("example.com") == 1000
+            assert sess._ecp_session_expiry("sp.example.com") == 1000
+            assert sess._ecp_session_expiry("evilexample.com") is None
+
+    def test_ecp_session_status_cookie_cache(self, requests_mock, tmp_path):
+        """Test that `Session.ecp_session_status` sends cached cookies.
+        """
+        url = "https://example.com/data"
+        idp = "https://idp.example.com/profile/SAML2/SOAP/ECP"
+        probe = requests_mock.head(
+            url,
+            status_code=200,
+            additional_matcher=lambda r: "_shibsession_abc=123" in (
+                r.headers.get("Cookie", "")
+            ),
+        )
+        cache = requests_ecp.CookieCache(tmp_path / "cookies.json")
+        cache.store(
+            url,
+            idp,
+            [create_cookie("_shibsession_abc", "123", domain="example.com")],
+        )
+        with self.TEST_CLASS(idp=idp, cookie_cache=cache) as sess:
+            assert sess.ecp_session_status(url).valid
+        assert probe.call_count == 1
+        # the probe isn't authenticated
+        assert not probe.last_request.hooks["response"]